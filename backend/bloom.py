@@ -0,0 +1,96 @@
+import hashlib
+import math
+
+"""
+Bloom filter in a Redis bitmap.
+
+    bloom = RedisBloomFilter(redis_client, '{users_bloom}', capacity=1_000_000, error_rate=0.001)
+    bloom.build(all_items)
+    bloom.add_many(['a', 'b'])
+    bloom.may_contain_many(['a', 'c'])  # [True, False], True can be a false positive
+
+The bitmap is sized (m bits, k hashes) for capacity items at error_rate, the k positions of an item
+come from one blake2b digest (double hashing). Until build() stored a complete bitmap for the same
+m and k (the ready marker) every item may be contained, so callers fall back to their exact check.
+A bitmap lost after the build (eviction, data loss) counts as not built: the checks see it missing
+or shorter than m bits and adds never create it again, only build() does.
+Items can not be removed, a stale one only costs a false positive.
+
+key should be a hash tag (e.g. '{users_bloom}') so the bitmap and its marker share a cluster slot.
+"""
+
+# KEYS[1]: the bitmap, ARGV: the positions to set. Nothing is set when the bitmap does not exist
+ADD_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+for i = 1, #ARGV do
+    redis.call('SETBIT', KEYS[1], ARGV[i], 1)
+end
+return 1
+"""
+
+
+class RedisBloomFilter:
+
+    def __init__(self, client, key: str, capacity: int, error_rate: float):
+        self.client = client
+        self.bits_key = f'{key}:bits'
+        self.ready_key = f'{key}:ready'
+        self.build_key = f'{key}:build'
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.params = f'{self.size}:{self.hashes}'
+
+    def positions(self, item: str) -> list[int]:
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        # NOTE odd, so the k positions differ
+        step = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * step) % self.size for i in range(self.hashes)]
+
+    def add_many(self, items) -> None:
+        positions = [position for item in items for position in self.positions(item)]
+        if positions:
+            self.client.register_script(ADD_SCRIPT)(keys=[self.bits_key], args=positions)
+
+    def may_contain_many(self, items) -> list[bool]:
+        """
+        False when an item was certainly never added, in one round trip
+        """
+        items = list(items)
+        with self.client.pipeline(transaction=False) as pipe:
+            pipe.get(self.ready_key)
+            pipe.strlen(self.bits_key)
+            for item in items:
+                for position in self.positions(item):
+                    pipe.getbit(self.bits_key, position)
+            ready, length, *bits = pipe.execute()
+
+        # NOTE STRLEN is 0 for a missing key
+        if ready is None or ready.decode() != self.params or length < (self.size + 7) // 8:
+            return [True] * len(items)
+        return [all(bits[i * self.hashes:(i + 1) * self.hashes]) for i in range(len(items))]
+
+    def build(self, items) -> int:
+        """
+        Replaces the bitmap with one of items, returns how many there were
+        """
+        bitmap = bytearray((self.size + 7) // 8)
+        count = 0
+        for item in items:
+            for position in self.positions(item):
+                # NOTE SETBIT offset 0 is the most significant bit of the first byte
+                bitmap[position >> 3] |= 0x80 >> (position & 7)
+            count += 1
+
+        # NOTE written aside and renamed with the marker in one transaction, a check never sees a partial bitmap
+        self.client.set(self.build_key, bytes(bitmap))
+        with self.client.pipeline() as pipe:
+            pipe.rename(self.build_key, self.bits_key)
+            pipe.set(self.ready_key, self.params)
+            pipe.execute()
+        return count
+
+    def false_positive_rate(self, count: int) -> float:
+        return (1 - math.exp(-self.hashes * count / self.size)) ** self.hashes
@@ -1,28 +1,331 @@
-import redis
+import copy
+import threading
+import time
 
 from django.conf import settings
+from django.core.cache import caches, DEFAULT_CACHE_ALIAS
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 
 from django_redis.cache import RedisCache
 
+from backend.cache_metrics import record_call, value_size
+from backend.redis_connections import LoopLocalAsyncClient, redis_connections
+
 class PrefixedRedisCache(RedisCache):
     """
     Prefixed cache with init from settings
+
+    get_cache returns one cache per prefix for the whole process. They are built from a copy of
+    settings.CACHES[REDIS_CACHE_NAME], so they all use the same django-redis connection pool
+    (pools are shared by url) and settings are never modified. The redis-py client behind them
+    is thread-safe, so the same instance can be used from every thread.
     """
+    _registry: dict[str, RedisCache] = {}
+    _registry_lock = threading.Lock()
 
     @classmethod
     def get_cache(cls, prefix: str) -> RedisCache:
-        params = settings.CACHES.get(settings.REDIS_CACHE_NAME, {})
-        params['KEY_PREFIX'] = prefix
+        cache = cls._registry.get(prefix)
+        if cache is None:
+            with cls._registry_lock:
+                cache = cls._registry.get(prefix)
+                if cache is None:
+                    params = copy.deepcopy(settings.CACHES.get(settings.REDIS_CACHE_NAME, {}))
+                    params['KEY_PREFIX'] = prefix
+                    location = params.get('LOCATION', '')
+                    cache = cls._registry[prefix] = cls(server=location, params=params)
+        return cache
+
+    @classmethod
+    def clear_registry(cls) -> None:
+        with cls._registry_lock:
+            cls._registry.clear()
+
+
+@receiver(setting_changed)
+def clear_prefixed_caches(setting, **kwargs):
+    # NOTE override_settings(CACHES=...) in tests must not keep using the old caches
+    if setting in ('CACHES', 'REDIS_CACHE_NAME'):
+        PrefixedRedisCache.clear_registry()
+
+
+class AsyncCache:
+    """
+    Native asyncio access to a Django cache.
+
+    Django's cache a* methods run the sync client in the main thread, which serializes every
+    async view on a single thread. For django-redis caches this talks to Redis through
+    redis.asyncio instead, using the same keys and value encoding as the sync cache, on the
+    first server of the alias LOCATION (the master, django-redis writes there too).
+    Other backends (e.g. locmem in tests) fall back to Django's a* methods.
+    """
+
+    def __init__(self, alias: str = DEFAULT_CACHE_ALIAS):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @property
+    def async_client(self):
+        """
+        'async' role client of the running event loop for the alias LOCATION, db and OPTIONS password
+        """
+        params = settings.CACHES[self.alias]
         location = params.get('LOCATION', '')
-        return cls(server=location, params=params)
+        if isinstance(location, str):
+            location = location.split(',')
+        connection_kwargs = {}
+        password = params.get('OPTIONS', {}).get('PASSWORD')
+        if password:
+            connection_kwargs['password'] = password
+        return redis_connections.get_async_client('async', location[0].strip(), **connection_kwargs)
+
+    def _native(self) -> bool:
+        return isinstance(self.cache, RedisCache)
+
+    def _expiry_ms(self, timeout) -> int | None:
+        """
+        PX of a write, resolved like django-redis: DEFAULT_TIMEOUT is the alias TIMEOUT, None never expires.
+        NOTE not get_backend_timeout, BaseCache returns an absolute time there
+        """
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.cache.default_timeout
+        return None if timeout is None else int(timeout * 1000)
+
+    async def get(self, key, default=None):
+        if not self._native():
+            return await self.cache.aget(key, default)
+        client = self.cache.client
+        start = time.perf_counter()
+        value = await self.async_client.get(client.make_key(key))
+        record_call(self.cache, 'get', [key], start, [value is not None], [_size(value)])
+        return default if value is None else client.decode(value)
+
+    async def set(self, key, value, timeout=DEFAULT_TIMEOUT) -> None:
+        if not self._native():
+            return await self.cache.aset(key, value, timeout)
+        expiry = self._expiry_ms(timeout)
+        if expiry is not None and expiry <= 0:
+            # NOTE same as django-redis, a timeout of 0 or less expires the key right away
+            return await self.delete(key)
+        client = self.cache.client
+        value = client.encode(value)
+        start = time.perf_counter()
+        await self.async_client.set(client.make_key(key), value, px=expiry)
+        record_call(self.cache, 'set', [key], start, sizes=[value_size(value)])
+
+    async def add(self, key, value, timeout=DEFAULT_TIMEOUT) -> bool:
+        if not self._native():
+            return await self.cache.aadd(key, value, timeout)
+        expiry = self._expiry_ms(timeout)
+        if expiry is not None and expiry <= 0:
+            return False
+        client = self.cache.client
+        value = client.encode(value)
+        start = time.perf_counter()
+        added = await self.async_client.set(client.make_key(key), value, px=expiry, nx=True)
+        record_call(self.cache, 'set', [key], start, sizes=[value_size(value)])
+        return bool(added)
+
+    async def delete(self, key) -> None:
+        if not self._native():
+            return await self.cache.adelete(key)
+        start = time.perf_counter()
+        await self.async_client.delete(self.cache.client.make_key(key))
+        record_call(self.cache, 'delete', [key], start)
+
+    async def get_many(self, keys: list) -> dict:
+        if not self._native():
+            return await self.cache.aget_many(keys)
+        client = self.cache.client
+        start = time.perf_counter()
+        values = await self.async_client.mget([client.make_key(key) for key in keys])
+        record_call(self.cache, 'get', keys, start,
+                    [value is not None for value in values], [_size(value) for value in values])
+        return {key: client.decode(value) for key, value in zip(keys, values) if value is not None}
+
+    async def set_many(self, rows: list[tuple]) -> None:
+        """
+        rows of (key, value, timeout), written in one round trip
+        """
+        if not self._native():
+            for timeout, data in _group_by_timeout(rows).items():
+                await self.cache.aset_many(data, timeout)
+            return
+        client = self.cache.client
+        rows = [(key, client.encode(value), self._expiry_ms(timeout)) for key, value, timeout in rows]
+        start = time.perf_counter()
+        async with self.async_client.pipeline(transaction=False) as pipe:
+            for key, value, expiry in rows:
+                if expiry is not None and expiry <= 0:
+                    pipe.delete(client.make_key(key))
+                else:
+                    pipe.set(client.make_key(key), value, px=expiry)
+            await pipe.execute()
+        record_call(self.cache, 'set', [row[0] for row in rows], start, sizes=[value_size(row[1]) for row in rows])
+
+    async def delete_many(self, keys: list) -> None:
+        if not self._native():
+            return await self.cache.adelete_many(keys)
+        if keys:
+            start = time.perf_counter()
+            await self.async_client.delete(*(self.cache.client.make_key(key) for key in keys))
+            record_call(self.cache, 'delete', list(keys), start)
+
+
+def _size(value) -> int | None:
+    return None if value is None else value_size(value)
+
+
+def _group_by_timeout(rows: list[tuple]) -> dict:
+    grouped = {}
+    for key, value, timeout in rows:
+        grouped.setdefault(timeout, {})[key] = value
+    return grouped
+
+
+def hash_tag(tag) -> str:
+    """
+    Redis Cluster only hashes the {tag} part of a key: keys with the same tag are in the same slot,
+    which Lua scripts and MULTI on several keys require
+    """
+    return f'{{{tag}}}'
+
+
+class CacheKey:
+    """
+    A family of cache keys: prefix + identifier, with the TTL and the value serializer of the family.
+
+    Declared once (e.g. in users/cache_keys.py), registered by name:
+        CAPTCHA_PASSED = CacheKey('captcha_passed', 'passed:', timeout=180)
+        CAPTCHA_PASSED.set(ckey, 6)
+
+    serializer is an optional object with dumps/loads applied around the cache's own serializer,
+    timeout None means no expiry. Keys of several families are read and written in one round trip
+    with get_many/set_many/delete_many. With hash_tag=True the identifier is a hash tag, so the keys
+    of every tagged family with the same identifier are in the same Redis Cluster slot.
+    """
+    registry: dict[str, 'CacheKey'] = {}
+
+    def __init__(self, name: str, prefix: str, timeout: int | None, serializer=None, alias: str = DEFAULT_CACHE_ALIAS,
+                 hash_tag: bool = False):
+        if name in self.registry:
+            raise ImproperlyConfigured(f'Cache key {name} is already declared')
+        self.name = name
+        self.prefix = prefix
+        self.timeout = timeout
+        self.serializer = serializer
+        self.alias = alias
+        self.hash_tag = hash_tag
+        self.registry[name] = self
+
+    def __repr__(self):
+        return f'CacheKey({self.name!r}, {self.prefix!r})'
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def key(self, ident='') -> str:
+        return f'{self.prefix}{hash_tag(ident)}' if self.hash_tag else f'{self.prefix}{ident}'
+
+    def get_timeout(self, timeout=DEFAULT_TIMEOUT) -> int | None:
+        return self.timeout if timeout is DEFAULT_TIMEOUT else timeout
+
+    def dumps(self, value):
+        return value if self.serializer is None else self.serializer.dumps(value)
+
+    def loads(self, value):
+        return value if self.serializer is None or value is None else self.serializer.loads(value)
+
+    def get(self, ident='', default=None):
+        value = self.cache.get(self.key(ident))
+        return default if value is None else self.loads(value)
+
+    def set(self, ident, value, timeout=DEFAULT_TIMEOUT) -> None:
+        self.cache.set(self.key(ident), self.dumps(value), self.get_timeout(timeout))
+
+    def add(self, ident, value, timeout=DEFAULT_TIMEOUT) -> bool:
+        return self.cache.add(self.key(ident), self.dumps(value), self.get_timeout(timeout))
+
+    def delete(self, ident='') -> None:
+        self.cache.delete(self.key(ident))
+
+    async def aget(self, ident='', default=None):
+        value = await AsyncCache(self.alias).get(self.key(ident))
+        return default if value is None else self.loads(value)
+
+    async def aset(self, ident, value, timeout=DEFAULT_TIMEOUT) -> None:
+        await AsyncCache(self.alias).set(self.key(ident), self.dumps(value), self.get_timeout(timeout))
+
+    async def aadd(self, ident, value, timeout=DEFAULT_TIMEOUT) -> bool:
+        return await AsyncCache(self.alias).add(self.key(ident), self.dumps(value), self.get_timeout(timeout))
+
+    async def adelete(self, ident='') -> None:
+        await AsyncCache(self.alias).delete(self.key(ident))
+
+
+def _batch_alias(keys) -> str:
+    aliases = {key.alias for key, *_ in keys}
+    if len(aliases) > 1:
+        raise ValueError(f'Keys of different caches can not be batched: {aliases}')
+    return aliases.pop() if aliases else DEFAULT_CACHE_ALIAS
+
+
+def get_many(keys: list[tuple[CacheKey, object]]) -> list:
+    """
+    [(family, ident), ...] -> values in the same order, None for missing keys
+    """
+    cache = caches[_batch_alias(keys)]
+    found = cache.get_many([family.key(ident) for family, ident in keys])
+    return [family.loads(found.get(family.key(ident))) for family, ident in keys]
+
+
+def set_many(items: list[tuple[CacheKey, object, object]]) -> None:
+    """
+    [(family, ident, value), ...] with the TTL of each family, in one round trip
+    """
+    cache = caches[_batch_alias(items)]
+    rows = [(family.key(ident), family.dumps(value), family.timeout) for family, ident, value in items]
+    if not isinstance(cache, RedisCache):
+        for timeout, data in _group_by_timeout(rows).items():
+            cache.set_many(data, timeout)
+        return
+
+    client = cache.client
+    rows = [(key, client.encode(value), timeout) for key, value, timeout in rows]
+    start = time.perf_counter()
+    pipe = client.get_client(write=True).pipeline(transaction=False)
+    for key, value, timeout in rows:
+        pipe.set(client.make_key(key), value, ex=timeout)
+    pipe.execute()
+    record_call(cache, 'set', [row[0] for row in rows], start, sizes=[value_size(row[1]) for row in rows])
+
+
+def delete_many(keys: list[tuple[CacheKey, object]]) -> None:
+    caches[_batch_alias(keys)].delete_many([family.key(ident) for family, ident in keys])
+
+
+async def aget_many(keys: list[tuple[CacheKey, object]]) -> list:
+    found = await AsyncCache(_batch_alias(keys)).get_many([family.key(ident) for family, ident in keys])
+    return [family.loads(found.get(family.key(ident))) for family, ident in keys]
+
+
+async def aset_many(items: list[tuple[CacheKey, object, object]]) -> None:
+    await AsyncCache(_batch_alias(items)).set_many([
+        (family.key(ident), family.dumps(value), family.timeout) for family, ident, value in items
+    ])
+
+
+async def adelete_many(keys: list[tuple[CacheKey, object]]) -> None:
+    await AsyncCache(_batch_alias(keys)).delete_many([family.key(ident) for family, ident in keys])
 
 
-pool = redis.ConnectionPool(
-    host=settings.REDIS['host'],
-    port=settings.REDIS['port'],
-    db=0,
-)
+redis_client = redis_connections.get_client('client')
 
-redis_client = redis.Redis(
-    connection_pool=pool,
-)
+async_redis_client = LoopLocalAsyncClient('async')
@@ -0,0 +1,388 @@
+import functools
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django_redis.client import DefaultClient
+
+from backend.redis_connections import redis_connections
+
+logger = logging.getLogger(__name__)
+
+"""
+Per-namespace cache metrics.
+
+InstrumentedClient is a django-redis CLIENT_CLASS: every get/set/add/delete/incr of the caches
+that use it (and the batched calls) is counted under the namespace of its key, with hits and
+misses, a latency histogram per operation and a histogram of the encoded value sizes.
+
+The namespace of a key is the longest matching prefix among the CacheKey families and
+settings.CACHE_METRICS_NAMESPACES, else the key up to its first ':', else 'other'. Keys are
+never recorded themselves: there are as many as users and some hold secrets (tokens, IPs), so the
+largest value of every namespace is kept as its size only.
+
+Every process counts in memory and adds its counts to the settings.CACHE_METRICS_KEY hash in
+Redis every CACHE_METRICS_FLUSH_INTERVAL seconds (one pipeline, from the thread that records
+after the interval), so the metrics view and `python manage.py cache_metrics` show all processes.
+"""
+
+# Upper bounds, the last bucket is everything above
+LATENCY_BUCKETS_MS = (0.25, 0.5, 1, 2, 5, 10, 25, 50, 100, 250)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+OPERATIONS = ('get', 'set', 'delete', 'incr')
+
+# NOTE HINCRBY can not keep a maximum, the largest value of a namespace is only replaced by a larger one
+SET_LARGEST_SCRIPT = """
+local current = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0')
+if tonumber(ARGV[2]) > current then
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+end
+"""
+
+
+def _bucket(value: float, bounds: tuple) -> str:
+    for bound in bounds:
+        if value <= bound:
+            return str(bound)
+    return 'inf'
+
+
+def bucket_labels(bounds: tuple) -> list[str]:
+    return [str(bound) for bound in bounds] + ['inf']
+
+
+def quantile(counts: dict, bounds: tuple, q: float) -> float | None:
+    """
+    Upper bound of the bucket holding the q quantile, counts are {bucket label: count}
+    """
+    total = sum(counts.values())
+    if not total:
+        return None
+    seen = 0
+    for label in bucket_labels(bounds):
+        seen += counts.get(label, 0)
+        if seen >= total * q:
+            return float(label)
+    return float('inf')
+
+
+class CacheMetrics:
+    """
+    Counters by (namespace, field), e.g. ('passed:', 'get.hit') or ('ruc_emails', 'set.latency.1')
+    """
+
+    def __init__(self, key: str, flush_interval: float):
+        self.key = key
+        self.flush_interval = flush_interval
+        self._counts: dict[tuple[str, str], int] = {}
+        self._largest: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._next_flush = time.monotonic() + flush_interval
+        self._prefixes = ([], -1)
+
+    def prefixes(self) -> list[str]:
+        # NOTE imported here, backend.cache is not loaded yet when django-redis imports the client class
+        from backend.cache import CacheKey
+
+        prefixes, families = self._prefixes
+        if families != len(CacheKey.registry):
+            # Families declared since the last call (modules are imported lazily)
+            families = len(CacheKey.registry)
+            prefixes = {family.prefix for family in CacheKey.registry.values()}
+            prefixes.update(getattr(settings, 'CACHE_METRICS_NAMESPACES', ()))
+            prefixes = sorted(prefixes - {''}, key=len, reverse=True)
+            self._prefixes = (prefixes, families)
+        return prefixes
+
+    def namespace(self, key, key_prefix: str = '') -> str:
+        key = str(key)
+        namespace = next((prefix for prefix in self.prefixes() if key.startswith(prefix)), None)
+        if namespace is None:
+            head, sep, _ = key.partition(':')
+            namespace = head + sep if sep else 'other'
+        return f'{key_prefix}:{namespace}' if key_prefix else namespace
+
+    def record(self, op: str, keys: list, seconds: float, hits: list | None = None,
+               sizes: list | None = None, key_prefix: str = '') -> None:
+        """
+        One cache call on keys: hits and sizes are aligned with keys (None where there is no value)
+        """
+        bucket = _bucket(seconds * 1000, LATENCY_BUCKETS_MS)
+        namespaces = [self.namespace(key, key_prefix) for key in keys]
+        with self._lock:
+            timed = set()
+            for i, namespace in enumerate(namespaces):
+                self._add(namespace, op)
+                if namespace not in timed:
+                    # NOTE a batch is one round trip, its latency is counted once per namespace
+                    timed.add(namespace)
+                    self._add(namespace, f'{op}.calls')
+                    self._add(namespace, f'{op}.latency.{bucket}')
+                    self._add(namespace, f'{op}.us', int(seconds * 1e6))
+                if hits is not None:
+                    self._add(namespace, f'{op}.hit' if hits[i] else f'{op}.miss')
+                size = sizes[i] if sizes is not None else None
+                if size is not None:
+                    self._add(namespace, f'size.{_bucket(size, SIZE_BUCKETS)}')
+                    self._add(namespace, 'size.bytes', size)
+                    if size > self._largest.get(namespace, 0):
+                        self._largest[namespace] = size
+
+        if self.flush_interval and time.monotonic() >= self._next_flush:
+            self.flush()
+
+    def _add(self, namespace: str, field: str, value: int = 1) -> None:
+        counts = self._counts
+        counts[namespace, field] = counts.get((namespace, field), 0) + value
+
+    def _take(self) -> tuple[dict, dict]:
+        with self._lock:
+            counts, self._counts = self._counts, {}
+            largest, self._largest = self._largest, {}
+        return counts, largest
+
+    def flush(self) -> None:
+        """
+        Adds the counts of this process to Redis, only one thread flushes at a time
+        """
+        if not self._flush_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_flush = time.monotonic() + self.flush_interval
+            counts, largest = self._take()
+            if not counts:
+                return
+            pipe = redis_connections.get_client('client').pipeline(transaction=False)
+            for (namespace, field), value in counts.items():
+                pipe.hincrby(self.key, f'{namespace}|{field}', value)
+            for namespace, size in largest.items():
+                # NOTE EVAL, a Redis Cluster pipeline can not load scripts for EVALSHA
+                pipe.eval(SET_LARGEST_SCRIPT, 1, self.key, f'{namespace}|size.max', size)
+            pipe.execute()
+        except Exception as e:
+            # NOTE the counts are dropped, metrics must never break or slow down a request
+            logger.warning(f'[Cache metrics] flush failed: {e}')
+        finally:
+            self._flush_lock.release()
+
+    def snapshot(self) -> dict[str, dict]:
+        """
+        Counts of this process not flushed yet, by namespace
+        """
+        with self._lock:
+            counts = dict(self._counts)
+            largest = dict(self._largest)
+        result = {}
+        for (namespace, field), value in counts.items():
+            result.setdefault(namespace, {})[field] = value
+        for namespace, size in largest.items():
+            result.setdefault(namespace, {})['size.max'] = size
+        return result
+
+    def collect(self) -> dict[str, dict]:
+        """
+        Counts of every process (Redis) plus the unflushed ones of this process
+        """
+        result = {}
+        if self.flush_interval:
+            client = redis_connections.get_client('client')
+            for field, value in client.hgetall(self.key).items():
+                namespace, _, name = field.decode().partition('|')
+                if name == 'size.max_key':
+                    # NOTE written by older versions, until the next --reset
+                    continue
+                result.setdefault(namespace, {})[name] = int(value)
+
+        for namespace, local in self.snapshot().items():
+            merged = result.setdefault(namespace, {})
+            for name, value in local.items():
+                if name == 'size.max':
+                    merged[name] = max(merged.get(name, 0), value)
+                else:
+                    merged[name] = merged.get(name, 0) + value
+        return result
+
+    def reset(self) -> None:
+        self._take()
+        if self.flush_interval:
+            redis_connections.get_client('client').delete(self.key)
+
+
+def summarize(namespace: str, counts: dict) -> dict:
+    """
+    Totals, hit ratio, latency quantiles and sizes of one namespace of collect()
+    """
+    gets = counts.get('get.hit', 0) + counts.get('get.miss', 0)
+    sizes = {label: counts.get(f'size.{label}', 0) for label in bucket_labels(SIZE_BUCKETS)}
+    size_count = sum(sizes.values())
+    row = {
+        'namespace': namespace,
+        'ops': sum(counts.get(op, 0) for op in OPERATIONS),
+        'hit_ratio': round(counts.get('get.hit', 0) / gets, 4) if gets else None,
+        'avg_size': round(counts.get('size.bytes', 0) / size_count) if size_count else None,
+        'max_size': counts.get('size.max'),
+    }
+    for op in OPERATIONS:
+        row[op] = counts.get(op, 0)
+        latency = {label: counts.get(f'{op}.latency.{label}', 0) for label in bucket_labels(LATENCY_BUCKETS_MS)}
+        row[f'{op}_p50_ms'] = quantile(latency, LATENCY_BUCKETS_MS, 0.5)
+        row[f'{op}_p99_ms'] = quantile(latency, LATENCY_BUCKETS_MS, 0.99)
+    row['get_hit'] = counts.get('get.hit', 0)
+    row['get_miss'] = counts.get('get.miss', 0)
+    return row
+
+
+def prometheus_text(metrics: dict[str, dict]) -> str:
+    """
+    Prometheus text exposition of collect()
+    """
+    lines = [
+        '# TYPE cache_operations_total counter',
+        '# TYPE cache_get_results_total counter',
+        '# TYPE cache_latency_seconds histogram',
+        '# TYPE cache_value_size_bytes histogram',
+        '# TYPE cache_value_size_max_bytes gauge',
+    ]
+    for namespace in sorted(metrics):
+        counts = metrics[namespace]
+        ns = namespace.replace('\\', '\\\\').replace('"', '\\"')
+        for op in OPERATIONS:
+            if counts.get(op):
+                lines.append(f'cache_operations_total{{namespace="{ns}",op="{op}"}} {counts[op]}')
+        for result in ('hit', 'miss'):
+            if f'get.{result}' in counts:
+                lines.append(f'cache_get_results_total{{namespace="{ns}",result="{result}"}} {counts[f"get.{result}"]}')
+
+        for op in OPERATIONS:
+            calls = counts.get(f'{op}.calls', 0)
+            if not calls:
+                continue
+            cumulative = 0
+            for label in bucket_labels(LATENCY_BUCKETS_MS):
+                cumulative += counts.get(f'{op}.latency.{label}', 0)
+                le = '+Inf' if label == 'inf' else float(label) / 1000
+                lines.append(f'cache_latency_seconds_bucket{{namespace="{ns}",op="{op}",le="{le}"}} {cumulative}')
+            lines.append(f'cache_latency_seconds_sum{{namespace="{ns}",op="{op}"}} {counts.get(f"{op}.us", 0) / 1e6}')
+            lines.append(f'cache_latency_seconds_count{{namespace="{ns}",op="{op}"}} {calls}')
+
+        cumulative = 0
+        for label in bucket_labels(SIZE_BUCKETS):
+            cumulative += counts.get(f'size.{label}', 0)
+            le = '+Inf' if label == 'inf' else label
+            if cumulative:
+                lines.append(f'cache_value_size_bytes_bucket{{namespace="{ns}",le="{le}"}} {cumulative}')
+        if cumulative:
+            lines.append(f'cache_value_size_bytes_sum{{namespace="{ns}"}} {counts.get("size.bytes", 0)}')
+            lines.append(f'cache_value_size_bytes_count{{namespace="{ns}"}} {cumulative}')
+            lines.append(f'cache_value_size_max_bytes{{namespace="{ns}"}} {counts.get("size.max", 0)}')
+    return '\n'.join(lines) + '\n'
+
+
+cache_metrics = CacheMetrics(
+    getattr(settings, 'CACHE_METRICS_KEY', 'cache_metrics'),
+    getattr(settings, 'CACHE_METRICS_FLUSH_INTERVAL', 10),
+)
+
+_local = threading.local()
+
+MISSING = object()
+
+
+def value_size(value) -> int:
+    """
+    Bytes of an encoded value, django-redis stores integers as their digits
+    """
+    return len(value) if isinstance(value, (bytes, bytearray, memoryview)) else len(str(value))
+
+
+def record_call(cache, op: str, keys: list, start: float, hits: list | None = None, sizes: list | None = None) -> None:
+    """
+    Records a call made on cache's Redis connection directly (pipelines, scripts, redis.asyncio),
+    start is its time.perf_counter()
+    """
+    client = getattr(cache, 'client', None)
+    if isinstance(client, InstrumentedClient):
+        cache_metrics.record(op, keys, time.perf_counter() - start, hits, sizes, cache.key_prefix)
+
+
+class InstrumentedClient(DefaultClient):
+    """
+    django-redis DefaultClient that records its calls in cache_metrics (CACHES OPTIONS.CLIENT_CLASS)
+    """
+
+    def _measure(self, op: str, keys: list, call, hits=None):
+        if getattr(_local, 'sizes', None) is not None:
+            # NOTE nested call (add and set_many go through set), the outer call records it
+            return call()
+        sizes = _local.sizes = []
+        start = time.perf_counter()
+        try:
+            result = call()
+        finally:
+            _local.sizes = None
+        seconds = time.perf_counter() - start
+        try:
+            found = hits(result) if hits is not None else None
+            if found is not None:
+                # NOTE values are decoded in the order of the keys, only the found ones
+                values = iter(sizes)
+                sizes = [next(values, None) if hit else None for hit in found]
+            elif len(sizes) != len(keys):
+                sizes = None
+            cache_metrics.record(op, keys, seconds, found, sizes, self._backend.key_prefix)
+        except Exception as e:
+            logger.warning(f'[Cache metrics] {op} not recorded: {e}')
+        return result
+
+    def encode(self, value):
+        value = super().encode(value)
+        sizes = getattr(_local, 'sizes', None)
+        if sizes is not None:
+            sizes.append(value_size(value))
+        return value
+
+    def decode(self, value):
+        sizes = getattr(_local, 'sizes', None)
+        if sizes is not None:
+            sizes.append(value_size(value))
+        return super().decode(value)
+
+    def get(self, key, default=None, version=None, client=None):
+        call = functools.partial(super().get, key, MISSING, version=version, client=client)
+        value = self._measure('get', [key], call, hits=lambda value: [value is not MISSING])
+        return default if value is MISSING else value
+
+    def get_many(self, keys, version=None, client=None):
+        keys = list(keys)
+        call = functools.partial(super().get_many, keys, version=version, client=client)
+        return self._measure('get', keys, call, hits=lambda found: [key in found for key in keys])
+
+    def has_key(self, key, version=None, client=None):
+        call = functools.partial(super().has_key, key, version=version, client=client)
+        return self._measure('get', [key], call, hits=lambda found: [found])
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, client=None, nx=False, xx=False):
+        call = functools.partial(super().set, key, value, timeout, version=version, client=client, nx=nx, xx=xx)
+        return self._measure('set', [key], call)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None, client=None):
+        call = functools.partial(super().set_many, data, timeout, version=version, client=client)
+        return self._measure('set', list(data), call)
+
+    def delete(self, key, version=None, prefix=None, client=None):
+        call = functools.partial(super().delete, key, version=version, prefix=prefix, client=client)
+        return self._measure('delete', [key], call)
+
+    def delete_many(self, keys, version=None, client=None):
+        keys = list(keys)
+        call = functools.partial(super().delete_many, keys, version=version, client=client)
+        return self._measure('delete', keys, call)
+
+    def _incr(self, key, delta=1, version=None, client=None, ignore_key_check=False):
+        call = functools.partial(super()._incr, key, delta=delta, version=version, client=client,
+                                 ignore_key_check=ignore_key_check)
+        return self._measure('incr', [key], call)
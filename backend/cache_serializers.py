@@ -0,0 +1,96 @@
+import pickle
+import threading
+import zlib
+from typing import Any
+
+import msgpack
+from django_redis.serializers.base import BaseSerializer
+from django_redis.serializers.pickle import PickleSerializer
+
+"""
+Compact serializer for the django-redis caches (OPTIONS.SERIALIZER).
+
+Values are written as msgpack behind a one byte marker, and zlib compressed when the encoded
+value is COMPRESS_MIN_LENGTH bytes or more. Values msgpack can not represent exactly (model
+instances, sets, str/dict subclasses, namedtuples...) are pickled as before. Integers never
+reach the serializer, django-redis stores them raw so INCR/DECR keep working.
+
+Pickle (protocol 2+) always starts with 0x80, which none of the markers use, so values written
+before this serializer are still read. For a rolling deploy, first ship it with
+SERIALIZER_WRITE_FORMAT='pickle' (reads both, writes pickle, old processes can still read
+everything), then switch to 'msgpack'.
+"""
+
+MSGPACK = b'\x01'
+MSGPACK_ZLIB = b'\x02'
+PICKLE_ZLIB = b'\x03'
+
+# NOTE level 1 is ~3x faster than the default 6 and about as small on our payloads
+COMPRESS_LEVEL = 1
+
+# msgpack has no tuple, they are kept as an extension type so they are not read back as lists
+TUPLE_EXT = 1
+
+
+_local = threading.local()
+
+
+def _ext(obj):
+    if type(obj) is tuple:
+        # NOTE packb, the thread's Packer is busy with the outer value
+        return msgpack.ExtType(TUPLE_EXT, msgpack.packb(list(obj), use_bin_type=True, strict_types=True, default=_ext))
+    raise TypeError(f'{type(obj).__name__} is not msgpack serializable')
+
+
+def _ext_hook(code: int, data: bytes):
+    if code == TUPLE_EXT:
+        return tuple(unpack(data))
+    return msgpack.ExtType(code, data)
+
+
+def pack(value: Any) -> bytes:
+    # NOTE a Packer per thread is several times faster than packb for small values
+    packer = getattr(_local, 'packer', None)
+    if packer is None:
+        # strict_types sends subclasses (OrderedDict, SafeString, namedtuples...) to _ext, they are pickled
+        packer = _local.packer = msgpack.Packer(use_bin_type=True, strict_types=True, default=_ext)
+    return packer.pack(value)
+
+
+def unpack(data: bytes) -> Any:
+    return msgpack.unpackb(data, raw=False, strict_map_key=False, ext_hook=_ext_hook)
+
+
+class MsgpackSerializer(BaseSerializer):
+
+    def __init__(self, options) -> None:
+        self.compress_min_length = int(options.get('COMPRESS_MIN_LENGTH', 1024))
+        self.write_format = options.get('SERIALIZER_WRITE_FORMAT', 'msgpack')
+        self.pickle = PickleSerializer(options)
+        super().__init__(options=options)
+
+    def dumps(self, value: Any) -> bytes:
+        if self.write_format == 'pickle':
+            return self.pickle.dumps(value)
+
+        try:
+            data = pack(value)
+        except (TypeError, ValueError, OverflowError):
+            data = self.pickle.dumps(value)
+            if len(data) >= self.compress_min_length:
+                return PICKLE_ZLIB + zlib.compress(data, COMPRESS_LEVEL)
+            return data
+
+        if len(data) >= self.compress_min_length:
+            return MSGPACK_ZLIB + zlib.compress(data, COMPRESS_LEVEL)
+        return MSGPACK + data
+
+    def loads(self, value: bytes) -> Any:
+        marker = value[:1]
+        if marker == MSGPACK:
+            return unpack(value[1:])
+        if marker == MSGPACK_ZLIB:
+            return unpack(zlib.decompress(value[1:]))
+        if marker == PICKLE_ZLIB:
+            return pickle.loads(zlib.decompress(value[1:]))
+        return self.pickle.loads(value)
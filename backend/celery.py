@@ -6,13 +6,9 @@ from celery import Celery
 # Set the default Django settings module
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
-backend_url = f"redis://:{settings.REDIS['pwd']}@{settings.REDIS['host']}:{settings.REDIS['port']}" \
-    if settings.REDIS['pwd'] else \
-    f"redis://{settings.REDIS['host']}:{settings.REDIS['port']}"
-
 app = Celery(
     'core',
-    backend=backend_url,
+    backend=settings.CELERY_RESULT_BACKEND,
     broker=settings.BROKER_URL,
     include=[
         # Tasks from all apps
@@ -31,6 +27,28 @@ app.conf.task_queues = (
     Queue('default'),
 )
 
+app.conf.beat_schedule.update({
+    'ensure_login_history_partitions': {
+        'task': 'users.tasks.ensure_login_history_partitions',
+        'schedule': 24 * 60 * 60.0,
+    },
+})
+
+app.conf.beat_schedule.update({
+    'refill_username_pool': {
+        'task': 'users.tasks.refill_username_pool',
+        'schedule': float(settings.USERNAME_POOL_REFILL_INTERVAL),
+    },
+})
+
+if settings.LOGIN_HISTORY_BUFFERED:
+    app.conf.beat_schedule.update({
+        'flush_login_history': {
+            'task': 'users.tasks.flush_login_history',
+            'schedule': float(settings.LOGIN_HISTORY_FLUSH_INTERVAL),
+        },
+    })
+
 
 if False:
     app.conf.beat_schedule.update({
@@ -0,0 +1,260 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches, DEFAULT_CACHE_ALIAS
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django_redis.cache import RedisCache
+from redis.exceptions import RedisError
+
+from backend.redis_connections import redis_connections
+
+logger = logging.getLogger(__name__)
+
+"""
+Two-tier cache for hot keys that rarely change.
+
+A NearCache keeps the values of one namespace in a bounded per-process LRU, each entry with its
+own local TTL, in front of a Django cache. Writes go to the Django cache and publish the key on
+settings.NEAR_CACHE_CHANNEL, every other process drops its local copy when the message arrives.
+A missed message (e.g. while the subscriber reconnects) is bounded by the local TTL, and all the
+local entries are dropped whenever the subscriber (re)connects.
+
+Namespaces opt in through settings.NEAR_CACHES, a namespace that is not there only uses the
+Django cache. Local values are shared by every thread of the process, treat them as read-only.
+"""
+
+_MISSING = object()
+
+
+class LocalLRU:
+    """
+    Thread-safe LRU of (expires at, value)
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return _MISSING
+            if entry[0] <= time.monotonic():
+                del self._data[key]
+                return _MISSING
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, timeout: float) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + timeout, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class NearCache:
+
+    def __init__(self, namespace: str, max_entries: int = 0, local_timeout: float = 0, alias: str = DEFAULT_CACHE_ALIAS):
+        self.namespace = namespace
+        self.alias = alias
+        self.local_timeout = local_timeout
+        self.local = LocalLRU(max_entries) if max_entries and local_timeout else None
+        # NOTE bumped on every invalidation, a value read from the Django cache before it is not kept locally
+        self.generation = 0
+        self.local_hits = 0
+        self.remote_hits = 0
+        self.misses = 0
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get(self, key, default=None):
+        if self.local is not None:
+            value = self.local.get(key)
+            if value is not _MISSING:
+                self.local_hits += 1
+                return value
+            invalidator.ensure_running()
+
+        generation = self.generation
+        value = self.cache.get(key, _MISSING)
+        if value is _MISSING:
+            self.misses += 1
+            return default
+
+        self.remote_hits += 1
+        if self.local is not None and generation == self.generation:
+            self.local.set(key, value, self.local_timeout)
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, local_timeout: float | None = None) -> None:
+        self.cache.set(key, value, timeout)
+        self.invalidate(key)
+        if self.local is not None:
+            invalidator.ensure_running()
+            self.local.set(key, value, local_timeout or self.local_timeout)
+
+    def delete(self, key) -> None:
+        self.cache.delete(key)
+        self.invalidate(key)
+
+    def invalidate(self, key) -> None:
+        """
+        Drops the local copies of key in every process
+        """
+        self.evict(key)
+        invalidator.publish(self.namespace, key)
+
+    def evict(self, key) -> None:
+        self.generation += 1
+        if self.local is not None:
+            self.local.delete(key)
+
+    def evict_all(self) -> None:
+        self.generation += 1
+        if self.local is not None:
+            self.local.clear()
+
+    def stats(self) -> dict:
+        requests = self.local_hits + self.remote_hits + self.misses
+        remote_requests = self.remote_hits + self.misses
+        return {
+            'namespace': self.namespace,
+            'local_entries': len(self.local) if self.local is not None else 0,
+            'local_hits': self.local_hits,
+            'remote_hits': self.remote_hits,
+            'misses': self.misses,
+            'local_hit_ratio': round(self.local_hits / requests, 4) if requests else None,
+            'remote_hit_ratio': round(self.remote_hits / remote_requests, 4) if remote_requests else None,
+        }
+
+
+class NearCacheInvalidator:
+    """
+    Publishes and receives the invalidation messages of every NearCache of the process,
+    the subscriber is a daemon thread started on first use (and again after a fork)
+    """
+
+    def __init__(self):
+        self._id = uuid.uuid4().hex
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def sender(self) -> str:
+        # NOTE forked workers share _id, the pid tells them apart
+        return f'{self._id}:{os.getpid()}'
+
+    def enabled(self) -> bool:
+        # NOTE other backends (e.g. locmem in tests) are not shared between processes, nothing to invalidate
+        return any(isinstance(caches[cache.alias], RedisCache) for cache in _near_caches.values() if cache.local is not None)
+
+    def publish(self, namespace: str, key) -> None:
+        if not self.enabled():
+            return
+        message = json.dumps([self.sender, namespace, key])
+        try:
+            redis_connections.get_client('client').publish(settings.NEAR_CACHE_CHANNEL, message)
+        except RedisError:
+            logger.exception('[Near cache] invalidation not published, other processes keep their copy until it expires')
+
+    def ensure_running(self) -> None:
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            return
+        if not self.enabled():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.listen, name='near-cache-invalidator', daemon=True)
+                self._thread.start()
+
+    def handle(self, data) -> None:
+        sender, namespace, key = json.loads(data)
+        cache = _near_caches.get(namespace)
+        if sender != self.sender and cache is not None:
+            cache.evict(key)
+
+    def listen(self) -> None:
+        client = redis_connections.get_client('pubsub')
+        while True:
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(settings.NEAR_CACHE_CHANNEL)
+                # NOTE anything may have changed while we were not subscribed
+                for cache in list(_near_caches.values()):
+                    cache.evict_all()
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if not message:
+                        continue
+                    try:
+                        self.handle(message['data'])
+                    except (ValueError, TypeError):
+                        logger.warning(f'[Near cache] bad invalidation message {message["data"]!r}')
+            except RedisError:
+                logger.exception('[Near cache] subscriber disconnected, retrying')
+                time.sleep(1)
+            finally:
+                pubsub.close()
+
+
+invalidator = NearCacheInvalidator()
+
+_near_caches: dict[str, NearCache] = {}
+_near_caches_lock = threading.Lock()
+
+
+def get_near_cache(namespace: str) -> NearCache:
+    """
+    One NearCache per namespace, configured by settings.NEAR_CACHES[namespace]
+    """
+    near_cache = _near_caches.get(namespace)
+    if near_cache is None:
+        with _near_caches_lock:
+            near_cache = _near_caches.get(namespace)
+            if near_cache is None:
+                options = settings.NEAR_CACHES.get(namespace, {})
+                near_cache = _near_caches[namespace] = NearCache(namespace, **options)
+    return near_cache
+
+
+def near_cache_stats() -> list[dict]:
+    return [near_cache.stats() for near_cache in list(_near_caches.values())]
+
+
+def near_cache_prometheus_text(stats: list[dict]) -> str:
+    """
+    Prometheus text exposition of near_cache_stats(), the ratios are left to the queries
+    """
+    lines = [
+        '# TYPE near_cache_entries gauge',
+        '# TYPE near_cache_requests_total counter',
+    ]
+    for near_cache in sorted(stats, key=lambda near_cache: near_cache['namespace']):
+        ns = near_cache['namespace'].replace('\\', '\\\\').replace('"', '\\"')
+        lines.append(f'near_cache_entries{{namespace="{ns}"}} {near_cache["local_entries"]}')
+        for result in ('local_hits', 'remote_hits', 'misses'):
+            lines.append(f'near_cache_requests_total{{namespace="{ns}",result="{result}"}} {near_cache[result]}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,482 @@
+import asyncio
+import threading
+import time
+from urllib.parse import unquote, urlsplit
+
+import redis
+import redis.asyncio
+import redis.asyncio.cluster
+import redis.asyncio.sentinel
+import redis.cluster
+import redis.sentinel
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django_redis.pool import ConnectionFactory
+from redis.asyncio.retry import Retry as AsyncRetry
+from redis.backoff import ExponentialBackoff
+from redis.exceptions import ConnectionError, TimeoutError
+from redis.retry import Retry
+
+"""
+Central Redis connection factory.
+
+Every Redis user of the process gets its connections from the pool of its role in
+settings.REDIS_POOLS (cache, client, async), with the role's pool size, socket timeouts,
+health check interval and retry policy. Pools are blocking: when all the connections of a
+role are in use, callers wait up to `timeout` seconds for one instead of opening more, so
+a process never holds more than the sum of max_connections of its roles. The pools of a
+running process are served at /metrics/redis-pools/ (core.views.RedisPoolMetricsView).
+
+redis.asyncio pools and connections belong to the event loop that first used them, so the
+async ones are kept per running loop and dropped once their loop is closed. An ASGI worker has
+one loop, under WSGI Django runs every async view in a new loop, which then opens its own
+connections. LoopLocalAsyncClient is the module level handle for them.
+
+Celery and channels_redis build their own pools from the same settings (CELERY_REDIS_*,
+CHANNEL_LAYERS), they are counted by `manage.py redis_connection_budget` but not here.
+
+settings.REDIS_MODE picks the topology, the callers do not change:
+- standalone: one Redis at REDIS_URL.
+- sentinel: the pools connect to the current master of REDIS_SENTINEL_MASTER, asked to the
+  REDIS_SENTINELS, and follow it on failover. redis-py sentinel pools do not block, past
+  max_connections they raise ConnectionError instead of waiting.
+- cluster: get_client returns one RedisCluster per role, with a pool of max_connections per
+  node (not blocking either). It discovers the slots when it is created, so the cluster must be
+  reachable when the process starts. Commands on several keys (Lua scripts, MULTI) need
+  keys of the same slot, see backend.cache.hash_tag; MGET/MSET/DEL are split by slot.
+"""
+
+
+class PoolStatsMixin:
+    """
+    Counts the callers that had to wait for a connection, how long, and the waits that timed out
+    """
+
+    def init_stats(self, role: str) -> None:
+        self.role = role
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+        self._stats_lock = threading.Lock()
+
+    def record_wait(self, start: float, timed_out: bool) -> None:
+        with self._stats_lock:
+            self.waits += 1
+            self.wait_time += time.monotonic() - start
+            self.timeouts += timed_out
+
+    def connection_counts(self) -> tuple[int, int]:
+        """
+        (in use, idle)
+        """
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        in_use, idle = self.connection_counts()
+        return {
+            'role': self.role,
+            'max_connections': self.max_connections,
+            'in_use': in_use,
+            'idle': idle,
+            'waits': self.waits,
+            'wait_time': round(self.wait_time, 3),
+            'timeouts': self.timeouts,
+        }
+
+
+class ObservedConnectionPool(PoolStatsMixin, redis.BlockingConnectionPool):
+
+    def __init__(self, role: str, **kwargs):
+        self.init_stats(role)
+        super().__init__(**kwargs)
+
+    def get_connection(self, *args, **kwargs):
+        # NOTE the queue holds idle connections and None placeholders for the ones not opened yet,
+        # it is only empty when max_connections are in use
+        if not self.pool.empty():
+            return super().get_connection(*args, **kwargs)
+
+        start = time.monotonic()
+        try:
+            connection = super().get_connection(*args, **kwargs)
+        except ConnectionError:
+            self.record_wait(start, timed_out=time.monotonic() - start >= self.timeout)
+            raise
+        self.record_wait(start, timed_out=False)
+        return connection
+
+    def connection_counts(self):
+        idle = sum(1 for connection in list(self.pool.queue) if connection is not None)
+        return len(self._connections) - idle, idle
+
+
+class AsyncObservedConnectionPool(PoolStatsMixin, redis.asyncio.BlockingConnectionPool):
+
+    def __init__(self, role: str, **kwargs):
+        self.init_stats(role)
+        super().__init__(**kwargs)
+
+    async def get_connection(self, *args, **kwargs):
+        if self.can_get_connection():
+            return await super().get_connection(*args, **kwargs)
+
+        start = time.monotonic()
+        try:
+            connection = await super().get_connection(*args, **kwargs)
+        except ConnectionError:
+            self.record_wait(start, timed_out=time.monotonic() - start >= self.timeout)
+            raise
+        self.record_wait(start, timed_out=False)
+        return connection
+
+    def connection_counts(self):
+        return len(self._in_use_connections), len(self._available_connections)
+
+
+class ObservedSentinelConnectionPool(PoolStatsMixin, redis.sentinel.SentinelConnectionPool):
+
+    def __init__(self, role: str, service_name: str, sentinel_manager, **kwargs):
+        self.init_stats(role)
+        super().__init__(service_name, sentinel_manager, **kwargs)
+
+    def connection_counts(self):
+        return len(self._in_use_connections), len(self._available_connections)
+
+
+class AsyncObservedSentinelConnectionPool(PoolStatsMixin, redis.asyncio.sentinel.SentinelConnectionPool):
+
+    def __init__(self, role: str, service_name: str, sentinel_manager, **kwargs):
+        self.init_stats(role)
+        super().__init__(service_name, sentinel_manager, **kwargs)
+
+    def connection_counts(self):
+        return len(self._in_use_connections), len(self._available_connections)
+
+
+class RedisCluster(redis.cluster.RedisCluster):
+    """
+    MGET and MSET split by slot like DEL already is, so django-redis get_many works on keys of
+    any slot. NOTE they are not atomic anymore, as with several Redis nodes anyway
+    """
+
+    def mget(self, keys, *args):
+        return self.mget_nonatomic(keys, *args)
+
+    def mset(self, mapping):
+        return self.mset_nonatomic(mapping)
+
+
+class AsyncRedisCluster(redis.asyncio.cluster.RedisCluster):
+
+    async def mget(self, keys, *args):
+        return await self.mget_nonatomic(keys, *args)
+
+    async def mset(self, mapping):
+        return await self.mset_nonatomic(mapping)
+
+
+class RedisConnections:
+    """
+    One pool per (role, url) for the whole process, or one RedisCluster client per role, the async ones per event loop
+    """
+    DEFAULT_DB = 0
+
+    def __init__(self):
+        self._pools = {}
+        self._clusters = {}
+        self._sentinels = {}
+        # NOTE {event loop: {key: async pool, client or sentinel}}, None outside a running loop
+        self._loop_stores = {}
+        # NOTE reentrant, a sentinel pool creates the Sentinel manager while holding it
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def mode() -> str:
+        return settings.REDIS_MODE
+
+    @staticmethod
+    def options(role: str) -> dict:
+        return {**settings.REDIS_POOL_DEFAULTS, **settings.REDIS_POOLS[role]}
+
+    def default_url(self) -> str:
+        return f'{settings.REDIS_URL}/{self.DEFAULT_DB}'
+
+    def pool_kwargs(self, role: str, retry_cls) -> dict:
+        options = self.options(role)
+        errors = (ConnectionError, TimeoutError) if options['retry_on_timeout'] else (ConnectionError,)
+        return {
+            'max_connections': options['max_connections'],
+            'timeout': options['timeout'],
+            'socket_timeout': options['socket_timeout'],
+            'socket_connect_timeout': options['socket_connect_timeout'],
+            'health_check_interval': options['health_check_interval'],
+            'retry': retry_cls(ExponentialBackoff(cap=1, base=0.05), options['retries'], supported_errors=errors),
+        }
+
+    def _get_or_create(self, key: tuple, create, store: dict | None = None):
+        store = self._pools if store is None else store
+        value = store.get(key)
+        if value is None:
+            with self._lock:
+                value = store.get(key)
+                if value is None:
+                    value = store[key] = create()
+        return value
+
+    def _async_store(self) -> dict:
+        """
+        Async pools and clients of the running event loop, the ones of closed loops are forgotten
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        store = self._loop_stores.get(loop)
+        if store is None:
+            with self._lock:
+                store = self._loop_stores.get(loop)
+                if store is None:
+                    for closed in [other for other in self._loop_stores if other is not None and other.is_closed()]:
+                        del self._loop_stores[closed]
+                    store = self._loop_stores[loop] = {}
+        return store
+
+    def sentinel(self, is_async: bool = False):
+        """
+        The Sentinel manager of the process, it asks REDIS_SENTINELS for the master address
+        """
+        def create():
+            options = settings.REDIS_POOL_DEFAULTS
+            sentinel_kwargs = {
+                'password': settings.REDIS_SENTINEL_PASSWORD or None,
+                'socket_timeout': options['socket_timeout'],
+                'socket_connect_timeout': options['socket_connect_timeout'],
+            }
+            cls = redis.asyncio.sentinel.Sentinel if is_async else redis.sentinel.Sentinel
+            return cls(settings.REDIS_SENTINELS, sentinel_kwargs=sentinel_kwargs)
+
+        if is_async:
+            return self._get_or_create(('sentinel',), create, self._async_store())
+        return self._get_or_create((is_async,), create, self._sentinels)
+
+    @staticmethod
+    def sentinel_pool_kwargs(url: str, kwargs: dict) -> tuple[str, dict]:
+        """
+        (master name, pool kwargs) of a redis://:password@<master name>/<db> url
+        """
+        parts = urlsplit(url)
+        kwargs = {key: value for key, value in kwargs.items() if key != 'timeout'}
+        kwargs['db'] = int(parts.path.lstrip('/') or 0)
+        if parts.password:
+            kwargs.setdefault('password', unquote(parts.password))
+        # NOTE not parts.hostname, it is lowercased and master names are case sensitive
+        return parts.netloc.rpartition('@')[2], kwargs
+
+    def get_pool(self, role: str, url: str | None = None, **connection_kwargs) -> ObservedConnectionPool:
+        if self.mode() == 'cluster':
+            raise ImproperlyConfigured('Redis Cluster has a pool per node, use redis_connections.get_client')
+        url = url or self.default_url()
+
+        def create():
+            kwargs = {**self.pool_kwargs(role, Retry), **connection_kwargs}
+            if self.mode() == 'sentinel':
+                service_name, kwargs = self.sentinel_pool_kwargs(url, kwargs)
+                return ObservedSentinelConnectionPool(role, service_name, self.sentinel(), **kwargs)
+            return ObservedConnectionPool.from_url(url, role=role, **kwargs)
+
+        return self._get_or_create((role, url, False), create)
+
+    def get_async_pool(self, role: str, url: str | None = None, **connection_kwargs) -> AsyncObservedConnectionPool:
+        """
+        Pool of the running event loop
+        """
+        if self.mode() == 'cluster':
+            raise ImproperlyConfigured('Redis Cluster has a pool per node, use redis_connections.get_async_client')
+        url = url or self.default_url()
+
+        def create():
+            kwargs = {**self.pool_kwargs(role, AsyncRetry), **connection_kwargs}
+            if self.mode() == 'sentinel':
+                service_name, kwargs = self.sentinel_pool_kwargs(url, kwargs)
+                return AsyncObservedSentinelConnectionPool(role, service_name, self.sentinel(is_async=True), **kwargs)
+            return AsyncObservedConnectionPool.from_url(url, role=role, **kwargs)
+
+        return self._get_or_create(('pool', role, url, tuple(sorted(connection_kwargs.items()))), create, self._async_store())
+
+    def cluster_kwargs(self, role: str, retry_cls, node_cls) -> dict:
+        kwargs = self.pool_kwargs(role, retry_cls)
+        # NOTE node pools do not block, there is nothing to wait for
+        kwargs.pop('timeout')
+        return {
+            **kwargs,
+            'startup_nodes': [node_cls(host, port) for host, port in settings.REDIS_CLUSTER_NODES],
+            'password': settings.REDIS['pwd'] or None,
+        }
+
+    def get_client(self, role: str, url: str | None = None) -> redis.Redis | RedisCluster:
+        if self.mode() == 'cluster':
+            # NOTE url is ignored, there is one cluster
+            return self._get_or_create((role, False), lambda: RedisCluster(
+                **self.cluster_kwargs(role, Retry, redis.cluster.ClusterNode),
+            ), self._clusters)
+        return redis.Redis(connection_pool=self.get_pool(role, url))
+
+    def get_async_client(self, role: str, url: str | None = None, **connection_kwargs) -> redis.asyncio.Redis | AsyncRedisCluster:
+        """
+        Client of the running event loop, do not keep it across loops (see LoopLocalAsyncClient)
+        """
+        store = self._async_store()
+        if self.mode() == 'cluster':
+            return self._get_or_create(('cluster', role), lambda: AsyncRedisCluster(
+                **self.cluster_kwargs(role, AsyncRetry, redis.asyncio.cluster.ClusterNode),
+            ), store)
+        return self._get_or_create(
+            ('client', role, url, tuple(sorted(connection_kwargs.items()))),
+            lambda: redis.asyncio.Redis(connection_pool=self.get_async_pool(role, url, **connection_kwargs)),
+            store,
+        )
+
+    def clear(self) -> None:
+        """
+        Forgets the pools and clients (e.g. after the settings changed), the ones in use keep working
+        """
+        with self._lock:
+            self._pools.clear()
+            self._clusters.clear()
+            self._sentinels.clear()
+            self._loop_stores.clear()
+
+    def stats(self) -> list[dict]:
+        """
+        Utilization of every pool of this process
+        """
+        pools = [(url, is_async, pool) for (role, url, is_async), pool in list(self._pools.items())]
+        clusters = [(role, is_async, client) for (role, is_async), client in list(self._clusters.items())]
+        for store in list(self._loop_stores.values()):
+            for key, value in list(store.items()):
+                if key[0] == 'pool':
+                    pools.append((key[2] or self.default_url(), True, value))
+                elif key[0] == 'cluster':
+                    clusters.append((key[1], True, value))
+
+        result = []
+        for url, is_async, pool in pools:
+            parts = urlsplit(url)
+            if hasattr(pool, 'service_name'):
+                location = f'{pool.service_name}{parts.path}'
+            else:
+                location = f'{parts.hostname}:{parts.port or 6379}{parts.path}'
+            result.append({**pool.stats(), 'async': is_async, 'location': location})
+
+        for role, is_async, client in clusters:
+            for node in client.get_nodes():
+                if is_async:
+                    in_use, idle = len(node._connections) - len(node._free), len(node._free)
+                    max_connections = node.max_connections
+                elif node.redis_connection is not None:
+                    pool = node.redis_connection.connection_pool
+                    in_use, idle = len(pool._in_use_connections), len(pool._available_connections)
+                    max_connections = pool.max_connections
+                else:
+                    continue
+                result.append({
+                    'role': role,
+                    'max_connections': max_connections,
+                    'in_use': in_use,
+                    'idle': idle,
+                    'waits': 0,
+                    'wait_time': 0.0,
+                    'timeouts': 0,
+                    'async': is_async,
+                    'location': f'{node.host}:{node.port}',
+                })
+        return result
+
+
+redis_connections = RedisConnections()
+
+
+def pools_prometheus_text(stats: list[dict]) -> str:
+    """
+    Prometheus text exposition of RedisConnections.stats(), the pools of every event loop are added up
+    """
+    totals = {}
+    for pool in stats:
+        labels = (pool['role'], pool['location'], pool['async'])
+        total = totals.setdefault(labels, dict.fromkeys(('max_connections', 'in_use', 'idle', 'waits', 'wait_time', 'timeouts'), 0))
+        for field in total:
+            total[field] += pool[field]
+
+    lines = [
+        '# TYPE redis_pool_max_connections gauge',
+        '# TYPE redis_pool_connections gauge',
+        '# TYPE redis_pool_waits_total counter',
+        '# TYPE redis_pool_wait_seconds_total counter',
+        '# TYPE redis_pool_timeouts_total counter',
+    ]
+    for (role, location, is_async), total in sorted(totals.items()):
+        labels = f'role="{role}",location="{location}",async="{str(is_async).lower()}"'
+        lines.append(f'redis_pool_max_connections{{{labels}}} {total["max_connections"]}')
+        lines.append(f'redis_pool_connections{{{labels},state="in_use"}} {total["in_use"]}')
+        lines.append(f'redis_pool_connections{{{labels},state="idle"}} {total["idle"]}')
+        lines.append(f'redis_pool_waits_total{{{labels}}} {total["waits"]}')
+        lines.append(f'redis_pool_wait_seconds_total{{{labels}}} {round(total["wait_time"], 3)}')
+        lines.append(f'redis_pool_timeouts_total{{{labels}}} {total["timeouts"]}')
+    return '\n'.join(lines) + '\n'
+
+
+class LoopLocalAsyncClient:
+    """
+    Module level async client of a role, e.g. async_redis_client = LoopLocalAsyncClient('async').
+
+    Every attribute is looked up on redis_connections.get_async_client for the running event loop,
+    so it can be imported and used from any loop. Scripts registered on it must be called with
+    client=async_redis_client.client(), the script keeps the client it was registered on.
+    """
+
+    def __init__(self, role: str, url: str | None = None, **connection_kwargs):
+        self.role = role
+        self.url = url
+        self.connection_kwargs = connection_kwargs
+
+    def client(self) -> redis.asyncio.Redis | AsyncRedisCluster:
+        return redis_connections.get_async_client(self.role, self.url, **self.connection_kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client(), name)
+
+    def __repr__(self):
+        return f'LoopLocalAsyncClient({self.role!r})'
+
+
+@receiver(setting_changed)
+def clear_redis_connections(setting, **kwargs):
+    if setting.startswith('REDIS_'):
+        redis_connections.clear()
+
+
+class DjangoRedisConnectionFactory(ConnectionFactory):
+    """
+    django-redis connection factory (DJANGO_REDIS_CONNECTION_FACTORY) on the 'cache' role pools
+    """
+
+    def get_or_create_connection_pool(self, params):
+        params = dict(params)
+        url = params.pop('url')
+        # NOTE django-redis params only carry the parser and the OPTIONS password and socket timeouts,
+        # the pool size and the other timeouts come from REDIS_POOLS
+        params = {key: value for key, value in params.items() if value is not None}
+        return redis_connections.get_pool('cache', url, **params)
+
+    def connect(self, url: str):
+        if redis_connections.mode() == 'cluster':
+            # NOTE every cache alias uses the 'cache' cluster client, there is no db to pick
+            return redis_connections.get_client('cache')
+        return super().connect(url)
+
+    def disconnect(self, connection) -> None:
+        if isinstance(connection, redis.cluster.RedisCluster):
+            return connection.disconnect_connection_pools()
+        return super().disconnect(connection)
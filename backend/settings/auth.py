@@ -1,3 +1,5 @@
+import os
+
 from .env import env
 
 SESSION_COOKIE_AGE = 2 * 24 * 60 * 60  # two days
@@ -20,13 +22,65 @@ AUTHENTICATION_BACKENDS = (
 CAPTCHA_ENABLED = False
 CAPTCHA_TIMEOUT = 60 * 60
 RECAPTCHA_SECRET = env('RECAPTCHA_SECRET', default='')
-IP_MASK = env('CAPTCHA_ALLOWED_IP_MASK', default=r'172.\d{1,3}.\d{1,3}.\d{1,3}')
-CAPTCHA_ALLOWED_IP_MASK = fr"{IP_MASK}"
+# NOTE point RECAPTCHA_VERIFY_URL to a local stub server for tests and benchmarks
+RECAPTCHA_VERIFY_URL = env('RECAPTCHA_VERIFY_URL', default='https://www.google.com/recaptcha/api/siteverify')
+RECAPTCHA_CONNECT_TIMEOUT = env.float('RECAPTCHA_CONNECT_TIMEOUT', default=2)  # seconds
+RECAPTCHA_READ_TIMEOUT = env.float('RECAPTCHA_READ_TIMEOUT', default=3)  # seconds
+RECAPTCHA_POOL_SIZE = env.int('RECAPTCHA_POOL_SIZE', default=10)  # keep-alive connections per process
+RECAPTCHA_RESULT_CACHE_TIMEOUT = env.int('RECAPTCHA_RESULT_CACHE_TIMEOUT', default=60)  # seconds
+# IPs that skip the captcha (IPv4/IPv6 CIDRs, see core/ip_allowlist.py), AllowedIPNetwork rows
+# with list_name='captcha_bypass' are added to these
+CAPTCHA_ALLOWED_NETWORKS = env.list('CAPTCHA_ALLOWED_NETWORKS', default=['127.0.0.0/8', '::1/128', '172.16.0.0/12'])
+# How often processes check if AllowedIPNetwork rows changed
+IP_ALLOWLIST_RELOAD_INTERVAL = env.int('IP_ALLOWLIST_RELOAD_INTERVAL', default=30)  # seconds
 
 # DISALLOW_COUNTRY = ('')
 
 # Custom settings for auth
-RUC_COUNT_EMAILS = env('RUC_COUNT_EMAILS', default=5)
-RUC_MIN_SCORE = env('RUC_MIN_SCORE', default=85)
+# Registrations compared with the new one (users/similarity.py indexes them, thousands are fine)
+RUC_COUNT_EMAILS = env.int('RUC_COUNT_EMAILS', default=5)
+RUC_MIN_SCORE = env.int('RUC_MIN_SCORE', default=85)
 ACTIONS_FREEZE_ON_PWD_RESET = env('ACTIONS_FREEZE_ON_PWD_RESET', default=1800)
-ACTIONS_FREEZE_ON_PWD_CHANGE = env('ACTIONS_FREEZE_ON_PWD_CHANGE', default=1800)
\ No newline at end of file
+ACTIONS_FREEZE_ON_PWD_CHANGE = env('ACTIONS_FREEZE_ON_PWD_CHANGE', default=1800)
+
+# Username generation (see users.utils.generate_cool_username)
+USERNAME_CANDIDATES = env.int('USERNAME_CANDIDATES', default=10)  # random usernames checked per query
+USERNAME_POOL_SIZE = env.int('USERNAME_POOL_SIZE', default=1000)  # free usernames kept in Redis
+USERNAME_POOL_REFILL_INTERVAL = env.int('USERNAME_POOL_REFILL_INTERVAL', default=10 * 60)  # seconds
+
+# Bloom filter of the existing usernames and emails checked before the database (see users/bloom.py),
+# build it with `python manage.py rebuild_user_bloom`. About 1.8 MB of Redis per million users at 0.1%
+USER_BLOOM_ENABLED = env.bool('USER_BLOOM_ENABLED', default=True)
+USER_BLOOM_CAPACITY = env.int('USER_BLOOM_CAPACITY', default=1_000_000)
+USER_BLOOM_ERROR_RATE = env.float('USER_BLOOM_ERROR_RATE', default=0.001)
+
+# LoginHistory write-behind (see users/login_history.py)
+# When enabled logins are pushed to Redis and users.tasks.flush_login_history writes them in batches
+LOGIN_HISTORY_BUFFERED = env.bool('LOGIN_HISTORY_BUFFERED', default=False)
+LOGIN_HISTORY_FLUSH_SIZE = env.int('LOGIN_HISTORY_FLUSH_SIZE', default=500)
+LOGIN_HISTORY_FLUSH_INTERVAL = env.int('LOGIN_HISTORY_FLUSH_INTERVAL', default=5)  # seconds
+
+# LoginHistory monthly partitions (see users/partitions.py)
+LOGIN_HISTORY_PARTITIONS_AHEAD = env.int('LOGIN_HISTORY_PARTITIONS_AHEAD', default=3)  # months
+LOGIN_HISTORY_RETENTION_MONTHS = env.int('LOGIN_HISTORY_RETENTION_MONTHS', default=12)
+
+# User agent parsing cache (see users/user_agent.py)
+USER_AGENT_CACHE_SIZE = env.int('USER_AGENT_CACHE_SIZE', default=1024)  # per process LRU entries
+USER_AGENT_REDIS_CACHE = env.bool('USER_AGENT_REDIS_CACHE', default=False)  # share parsed user agents between workers
+USER_AGENT_CACHE_TIMEOUT = env.int('USER_AGENT_CACHE_TIMEOUT', default=60 * 60)
+
+# Password hashing pool (see users/auth/hashing.py)
+PASSWORD_HASHING_WORKERS = env.int('PASSWORD_HASHING_WORKERS', default=os.cpu_count() or 1)
+PASSWORD_HASHING_QUEUE_SIZE = env.int('PASSWORD_HASHING_QUEUE_SIZE', default=64)  # waiting logins, more get a 503
+
+# Async auth views (see users/async_views.py), only useful when running under ASGI
+AUTH_ASYNC_VIEWS = env.bool('AUTH_ASYNC_VIEWS', default=False)
+
+# Auth endpoints rate limits by url name (see users/throttling.py)
+# Each endpoint can be limited per client IP, per email in the request body and for all clients together
+AUTH_THROTTLE_RATES = {
+    'rest_login': {'ip': '30/minute', 'email': '10/minute', 'endpoint': '3000/minute'},
+    'rest_register': {'ip': '10/hour', 'email': '3/hour', 'endpoint': '300/minute'},
+    'rest_password_reset': {'ip': '10/hour', 'email': '3/hour', 'endpoint': '300/minute'},
+    'resend_email_confirmation': {'ip': '10/hour', 'endpoint': '300/minute'},
+}
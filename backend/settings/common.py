@@ -86,7 +86,7 @@ INSTALLED_APPS = [
 # TODO ADD
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware', # NOTE this is for serving static files. If nginx is implemented for production, this is not needed
+    'core.middleware.AsyncWhiteNoiseMiddleware', # NOTE this is for serving static files. If nginx is implemented for production, this is not needed
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.locale.LocaleMiddleware', # New
     # 'core.middleware.force_default_language_middleware', # New
@@ -95,7 +95,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
-    'django_otp.middleware.OTPMiddleware', # New
+    'core.middleware.AsyncOTPMiddleware', # New
     # 'core.middleware.AccessLogsMiddleware', # New
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
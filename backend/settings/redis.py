@@ -1,3 +1,5 @@
+from urllib.parse import quote
+
 from .env import env
 
 REDIS = {
@@ -6,36 +8,168 @@ REDIS = {
     'pwd': env('REDIS_PASS', default=''),
 }
 
+
+def _host_port(node: str) -> tuple[str, int]:
+    host, _, port = node.rpartition(':')
+    return host, int(port)
+
+
+# standalone: REDIS_HOST/REDIS_PORT
+# sentinel: the master REDIS_SENTINEL_MASTER of the REDIS_SENTINELS (host:port,host:port), with failover
+# cluster: Redis Cluster discovered from REDIS_CLUSTER_NODES (host:port,host:port), db 0 only
+REDIS_MODE = env('REDIS_MODE', default='standalone')
+REDIS_SENTINELS = [_host_port(node) for node in env.list('REDIS_SENTINELS', default=[])]
+REDIS_SENTINEL_MASTER = env('REDIS_SENTINEL_MASTER', default='mymaster')
+REDIS_SENTINEL_PASSWORD = env('REDIS_SENTINEL_PASSWORD', default='')  # of the sentinels, REDIS_PASS is the master's
+REDIS_CLUSTER_NODES = [_host_port(node) for node in env.list('REDIS_CLUSTER_NODES', default=[])]
+
+# NOTE in sentinel mode the host of the url is the master name, backend.redis_connections asks the sentinels for it
+_redis_host = {
+    'standalone': f"{REDIS['host']}:{REDIS['port']}",
+    'sentinel': REDIS_SENTINEL_MASTER,
+    'cluster': ':'.join(map(str, REDIS_CLUSTER_NODES[0])) if REDIS_CLUSTER_NODES else '',
+}[REDIS_MODE]
+
+# NOTE quoted, a password with @ : / # would break the url
+_redis_auth = f":{quote(REDIS['pwd'], safe='')}@" if REDIS['pwd'] else ''
+REDIS_URL = f"redis://{_redis_auth}{_redis_host}"
+
+# Connection pools by role, see backend/redis_connections.py. A process opens at most max_connections
+# for every role it uses: `python manage.py redis_connection_budget` adds them up to size Redis maxclients
+REDIS_POOL_DEFAULTS = {
+    'max_connections': 20,
+    'timeout': env.float('REDIS_POOL_TIMEOUT', default=5),  # seconds to wait for a free connection
+    'socket_timeout': env.float('REDIS_SOCKET_TIMEOUT', default=2),  # seconds
+    'socket_connect_timeout': env.float('REDIS_SOCKET_CONNECT_TIMEOUT', default=1),  # seconds
+    'health_check_interval': env.int('REDIS_HEALTH_CHECK_INTERVAL', default=30),  # seconds
+    'retries': env.int('REDIS_RETRIES', default=1),  # on connection errors, with exponential backoff
+    'retry_on_timeout': False,  # NOTE a timed out command may have run, retrying could apply it twice
+}
+
+REDIS_POOLS = {
+    # django-redis, every CACHES alias and PrefixedRedisCache prefix
+    'cache': {'max_connections': env.int('REDIS_CACHE_MAX_CONNECTIONS', default=50)},
+    # backend.cache.redis_client: throttles, login history buffer
+    'client': {'max_connections': env.int('REDIS_CLIENT_MAX_CONNECTIONS', default=20)},
+    # backend.cache.async_redis_client and AsyncCache: async views, one pool per event loop
+    'async': {'max_connections': env.int('REDIS_ASYNC_MAX_CONNECTIONS', default=50)},
+    # backend.near_cache invalidation subscriber, one connection per process
+    'pubsub': {'max_connections': 2},
+    # Celery result backend, in worker processes and wherever results are read
+    'celery': {'max_connections': env.int('REDIS_CELERY_MAX_CONNECTIONS', default=10)},
+    # channels_redis, one pool per event loop. NOTE it blocks up to 5s on BZPOPMIN, no socket timeout
+    'channels': {'max_connections': env.int('REDIS_CHANNELS_MAX_CONNECTIONS', default=20), 'socket_timeout': None},
+}
+
+
+def _redis_pool(role: str) -> dict:
+    return {**REDIS_POOL_DEFAULTS, **REDIS_POOLS[role]}
+
+
 REDIS_CACHE_NAME = 'redis'
 
+# NOTE the pool comes from DJANGO_REDIS_CONNECTION_FACTORY, every alias on the same url shares the 'cache' pool
+# (in cluster mode, the 'cache' RedisCluster client)
+DJANGO_REDIS_CONNECTION_FACTORY = 'backend.redis_connections.DjangoRedisConnectionFactory'
+
+# msgpack + zlib above COMPRESS_MIN_LENGTH bytes, see backend/cache_serializers.py.
+# CACHE_SERIALIZER_WRITE_FORMAT=pickle while old processes that only read pickle are still running
+CACHE_SERIALIZER_OPTIONS = {
+    'SERIALIZER': 'backend.cache_serializers.MsgpackSerializer',
+    'SERIALIZER_WRITE_FORMAT': env('CACHE_SERIALIZER_WRITE_FORMAT', default='msgpack'),
+    'COMPRESS_MIN_LENGTH': env.int('CACHE_COMPRESS_MIN_LENGTH', default=1024),  # bytes
+}
+
 CACHES = {
     'default': {
         'BACKEND': 'backend.cache.PrefixedRedisCache',
-        'LOCATION': 'redis://' + REDIS['host'] + ':' + str(REDIS['port']) + '/0',
+        'LOCATION': f'{REDIS_URL}/0',
         'OPTIONS': {
-            'PASSWORD': REDIS['pwd'],
-            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            'CLIENT_CLASS': 'backend.cache_metrics.InstrumentedClient',
+            **CACHE_SERIALIZER_OPTIONS,
         },
     },
     REDIS_CACHE_NAME: {
         'BACKEND': 'backend.cache.PrefixedRedisCache',
-        'LOCATION': 'redis://' + REDIS['host'] + ':' + str(REDIS['port']) + '/0',
+        'LOCATION': f'{REDIS_URL}/0',
         'OPTIONS': {
-            'PASSWORD': REDIS['pwd'],
-            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            'CLIENT_CLASS': 'backend.cache_metrics.InstrumentedClient',
+            **CACHE_SERIALIZER_OPTIONS,
         },
     },
 }
 
+# Per-namespace hits, misses, latency and value sizes of the caches above, see backend/cache_metrics.py.
+# Shown by `python manage.py cache_metrics` and /metrics/cache/ (Prometheus text, for staff or with
+# `Authorization: Metrics <CACHE_METRICS_TOKEN>`)
+CACHE_METRICS_KEY = 'cache_metrics'
+CACHE_METRICS_FLUSH_INTERVAL = env.int('CACHE_METRICS_FLUSH_INTERVAL', default=10)  # seconds, 0 keeps them per process
+CACHE_METRICS_TOKEN = env('CACHE_METRICS_TOKEN', default='')
+# Key prefixes that are not CacheKey families (those are added automatically)
+CACHE_METRICS_NAMESPACES = [
+    'user_agent_',
+    'ip_allowlist_version_',
+]
+
+# Two-tier caches (backend/near_cache.py), namespaces not listed here only use the Django cache.
+# Their hit ratios are served per process by /metrics/near-cache/
+NEAR_CACHE_CHANNEL = 'near_cache:invalidate'
+NEAR_CACHES = {
+    # 'namespace': {'max_entries': 1000, 'local_timeout': 60},
+}
+
+# Celery results. NOTE Celery's Redis backend can not use a cluster, it needs its own Redis (REDIS_CELERY_URL)
+if REDIS_MODE == 'sentinel':
+    CELERY_RESULT_BACKEND = ';'.join(
+        f'sentinel://{_redis_auth}{host}:{port}/0'
+        for host, port in REDIS_SENTINELS
+    )
+    CELERY_RESULT_BACKEND_TRANSPORT_OPTIONS = {
+        'master_name': REDIS_SENTINEL_MASTER,
+        'sentinel_kwargs': {'password': REDIS_SENTINEL_PASSWORD or None},
+    }
+elif REDIS_MODE == 'cluster':
+    CELERY_RESULT_BACKEND = env('REDIS_CELERY_URL')
+else:
+    CELERY_RESULT_BACKEND = env('REDIS_CELERY_URL', default=f'{REDIS_URL}/0')
+CELERY_REDIS_MAX_CONNECTIONS = _redis_pool('celery')['max_connections']
+CELERY_REDIS_SOCKET_TIMEOUT = _redis_pool('celery')['socket_timeout']
+CELERY_REDIS_SOCKET_CONNECT_TIMEOUT = _redis_pool('celery')['socket_connect_timeout']
+CELERY_REDIS_BACKEND_HEALTH_CHECK_INTERVAL = _redis_pool('celery')['health_check_interval']
+CELERY_REDIS_RETRY_ON_TIMEOUT = _redis_pool('celery')['retry_on_timeout']
+CELERY_RESULT_BACKEND_ALWAYS_RETRY = _redis_pool('celery')['retries'] > 0
+CELERY_RESULT_BACKEND_MAX_RETRIES = _redis_pool('celery')['retries']
+
+_channels_pool = {
+    'max_connections': _redis_pool('channels')['max_connections'],
+    'socket_timeout': _redis_pool('channels')['socket_timeout'],
+    'socket_connect_timeout': _redis_pool('channels')['socket_connect_timeout'],
+    'health_check_interval': _redis_pool('channels')['health_check_interval'],
+}
+
+# NOTE channels_redis can not use a cluster either, it shards channels over the standalone
+# Redis of REDIS_CHANNELS_URLS (redis://host:port/0,...) instead
+if REDIS_MODE == 'sentinel':
+    _channels_hosts = [{
+        'master_name': REDIS_SENTINEL_MASTER,
+        'sentinels': REDIS_SENTINELS,
+        'sentinel_kwargs': {'password': REDIS_SENTINEL_PASSWORD or None},
+        'password': REDIS['pwd'] or None,
+        'db': 0,
+        **_channels_pool,
+    }]
+elif REDIS_MODE == 'cluster':
+    _channels_hosts = [{'address': url, **_channels_pool} for url in env.list('REDIS_CHANNELS_URLS')]
+else:
+    _channels_hosts = [
+        {'address': url, **_channels_pool} for url in env.list('REDIS_CHANNELS_URLS', default=[f'{REDIS_URL}/0'])
+    ]
+
 CHANNEL_LAYERS = {
     'default': {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
         'CONFIG': {
-            'hosts': [
-                (f"redis://:{REDIS['pwd']}@{REDIS['host']}:{REDIS['port']}/0",)
-                if REDIS['pwd'] else
-                (REDIS['host'], REDIS['port'])
-            ],
+            'hosts': _channels_hosts,
         },
     }
 }
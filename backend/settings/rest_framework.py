@@ -1,5 +1,7 @@
 from datetime import timedelta
 
+from .env import env
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         # 'rest_framework.authentication.TokenAuthentication',
@@ -23,7 +25,9 @@ REST_FRAMEWORK = {
     ),
     'COERCE_DECIMAL_TO_STRING': False,
     'DEFAULT_THROTTLE_CLASSES': [
-        'rest_framework.throttling.ScopedRateThrottle',
+        # NOTE sliding windows in Redis, checked and updated atomically (see core/throttling.py)
+        'core.throttling.ScopedSlidingWindowThrottle',
+        'users.throttling.AuthEndpointThrottle',
     ],
     'DEFAULT_THROTTLE_RATES': {
         'anon': '5/second',
@@ -34,6 +38,9 @@ REST_FRAMEWORK = {
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
 }
 
+# IPs that are never throttled (IPv4/IPv6 CIDRs), AllowedIPNetwork rows with list_name='throttle_exempt' are added to these
+THROTTLE_EXEMPT_NETWORKS = env.list('THROTTLE_EXEMPT_NETWORKS', default=[])
+
 # These are the settings for dj-rest-auth with simplejwt
 REST_AUTH = {
     'USE_JWT': True,
@@ -0,0 +1,152 @@
+import functools
+import logging
+import math
+import random
+import time
+import uuid
+
+from django.core.cache import caches, DEFAULT_CACHE_ALIAS
+from django_redis.cache import RedisCache
+from redis.exceptions import LockError
+
+logger = logging.getLogger(__name__)
+
+"""
+Single-flight cache fill.
+
+    @single_flight('ruc_emails', timeout=300)
+    def recent_usernames() -> list[str]:
+        ...
+
+Calling the function returns the cached value. When it is missing, only the caller that gets
+a short lock recomputes it: the others wait up to `wait` seconds for the new value (and only
+compute it themselves if it still is not there). Values are kept stale_timeout seconds past
+their expiry, so once a value exists callers that do not get the lock return the stale one
+instead of waiting.
+
+Expiry is probabilistic (XFetch): a caller refreshes early with a probability that grows as the
+expiry gets closer and with the time the last computation took, so a hot key is usually
+recomputed by a single caller before it expires.
+"""
+
+ENVELOPE = 'sf'
+LOCK_SUFFIX = ':fill_lock'
+
+
+class FillLock:
+    """
+    Redis lock for django-redis caches, add/delete on a random token for the others (e.g. locmem in tests)
+    """
+
+    def __init__(self, alias: str, key: str, timeout: float):
+        self.cache = caches[alias]
+        self.key = f'{key}{LOCK_SUFFIX}'
+        self.timeout = timeout
+        self.token = uuid.uuid4().hex
+        self._lock = None
+
+    def acquire(self) -> bool:
+        if isinstance(self.cache, RedisCache):
+            self._lock = self.cache.lock(self.key, timeout=self.timeout)
+            return self._lock.acquire(blocking=False)
+        return self.cache.add(self.key, self.token, math.ceil(self.timeout))
+
+    def release(self) -> None:
+        if self._lock is not None:
+            try:
+                self._lock.release()
+            except LockError:
+                logger.warning(f'[Single flight] {self.key} expired before the value was computed')
+        elif self.cache.get(self.key) == self.token:
+            self.cache.delete(self.key)
+
+
+class SingleFlight:
+
+    def __init__(self, func, key, timeout: int, stale_timeout: int | None, lock_timeout: float,
+                 wait: float, beta: float, cache, alias: str):
+        self.func = func
+        self.key_func = key if callable(key) else (lambda *args, **kwargs: key)
+        self.timeout = timeout
+        self.stale_timeout = timeout if stale_timeout is None else stale_timeout
+        self.lock_timeout = lock_timeout
+        self.wait = wait
+        self.beta = beta
+        self._cache = cache
+        self.alias = alias
+        functools.update_wrapper(self, func)
+
+    @property
+    def cache(self):
+        return self._cache if self._cache is not None else caches[self.alias]
+
+    def key(self, *args, **kwargs) -> str:
+        return self.key_func(*args, **kwargs)
+
+    def get_entry(self, key: str) -> tuple | None:
+        """
+        (value, expires at, seconds the computation took), values written without single_flight are ignored
+        """
+        entry = self.cache.get(key)
+        if isinstance(entry, tuple) and len(entry) == 4 and entry[0] == ENVELOPE:
+            return entry[1:]
+        return None
+
+    def is_fresh(self, expires_at: float, delta: float) -> bool:
+        # NOTE log(random()) <= 0, the longer the computation the earlier the refresh may happen
+        return time.time() - delta * self.beta * math.log(1.0 - random.random()) < expires_at
+
+    def compute(self, key: str, *args, **kwargs):
+        start = time.time()
+        value = self.func(*args, **kwargs)
+        delta = time.time() - start
+        self.cache.set(key, (ENVELOPE, value, time.time() + self.timeout, delta), self.timeout + self.stale_timeout)
+        return value
+
+    def __call__(self, *args, **kwargs):
+        key = self.key(*args, **kwargs)
+        entry = self.get_entry(key)
+        if entry is not None and self.is_fresh(entry[1], entry[2]):
+            return entry[0]
+
+        lock = FillLock(self.alias, key, self.lock_timeout)
+        if lock.acquire():
+            try:
+                return self.compute(key, *args, **kwargs)
+            finally:
+                lock.release()
+
+        if entry is not None:
+            # Someone else is refreshing it
+            return entry[0]
+
+        deadline = time.monotonic() + self.wait
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            entry = self.get_entry(key)
+            if entry is not None:
+                return entry[0]
+
+        logger.warning(f'[Single flight] {key} not filled after {self.wait}s, computing it')
+        return self.compute(key, *args, **kwargs)
+
+    def refresh(self, *args, **kwargs):
+        """
+        Recomputes and stores the value now, e.g. after the data it comes from changed
+        """
+        return self.compute(self.key(*args, **kwargs), *args, **kwargs)
+
+    def invalidate(self, *args, **kwargs) -> None:
+        self.cache.delete(self.key(*args, **kwargs))
+
+
+def single_flight(key, timeout: int, *, stale_timeout: int | None = None, lock_timeout: float = 10,
+                  wait: float = 2.0, beta: float = 1.0, cache=None, alias: str = DEFAULT_CACHE_ALIAS):
+    """
+    key is the cache key, or a function of the decorated function's arguments that returns it.
+    cache is any object with get/set/delete (e.g. a backend.near_cache.NearCache), by default caches[alias],
+    locks are always taken on caches[alias].
+    """
+    def decorator(func) -> SingleFlight:
+        return SingleFlight(func, key, timeout, stale_timeout, lock_timeout, wait, beta, cache, alias)
+    return decorator
@@ -5,7 +5,9 @@ from django.urls import path
 from django_otp.admin import OTPAdminSite
 from django.views.generic import TemplateView
 
+from core.views import CacheMetricsView, NearCacheMetricsView, RedisPoolMetricsView
 from users.urls import urlpatterns as users_urlpatterns
+from users.views import PasswordHashingMetricsView
 
 admin.site.__class__ = OTPAdminSite
 # admin.autodiscover()
@@ -18,6 +20,10 @@ admin.site.__class__ = OTPAdminSite
 urlpatterns = [
     path('', TemplateView.as_view(template_name='landing.html'), name='landing'),
     path('admin/', admin.site.urls),
+    path('metrics/cache/', CacheMetricsView.as_view(), name='cache_metrics'),
+    path('metrics/redis-pools/', RedisPoolMetricsView.as_view(), name='redis_pool_metrics'),
+    path('metrics/near-cache/', NearCacheMetricsView.as_view(), name='near_cache_metrics'),
+    path('metrics/password-hashing/', PasswordHashingMetricsView.as_view(), name='password_hashing_metrics'),
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
 
 urlpatterns.extend(users_urlpatterns)
\ No newline at end of file
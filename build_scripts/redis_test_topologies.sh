@@ -0,0 +1,58 @@
+#!/usr/bin/env bash
+# Local Redis Cluster and Sentinel for the RedisClusterTests / RedisSentinelTests in core/tests.py
+#
+#   ./build_scripts/redis_test_topologies.sh start
+#   REDIS_TEST_CLUSTER_NODES=127.0.0.1:7000,127.0.0.1:7001,127.0.0.1:7002 \
+#   REDIS_TEST_SENTINELS=127.0.0.1:26379,127.0.0.1:26380,127.0.0.1:26381 \
+#       python manage.py test core
+#   ./build_scripts/redis_test_topologies.sh stop
+#
+# Needs redis-server and redis-cli (6.2+). Cluster: 3 masters + 3 replicas on 7000-7005.
+# Sentinel: master 6390, replica 6391, 3 sentinels on 26379-26381 watching "mymaster".
+set -o errexit
+
+DIR="${REDIS_TEST_DIR:-/tmp/redis-test-topologies}"
+
+start() {
+    mkdir -p "$DIR"
+
+    for port in 7000 7001 7002 7003 7004 7005; do
+        mkdir -p "$DIR/$port"
+        redis-server --port "$port" --dir "$DIR/$port" --daemonize yes --save '' --appendonly no \
+            --cluster-enabled yes --cluster-config-file nodes.conf --cluster-node-timeout 2000 \
+            --pidfile "$DIR/$port.pid" --logfile "$DIR/$port.log"
+    done
+    sleep 1
+    redis-cli --cluster create 127.0.0.1:7000 127.0.0.1:7001 127.0.0.1:7002 \
+        127.0.0.1:7003 127.0.0.1:7004 127.0.0.1:7005 --cluster-replicas 1 --cluster-yes
+
+    redis-server --port 6390 --dir "$DIR" --daemonize yes --save '' \
+        --pidfile "$DIR/6390.pid" --logfile "$DIR/6390.log"
+    redis-server --port 6391 --dir "$DIR" --daemonize yes --save '' --replicaof 127.0.0.1 6390 \
+        --pidfile "$DIR/6391.pid" --logfile "$DIR/6391.log"
+    for port in 26379 26380 26381; do
+        cat > "$DIR/sentinel-$port.conf" <<EOF
+port $port
+daemonize yes
+pidfile $DIR/$port.pid
+logfile $DIR/$port.log
+sentinel monitor mymaster 127.0.0.1 6390 2
+sentinel down-after-milliseconds mymaster 2000
+sentinel failover-timeout mymaster 10000
+EOF
+        redis-server "$DIR/sentinel-$port.conf" --sentinel
+    done
+}
+
+stop() {
+    for pidfile in "$DIR"/*.pid; do
+        [ -f "$pidfile" ] && kill "$(cat "$pidfile")" 2>/dev/null || true
+    done
+    rm -rf "$DIR"
+}
+
+case "$1" in
+    start) start ;;
+    stop) stop ;;
+    *) echo "usage: $0 start|stop" && exit 1 ;;
+esac
@@ -1,3 +1,11 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import AllowedIPNetwork
+
+
+@admin.register(AllowedIPNetwork)
+class AllowedIPNetworkAdmin(admin.ModelAdmin):
+    list_display = ('list_name', 'network', 'comment', 'updated')
+    list_filter = ('list_name',)
+    search_fields = ('network', 'comment')
+    readonly_fields = ('created', 'updated')
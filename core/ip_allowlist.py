@@ -0,0 +1,149 @@
+import ipaddress
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django_redis.exceptions import ConnectionInterrupted
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+"""
+IP allowlists built on a binary prefix trie of ipaddress networks.
+
+A lookup walks the bits of the address and stops at the first network that contains it,
+so it costs at most the prefix length (32 for IPv4, 128 for IPv6) whatever the size of the list.
+
+IPAllowlist compiles its networks from a setting and/or AllowedIPNetwork rows once per process
+and recompiles when the source changes: the setting is compared on every lookup (override_settings
+in tests) and the database rows through a version number in the cache, checked every
+IP_ALLOWLIST_RELOAD_INTERVAL seconds and bumped by core.signals when the rows change.
+While the cache is down the last compiled trie is kept, lookups never fail on Redis.
+"""
+
+IP_ALLOWLIST_VERSION_CACHE_KEY = 'ip_allowlist_version_'
+
+
+class IPNetworkTrie:
+    """
+    One binary trie per IP version, a node is [child 0, child 1, is the end of a network]
+    """
+
+    def __init__(self, networks=()):
+        self._roots = {4: [None, None, False], 6: [None, None, False]}
+        for network in networks:
+            self.add(network)
+
+    def add(self, network) -> None:
+        network = ipaddress.ip_network(network, strict=False)
+        bits = int(network.network_address)
+        node = self._roots[network.version]
+        for i in range(network.prefixlen):
+            bit = (bits >> (network.max_prefixlen - 1 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, False]
+            node = node[bit]
+        node[2] = True
+
+    def __contains__(self, ip) -> bool:
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+
+        bits = int(address)
+        node = self._roots[address.version]
+        for i in range(address.max_prefixlen - 1, -1, -1):
+            if node[2]:
+                return True
+            node = node[(bits >> i) & 1]
+            if node is None:
+                return False
+        return node[2]
+
+
+class IPAllowlist:
+    """
+    Named allowlist, e.g. IPAllowlist('captcha_bypass', setting='CAPTCHA_ALLOWED_NETWORKS')
+
+    With use_database, AllowedIPNetwork rows with the same list_name are added to the setting networks.
+    """
+
+    def __init__(self, name: str, setting: str | None = None, use_database: bool = True):
+        self.name = name
+        self.setting = setting
+        self.use_database = use_database
+        self._lock = threading.Lock()
+        self._trie = None
+        self._setting_value = None
+        self._db_version = None
+        self._db_checked_at = 0.0
+
+    def setting_networks(self) -> tuple:
+        return tuple(getattr(settings, self.setting, ())) if self.setting else ()
+
+    def database_networks(self) -> list[str]:
+        from core.models import AllowedIPNetwork
+        return list(AllowedIPNetwork.objects.filter(list_name=self.name).values_list('network', flat=True))
+
+    def db_version(self) -> int:
+        return cache.get(f'{IP_ALLOWLIST_VERSION_CACHE_KEY}{self.name}', 0)
+
+    @classmethod
+    def bump_version(cls, name: str) -> None:
+        key = f'{IP_ALLOWLIST_VERSION_CACHE_KEY}{name}'
+        # NOTE add + incr, concurrent changes still get different versions
+        cache.add(key, 0, timeout=None)
+        cache.incr(key)
+
+    def compile(self, setting_value: tuple, db_version) -> IPNetworkTrie:
+        networks = list(setting_value)
+        if self.use_database:
+            networks += self.database_networks()
+
+        trie = IPNetworkTrie()
+        for network in networks:
+            try:
+                trie.add(network)
+            except ValueError:
+                logger.warning(f'[IP allowlist] {self.name}: invalid network {network!r} skipped')
+
+        self._setting_value = setting_value
+        self._db_version = db_version
+        return trie
+
+    def db_check_due(self) -> bool:
+        return self.use_database and time.monotonic() - self._db_checked_at >= settings.IP_ALLOWLIST_RELOAD_INTERVAL
+
+    def needs_refresh(self) -> bool:
+        """
+        True when the next lookup may query the cache or the database, async callers run get_trie in a thread then
+        """
+        return self._trie is None or self.setting_networks() != self._setting_value or self.db_check_due()
+
+    def get_trie(self) -> IPNetworkTrie:
+        setting_value = self.setting_networks()
+        db_version = self._db_version
+        if self.db_check_due():
+            try:
+                db_version = self.db_version()
+            except (ConnectionInterrupted, RedisError) as e:
+                logger.warning(f'[IP allowlist] {self.name}: version check failed, keeping the current networks: {e!r}')
+            self._db_checked_at = time.monotonic()
+
+        trie = self._trie
+        if trie is None or setting_value != self._setting_value or db_version != self._db_version:
+            with self._lock:
+                if self._trie is None or setting_value != self._setting_value or db_version != self._db_version:
+                    self._trie = self.compile(setting_value, db_version)
+                trie = self._trie
+        return trie
+
+    def __contains__(self, ip) -> bool:
+        if not ip:
+            return False
+        return ip in self.get_trie()
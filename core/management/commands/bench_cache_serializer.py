@@ -0,0 +1,62 @@
+import json
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django_redis.serializers.pickle import PickleSerializer
+
+from backend.cache_serializers import MsgpackSerializer
+
+
+def sample_values() -> dict:
+    """
+    Values of the keys this project writes to the cache, with their current shapes
+    """
+    usernames = [f'SwiftFalcon{i}' for i in range(5)]
+    return {
+        'resend token reversed (str)': 'veJlEx0kwqGR6JlupEEp5Du3iVttZZXv',
+        'recaptcha result (bool)': True,
+        'recent usernames, JSON in pickle': json.dumps(usernames),
+        'recent usernames (list)': usernames,
+        'recent usernames x1000 (list)': [f'SwiftFalcon{i}' for i in range(1000)],
+        'allauth rate limit (list of floats)': [time.time() - i for i in range(10)],
+        'session-like dict': {'_auth_user_id': '42', '_auth_user_backend': 'users.auth.backends.EmailBackend',
+                              '_auth_user_hash': 'a' * 64, 'lang': 'en'},
+    }
+
+
+class Command(BaseCommand):
+    help = 'Compares payload size and encode/decode time of the cache serializers on our key types'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20_000)
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        min_length = settings.CACHE_SERIALIZER_OPTIONS['COMPRESS_MIN_LENGTH']
+        serializers = {
+            'pickle': PickleSerializer({}),
+            'msgpack': MsgpackSerializer({'COMPRESS_MIN_LENGTH': sys.maxsize}),
+            f'msgpack+zlib>={min_length}': MsgpackSerializer({'COMPRESS_MIN_LENGTH': min_length}),
+        }
+
+        self.stdout.write(f'{"value":38} {"serializer":22} {"bytes":>7} {"encode us":>10} {"decode us":>10}')
+        for name, value in sample_values().items():
+            for serializer_name, serializer in serializers.items():
+                data = serializer.dumps(value)
+                # NOTE the number of iterations goes down with the payload size
+                runs = max(iterations * 100 // max(len(data), 100), 100)
+
+                start = time.perf_counter()
+                for _ in range(runs):
+                    serializer.dumps(value)
+                encode = (time.perf_counter() - start) / runs * 1e6
+
+                start = time.perf_counter()
+                for _ in range(runs):
+                    serializer.loads(data)
+                decode = (time.perf_counter() - start) / runs * 1e6
+
+                self.stdout.write(f'{name:38} {serializer_name:22} {len(data):7} {encode:10.2f} {decode:10.2f}')
+            self.stdout.write('')
@@ -0,0 +1,80 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from backend.cache import PrefixedRedisCache
+from backend.redis_connections import redis_connections
+
+
+def pool_connections() -> tuple[int, int]:
+    """
+    (pools, connections opened by them) over the 'cache' role pools of the process
+    """
+    pools = [stats for stats in redis_connections.stats() if stats['role'] == 'cache']
+    return len(pools), sum(stats['in_use'] + stats['idle'] for stats in pools)
+
+
+class Command(BaseCommand):
+    help = 'Hammers PrefixedRedisCache.get_cache from several threads and reports the pools and connections used'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--seconds', type=float, default=30)
+        parser.add_argument('--prefixes', type=int, default=50)
+        parser.add_argument('--report-every', type=float, default=5)
+        parser.add_argument(
+            '--no-registry', action='store_true',
+            help='build a new cache on every call (previous behaviour) to compare',
+        )
+
+    def handle(self, *args, **options):
+        prefixes = [f'bench_prefixed_{i}' for i in range(options['prefixes'])]
+        if options['no_registry']:
+            get_cache = self.build_cache
+        else:
+            PrefixedRedisCache.clear_registry()
+            get_cache = PrefixedRedisCache.get_cache
+
+        stop = threading.Event()
+        operations = [0] * options['threads']
+
+        def worker(n):
+            i = 0
+            while not stop.is_set():
+                cache = get_cache(prefixes[i % len(prefixes)])
+                cache.set('key', i, timeout=60)
+                cache.get('key')
+                i += 1
+            operations[n] = i
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(options['threads'])]
+        for thread in threads:
+            thread.start()
+
+        client = PrefixedRedisCache.get_cache('bench_prefixed').client.get_client()
+        start = time.monotonic()
+        try:
+            while time.monotonic() - start < options['seconds']:
+                time.sleep(options['report_every'])
+                pools, opened = pool_connections()
+                self.stdout.write(
+                    f'{time.monotonic() - start:6.1f}s  pools {pools}  pool connections {opened}  '
+                    f'redis clients {client.info("clients")["connected_clients"]}  '
+                    f'registry {len(PrefixedRedisCache._registry)}'
+                )
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+        for prefix in prefixes:
+            get_cache(prefix).delete('key')
+        elapsed = time.monotonic() - start
+        self.stdout.write(f'{sum(operations)} get_cache + set + get in {elapsed:.1f}s '
+                          f'({sum(operations) / elapsed:.0f}/s)')
+
+    @staticmethod
+    def build_cache(prefix: str) -> PrefixedRedisCache:
+        cache = PrefixedRedisCache.get_cache(prefix)
+        return PrefixedRedisCache(server=cache._server, params=cache._params)
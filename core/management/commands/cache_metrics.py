@@ -0,0 +1,45 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from backend.cache_metrics import cache_metrics, summarize
+
+SORT_FIELDS = ('ops', 'get', 'set', 'hit_ratio', 'max_size', 'avg_size', 'get_p99_ms')
+
+
+def _fmt(value, spec: str = '') -> str:
+    return '-' if value is None else format(value, spec)
+
+
+class Command(BaseCommand):
+    help = 'Shows hits, misses, latency and value sizes of the cache by key namespace, for every process'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sort', choices=SORT_FIELDS, default='ops')
+        parser.add_argument('--json', action='store_true', help='one JSON object per namespace')
+        parser.add_argument('--reset', action='store_true', help='clears the metrics after showing them')
+
+    def handle(self, *args, **options):
+        rows = [summarize(namespace, counts) for namespace, counts in cache_metrics.collect().items()]
+        rows.sort(key=lambda row: row[options['sort']] or 0, reverse=True)
+
+        if options['json']:
+            for row in rows:
+                self.stdout.write(json.dumps(row))
+        else:
+            self.stdout.write(
+                f'{"namespace":40} {"ops":>9} {"gets":>9} {"hit %":>6} {"sets":>8} {"dels":>7} {"incrs":>7} '
+                f'{"get p50/p99 ms":>15} {"set p99 ms":>10} {"avg B":>7} {"max B":>9}'
+            )
+            for row in rows:
+                hit_ratio = None if row['hit_ratio'] is None else row['hit_ratio'] * 100
+                self.stdout.write(
+                    f'{row["namespace"][:40]:40} {row["ops"]:9} {row["get"]:9} {_fmt(hit_ratio, ".1f"):>6} '
+                    f'{row["set"]:8} {row["delete"]:7} {row["incr"]:7} '
+                    f'{_fmt(row["get_p50_ms"], "g") + "/" + _fmt(row["get_p99_ms"], "g"):>15} '
+                    f'{_fmt(row["set_p99_ms"], "g"):>10} {_fmt(row["avg_size"]):>7} {_fmt(row["max_size"]):>9}'
+                )
+
+        if options['reset']:
+            cache_metrics.reset()
+            self.stdout.write('Metrics cleared')
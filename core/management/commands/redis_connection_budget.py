@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+# Pool roles (settings.REDIS_POOLS) a process of each kind can open
+PROCESS_ROLES = {
+    'web': ('cache', 'client', 'async', 'pubsub'),
+    'asgi': ('cache', 'client', 'async', 'pubsub', 'channels'),
+    'celery': ('cache', 'client', 'pubsub', 'celery'),
+}
+
+
+class Command(BaseCommand):
+    help = 'Adds up the Redis connections every process can open, to size Redis maxclients'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--web', type=int, default=0, help='WSGI worker processes')
+        parser.add_argument('--asgi', type=int, default=0, help='ASGI worker processes')
+        parser.add_argument('--celery', type=int, default=0, help='Celery pool processes (workers x concurrency)')
+        parser.add_argument('--reserve', type=int, default=32, help='connections kept for redis-cli, monitoring, replicas')
+
+    def handle(self, *args, **options):
+        pools = {role: {**settings.REDIS_POOL_DEFAULTS, **settings.REDIS_POOLS[role]} for role in settings.REDIS_POOLS}
+        for role, pool in pools.items():
+            self.stdout.write(
+                f'{role:10} max {pool["max_connections"]:4}  wait {pool["timeout"]}s  '
+                f'socket {pool["socket_timeout"]}s  connect {pool["socket_connect_timeout"]}s  '
+                f'health check {pool["health_check_interval"]}s  retries {pool["retries"]}'
+            )
+
+        total = options['reserve']
+        for kind, roles in PROCESS_ROLES.items():
+            per_process = sum(pools[role]['max_connections'] for role in roles)
+            processes = options[kind]
+            total += per_process * processes
+            self.stdout.write(f'{kind:10} {per_process:4} per process x {processes} = {per_process * processes}')
+
+        self.stdout.write(f'maxclients >= {total} (with {options["reserve"]} reserved)')
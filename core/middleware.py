@@ -1,4 +1,10 @@
+import functools
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
 from django.utils import translation
+from django.utils.functional import SimpleLazyObject
+from django_otp.middleware import OTPMiddleware
+from whitenoise.middleware import WhiteNoiseMiddleware
 
 # TODO Implement this
 
@@ -50,3 +56,62 @@ class ResponseTimeMiddleware:
     def __call__(self, request):
         response = self.get_response(request)
         return response
+
+
+class AsyncWhiteNoiseMiddleware(WhiteNoiseMiddleware):
+    """
+    WhiteNoiseMiddleware that also runs in async mode.
+
+    WhiteNoise is sync only, so under ASGI Django would run every request below it
+    (including async views) behind async_to_sync, holding a thread per request.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, *args, **kwargs):
+        super().__init__(get_response, *args, **kwargs)
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            # NOTE only with DEBUG, it looks for the file on disk
+            static_file = await sync_to_async(self.find_file)(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return self.serve(static_file, request)
+        return await self.get_response(request)
+
+
+class AsyncOTPMiddleware(OTPMiddleware):
+    """
+    OTPMiddleware that also runs in async mode, request.user is still resolved lazily
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None):
+        super().__init__(get_response)
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        user = getattr(request, 'user', None)
+        if user is not None:
+            request.user = SimpleLazyObject(
+                functools.partial(self._verify_user, request, user)
+            )
+        return await self.get_response(request)
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.5 on 2026-10-17 23:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AllowedIPNetwork',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('list_name', models.CharField(db_index=True, max_length=50)),
+                ('network', models.CharField(help_text='IP or CIDR, e.g. 10.0.0.0/8 or 2001:db8::/32', max_length=49)),
+                ('comment', models.CharField(blank=True, max_length=255)),
+            ],
+            options={
+                'verbose_name': 'Allowed IP network',
+                'verbose_name_plural': 'Allowed IP networks',
+                'constraints': [models.UniqueConstraint(fields=('list_name', 'network'), name='core_allowedipnetwork_list_network_unique')],
+            },
+        ),
+    ]
@@ -1,4 +1,7 @@
+import ipaddress
+
 from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.db import models
 
 """
@@ -18,3 +21,26 @@ class UserMixinModel(models.Model):
 
     class Meta:
         abstract = True
+
+
+class AllowedIPNetwork(BaseModel):
+    """IPv4/IPv6 networks added to the core.ip_allowlist.IPAllowlist with the same list_name"""
+    list_name = models.CharField(max_length=50, db_index=True)
+    network = models.CharField(max_length=49, help_text='IP or CIDR, e.g. 10.0.0.0/8 or 2001:db8::/32')
+    comment = models.CharField(max_length=255, blank=True)
+
+    class Meta:
+        verbose_name = 'Allowed IP network'
+        verbose_name_plural = 'Allowed IP networks'
+        constraints = [
+            models.UniqueConstraint(fields=['list_name', 'network'], name='core_allowedipnetwork_list_network_unique'),
+        ]
+
+    def clean(self):
+        try:
+            self.network = str(ipaddress.ip_network(self.network, strict=False))
+        except ValueError:
+            raise ValidationError({'network': 'Enter a valid IP address or CIDR network.'})
+
+    def __str__(self):
+        return f"{self.list_name} - {self.network}"
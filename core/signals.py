@@ -0,0 +1,12 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from core.ip_allowlist import IPAllowlist
+from core.models import AllowedIPNetwork
+
+
+@receiver(post_save, sender=AllowedIPNetwork)
+@receiver(post_delete, sender=AllowedIPNetwork)
+def reload_ip_allowlist(sender, instance, **kwargs):
+    """Makes every process recompile the allowlist of the changed network."""
+    IPAllowlist.bump_version(instance.list_name)
@@ -1,3 +1,462 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.test import RequestFactory, TestCase, override_settings
+from django_redis.exceptions import ConnectionInterrupted
+from redis.crc import key_slot
+from redis.exceptions import RedisError
+
+from backend.cache import AsyncCache, CacheKey, delete_many, get_many, hash_tag, redis_client, set_many
+from backend.cache_metrics import CacheMetrics, cache_metrics, prometheus_text, summarize
+from backend.cache_serializers import MSGPACK, MSGPACK_ZLIB, MsgpackSerializer
+from backend.near_cache import NearCache, _near_caches, invalidator
+from backend.redis_connections import (
+    AsyncRedisCluster, ObservedSentinelConnectionPool, RedisCluster, RedisConnections, redis_connections,
+)
+from backend.single_flight import FillLock, single_flight
+from core.ip_allowlist import IPAllowlist, IPNetworkTrie
+from core.models import AllowedIPNetwork
+from core.throttling import ScopedSlidingWindowThrottle, SlidingWindowThrottle
+
+
+class IPNetworkTrieTests(TestCase):
+
+    def test_lookups(self):
+        trie = IPNetworkTrie(['10.0.0.0/8', '172.16.0.0/12', '8.8.8.8', '2001:db8::/32'])
+
+        for ip in ('10.1.2.3', '172.31.255.255', '8.8.8.8', '2001:db8::1', '::ffff:10.0.0.1'):
+            self.assertIn(ip, trie)
+        for ip in ('11.0.0.1', '172.32.0.1', '8.8.8.9', '2001:db9::1', 'localhost', ''):
+            self.assertNotIn(ip, trie)
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    TEST_ALLOWED_NETWORKS=['127.0.0.1', 'not-a-network'],
+    IP_ALLOWLIST_RELOAD_INTERVAL=0,
+)
+class IPAllowlistTests(TestCase):
+
+    def test_reloads_on_changes(self):
+        allowlist = IPAllowlist('test', setting='TEST_ALLOWED_NETWORKS')
+        self.assertIn('127.0.0.1', allowlist)
+        self.assertNotIn('192.168.0.10', allowlist)
+
+        network = AllowedIPNetwork.objects.create(list_name='test', network='192.168.0.0/24')
+        self.assertIn('192.168.0.10', allowlist)
+
+        network.delete()
+        self.assertNotIn('192.168.0.10', allowlist)
+
+        with override_settings(TEST_ALLOWED_NETWORKS=['::1']):
+            self.assertIn('::1', allowlist)
+            self.assertNotIn('127.0.0.1', allowlist)
+
+    def test_keeps_the_networks_while_the_cache_is_down(self):
+        allowlist = IPAllowlist('test', setting='TEST_ALLOWED_NETWORKS')
+        AllowedIPNetwork.objects.create(list_name='test', network='192.168.0.0/24')
+        self.assertIn('192.168.0.10', allowlist)
+
+        with mock.patch('core.ip_allowlist.cache.get', side_effect=ConnectionInterrupted(connection=None)):
+            self.assertIn('192.168.0.10', allowlist)
+            self.assertNotIn('10.0.0.1', allowlist)
+
+
+class FixedThrottle(SlidingWindowThrottle):
+    key_prefix = 'test_throttle'
+
+    def get_limits(self, request, view):
+        return {'{test}:a': '3/minute', '{test}:b': '2/minute'}
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    THROTTLE_EXEMPT_NETWORKS=['10.0.0.0/8'],
+    IP_ALLOWLIST_RELOAD_INTERVAL=0,
+)
+class SlidingWindowThrottleTests(TestCase):
+
+    def test_every_limit_applies(self):
+        try:
+            redis_client.ping()
+        except Exception:
+            self.skipTest('needs a local Redis')
+        redis_client.delete('test_throttle:{test}:a', 'test_throttle:{test}:b')
+
+        request = RequestFactory().get('/', REMOTE_ADDR='192.0.2.1')
+        throttles = [FixedThrottle() for _ in range(3)]
+        self.assertEqual([throttle.allow_request(request, None) for throttle in throttles], [True, True, False])
+        self.assertIsNone(throttles[0].wait())
+        # NOTE the oldest request leaves the 2/minute window in (almost) a minute
+        self.assertTrue(55 <= throttles[2].wait() <= 60)
+        # A refused request is not counted
+        self.assertEqual(redis_client.zcard('test_throttle:{test}:a'), 2)
+
+    def test_retry_after(self):
+        throttle = FixedThrottle()
+        with mock.patch('core.throttling.sliding_window_script', return_value=1500) as script:
+            self.assertFalse(throttle.allow_request(RequestFactory().get('/', REMOTE_ADDR='192.0.2.1'), None))
+        self.assertEqual(throttle.wait(), 2)
+        self.assertEqual(script.call_args.kwargs['keys'], ['test_throttle:{test}:a', 'test_throttle:{test}:b'])
+        self.assertEqual(script.call_args.kwargs['args'][1:], [3, 60000, 2, 60000])
+
+    def test_fails_open(self):
+        request = RequestFactory().get('/', REMOTE_ADDR='192.0.2.1')
+        with mock.patch('core.throttling.sliding_window_script', side_effect=RedisError), \
+                self.assertLogs('core.throttling', 'ERROR'):
+            self.assertTrue(FixedThrottle().allow_request(request, None))
+
+        script = mock.AsyncMock(side_effect=RedisError)
+        with mock.patch('core.throttling.async_sliding_window_script', script), \
+                self.assertLogs('core.throttling', 'ERROR'):
+            self.assertTrue(async_to_sync(FixedThrottle().aallow_request)(request, None))
+        script.assert_awaited_once()
+
+    def test_exempt_networks(self):
+        with mock.patch('core.throttling.sliding_window_script', return_value=1500) as script:
+            self.assertTrue(FixedThrottle().allow_request(RequestFactory().get('/', REMOTE_ADDR='10.1.2.3'), None))
+            script.assert_not_called()
+            self.assertFalse(FixedThrottle().allow_request(RequestFactory().get('/', REMOTE_ADDR='11.0.0.1'), None))
+
+        script = mock.AsyncMock(return_value=1500)
+        with mock.patch('core.throttling.async_sliding_window_script', script):
+            request = RequestFactory().get('/', REMOTE_ADDR='10.1.2.3')
+            self.assertTrue(async_to_sync(FixedThrottle().aallow_request)(request, None))
+        script.assert_not_awaited()
+
+    @override_settings(REST_FRAMEWORK={'DEFAULT_THROTTLE_RATES': {'test': '5/second'}})
+    def test_scoped_by_user_or_ip(self):
+        view = SimpleNamespace(throttle_scope='test')
+        request = RequestFactory().get('/', REMOTE_ADDR='192.0.2.1')
+        request.user = AnonymousUser()
+        self.assertEqual(ScopedSlidingWindowThrottle().get_limits(request, view), {'{test}:ip:192.0.2.1': '5/second'})
+
+        request.user = SimpleNamespace(pk=7, is_authenticated=True)
+        self.assertEqual(ScopedSlidingWindowThrottle().get_limits(request, view), {'{test}:user:7': '5/second'})
+        self.assertEqual(ScopedSlidingWindowThrottle().get_limits(request, SimpleNamespace()), {})
+
+
+class CacheMetricsTests(TestCase):
+
+    def test_records_by_namespace(self):
+        metrics = CacheMetrics('test_cache_metrics', flush_interval=0)
+        self.assertEqual(metrics.namespace('resend_verification_token_reversed_7'), 'resend_verification_token_reversed_')
+        self.assertEqual(metrics.namespace('resend_verification_token_7'), 'resend_verification_token_')
+        self.assertEqual(metrics.namespace('resend_verification_in_progress_7'), 'resend_verification_in_progress_')
+        self.assertEqual(metrics.namespace('ip_allowlist_version_0'), 'ip_allowlist_version_')
+        self.assertEqual(metrics.namespace('user_agent_0a1b'), 'user_agent_')
+        self.assertEqual(metrics.namespace('allauth:rl:login'), 'allauth:')
+        self.assertEqual(metrics.namespace('key', key_prefix='prefix'), 'prefix:other')
+
+        metrics.record('get', ['passed:1', 'passed:2'], 0.0003, hits=[True, False], sizes=[1, None])
+        metrics.record('set', ['passed:3'], 0.002, sizes=[5000])
+        row = summarize('passed:', metrics.collect()['passed:'])
+        self.assertEqual((row['ops'], row['get'], row['set'], row['hit_ratio']), (3, 2, 1, 0.5))
+        self.assertEqual((row['get_p99_ms'], row['set_p99_ms']), (0.5, 2.0))
+        self.assertEqual((row['max_size'], row['avg_size']), (5000, 2500))
+        self.assertNotIn('passed:3', str(metrics.collect()))
+
+        text = prometheus_text(metrics.collect())
+        self.assertIn('cache_get_results_total{namespace="passed:",result="miss"} 1', text)
+        self.assertIn('cache_value_size_bytes_bucket{namespace="passed:",le="+Inf"} 2', text)
+
+    def test_view_requires_staff_or_token(self):
+        with mock.patch.object(cache_metrics, 'flush_interval', 0), override_settings(CACHE_METRICS_TOKEN='secret'):
+            self.assertIn(self.client.get('/metrics/cache/').status_code, (401, 403))
+            self.assertIn(self.client.get('/metrics/cache/', HTTP_AUTHORIZATION='Metrics wrong').status_code, (401, 403))
+            response = self.client.get('/metrics/cache/', HTTP_AUTHORIZATION='Metrics secret')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('# TYPE cache_latency_seconds histogram', response.content.decode())
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class NearCacheTests(TestCase):
+
+    def setUp(self):
+        self.near_cache = _near_caches['test'] = NearCache('test', max_entries=2, local_timeout=60)
+        self.addCleanup(_near_caches.pop, 'test')
+
+    def test_local_and_remote_hits(self):
+        self.near_cache.cache.set('a', 1)
+        self.assertEqual(self.near_cache.get('a'), 1)
+        self.assertEqual(self.near_cache.get('a'), 1)
+        self.assertIsNone(self.near_cache.get('b'))
+
+        stats = self.near_cache.stats()
+        self.assertEqual((stats['local_hits'], stats['remote_hits'], stats['misses']), (1, 1, 1))
+
+        # LRU bound
+        self.near_cache.set('b', 2)
+        self.near_cache.set('c', 3)
+        self.assertEqual(self.near_cache.stats()['local_entries'], 2)
+
+    def test_invalidation_message(self):
+        self.near_cache.set('a', 1)
+        self.near_cache.cache.set('a', 2)
+        self.assertEqual(self.near_cache.get('a'), 1)
+
+        # Own messages are ignored, the local copy is already up to date
+        invalidator.handle(json.dumps([invalidator.sender, 'test', 'a']))
+        self.assertEqual(self.near_cache.get('a'), 1)
+
+        invalidator.handle(json.dumps(['other', 'test', 'a']))
+        self.assertEqual(self.near_cache.get('a'), 2)
+
+    @override_settings(CACHE_METRICS_TOKEN='secret')
+    def test_metrics_view(self):
+        self.near_cache.cache.set('a', 1)
+        self.near_cache.get('a')
+        self.near_cache.get('a')
+        self.assertIn(self.client.get('/metrics/near-cache/').status_code, (401, 403))
+        response = self.client.get('/metrics/near-cache/', HTTP_AUTHORIZATION='Metrics secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('near_cache_requests_total{namespace="test",result="local_hits"} 1', response.content.decode())
+        self.assertIn('near_cache_entries{namespace="test"} 1', response.content.decode())
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CacheKeyTests(TestCase):
+
+    def setUp(self):
+        self.tokens = CacheKey('test_tokens', 'test_token_', timeout=60)
+        self.users = CacheKey('test_users', 'test_user_', timeout=None, serializer=json)
+        self.addCleanup(CacheKey.registry.pop, 'test_tokens')
+        self.addCleanup(CacheKey.registry.pop, 'test_users')
+
+    def test_batched_operations(self):
+        set_many([(self.tokens, 'abc', 1), (self.users, 1, ['abc'])])
+        self.assertEqual(self.tokens.cache.get('test_user_1'), '["abc"]')
+        self.assertEqual(get_many([(self.users, 1), (self.tokens, 'abc'), (self.tokens, 'xyz')]), [['abc'], 1, None])
+
+        delete_many([(self.tokens, 'abc'), (self.users, 1)])
+        self.assertEqual(get_many([(self.tokens, 'abc'), (self.users, 1)]), [None, None])
+
+
+class MsgpackSerializerTests(TestCase):
+
+    def test_round_trip(self):
+        serializer = MsgpackSerializer({'COMPRESS_MIN_LENGTH': 100})
+        values = ['token', True, None, 1.5, ['a', ('b', 1)], {'a': {1: (2,)}}, OrderedDict(a=1), {1, 2}, 2 ** 70]
+        for value in values:
+            loaded = serializer.loads(serializer.dumps(value))
+            self.assertEqual(loaded, value)
+            self.assertIs(type(loaded), type(value))
+
+        self.assertEqual(serializer.dumps(['a'])[:1], MSGPACK)
+        self.assertEqual(serializer.dumps(['a' * 200])[:1], MSGPACK_ZLIB)
+
+    def test_reads_pickled_values(self):
+        value = {'written': 'before msgpack'}
+        self.assertEqual(MsgpackSerializer({}).loads(pickle.dumps(value)), value)
+        self.assertEqual(pickle.loads(MsgpackSerializer({'SERIALIZER_WRITE_FORMAT': 'pickle'}).dumps(value)), value)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class SingleFlightTests(TestCase):
+
+    def test_one_computation_for_concurrent_misses(self):
+        calls = []
+
+        @single_flight('test_single_flight', timeout=60)
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return ['value']
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(compute())) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [['value']] * 8)
+
+    def test_stale_value_while_refreshing(self):
+        values = iter(['first', 'second'])
+
+        @single_flight('test_single_flight_stale', timeout=60)
+        def compute():
+            return next(values)
+
+        self.assertEqual(compute(), 'first')
+        # Expired, but another process holds the lock
+        compute.cache.set('test_single_flight_stale', ('sf', 'first', time.time() - 1, 0.0), 60)
+        lock = FillLock('default', 'test_single_flight_stale', 10)
+        self.assertTrue(lock.acquire())
+        self.assertEqual(compute(), 'first')
+
+        lock.release()
+        self.assertEqual(compute(), 'second')
+
+
+def _test_nodes(variable: str) -> list[tuple[str, int]]:
+    return [(node.rpartition(':')[0], int(node.rpartition(':')[2])) for node in os.environ.get(variable, '').split(',') if node]
+
+
+class RedisTopologyTests(TestCase):
+
+    @override_settings(REDIS_MODE='sentinel', REDIS_SENTINELS=[('127.0.0.1', 26379)], REDIS_URL='redis://:secret@MyMaster')
+    def test_sentinel_pools(self):
+        connections = RedisConnections()
+        pool = connections.get_pool('client')
+        self.assertIsInstance(pool, ObservedSentinelConnectionPool)
+        self.assertEqual(pool.service_name, 'MyMaster')
+        self.assertEqual((pool.connection_kwargs['db'], pool.connection_kwargs['password']), (0, 'secret'))
+        self.assertEqual(connections.stats()[0]['location'], 'MyMaster/0')
+
+    @override_settings(REDIS_MODE='cluster', REDIS_CLUSTER_NODES=[('127.0.0.1', 7000)])
+    def test_cluster_has_no_single_pool(self):
+        connections = RedisConnections()
+        with self.assertRaises(ImproperlyConfigured):
+            connections.get_pool('client')
+        self.assertIsInstance(connections.get_async_client('async'), AsyncRedisCluster)
+
+    def test_async_clients_per_event_loop(self):
+        connections = RedisConnections()
+
+        async def pool():
+            return connections.get_async_client('async').connection_pool
+
+        first, second = asyncio.run(pool()), asyncio.run(pool())
+        self.assertIsNot(first, second)
+        # The pool of the closed loop is forgotten
+        self.assertEqual(len(connections.stats()), 1)
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'backend.cache.PrefixedRedisCache',
+        'LOCATION': 'redis://10.0.0.1:6380/3,redis://10.0.0.2:6380/3',
+        'OPTIONS': {'PASSWORD': 'secret'},
+    }})
+    def test_async_cache_on_the_alias_location(self):
+        async def connection_kwargs():
+            return AsyncCache().async_client.connection_pool.connection_kwargs
+
+        kwargs = asyncio.run(connection_kwargs())
+        self.assertEqual((kwargs['host'], kwargs['port'], kwargs['db'], kwargs['password']), ('10.0.0.1', 6380, 3, 'secret'))
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'backend.cache.PrefixedRedisCache',
+        'LOCATION': 'redis://localhost:6379/0',
+        'TIMEOUT': 300,
+    }})
+    def test_async_cache_timeouts(self):
+        client = mock.AsyncMock()
+        with mock.patch.object(AsyncCache, 'async_client', client):
+            cache = AsyncCache()
+            async_to_sync(cache.set)('default', 1)
+            async_to_sync(cache.add)('forever', 1, timeout=None)
+            async_to_sync(cache.set)('expired', 1, timeout=0)
+        # The alias TIMEOUT, like cache.set, not a key that never expires
+        self.assertEqual(client.set.await_args_list[0].kwargs['px'], 300_000)
+        self.assertIsNone(client.set.await_args_list[1].kwargs['px'])
+        self.assertEqual(client.set.await_count, 2)
+        client.delete.assert_awaited_once()
+
+    @override_settings(CACHE_METRICS_TOKEN='secret')
+    def test_pool_metrics_view(self):
+        redis_connections.get_pool('client')
+        self.assertIn(self.client.get('/metrics/redis-pools/').status_code, (401, 403))
+        response = self.client.get('/metrics/redis-pools/', HTTP_AUTHORIZATION='Metrics secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('redis_pool_connections{role="client",location="localhost:6379/0",async="false",state="idle"} 0',
+                      response.content.decode())
+
+    def test_hash_tagged_keys_share_a_slot(self):
+        tagged = [CacheKey(f'test_tagged_{i}', f'tagged_{i}:', timeout=60, hash_tag=True) for i in range(3)]
+        self.addCleanup(lambda: [CacheKey.registry.pop(family.name) for family in tagged])
+        self.assertEqual(tagged[0].key(42), 'tagged_0:{42}')
+        self.assertEqual(len({key_slot(family.key(42).encode()) for family in tagged}), 1)
+
+
+@skipUnless(os.environ.get('REDIS_TEST_CLUSTER_NODES'), 'needs REDIS_TEST_CLUSTER_NODES, see build_scripts/redis_test_topologies.sh')
+class RedisClusterTests(TestCase):
+    """
+    Runs against a local Redis Cluster: REDIS_TEST_CLUSTER_NODES=127.0.0.1:7000,127.0.0.1:7001,...
+    """
+
+    def setUp(self):
+        overrides = override_settings(
+            REDIS_MODE='cluster',
+            REDIS_CLUSTER_NODES=_test_nodes('REDIS_TEST_CLUSTER_NODES'),
+            CACHES={'default': {
+                'BACKEND': 'backend.cache.PrefixedRedisCache',
+                'LOCATION': 'redis://127.0.0.1/0',
+                'KEY_PREFIX': 'test_cluster',
+                'OPTIONS': {'CLIENT_CLASS': 'backend.cache_metrics.InstrumentedClient'},
+            }},
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.addCleanup(lambda: caches['default'].clear())
+
+    def test_cache_on_every_slot(self):
+        data = {f'key_{i}': i for i in range(50)}
+        caches['default'].set_many(data, timeout=60)
+        self.assertEqual(caches['default'].get_many(list(data)), data)
+        caches['default'].delete_many(list(data))
+        self.assertEqual(caches['default'].get_many(list(data)), {})
+
+    def test_scripts_on_hash_tagged_keys(self):
+        client = redis_connections.get_client('client')
+        self.assertIsInstance(client, RedisCluster)
+        keys = [f'test_cluster:a:{hash_tag(1)}', f'test_cluster:b:{hash_tag(1)}']
+        self.addCleanup(client.delete, *keys)
+        client.set(keys[0], 'a')
+        self.assertEqual(client.eval("return redis.call('RENAME', KEYS[1], KEYS[2])", 2, *keys), b'OK')
+        self.assertEqual(client.mget(keys), [None, b'a'])
+
+    def test_async_client(self):
+        async def run():
+            client = redis_connections.get_async_client('async')
+            await client.mset({f'test_cluster:async_{i}': i for i in range(10)})
+            values = await client.mget([f'test_cluster:async_{i}' for i in range(10)])
+            await client.delete(*(f'test_cluster:async_{i}' for i in range(10)))
+            await client.aclose()
+            return values
+
+        self.assertEqual(asyncio.run(run()), [str(i).encode() for i in range(10)])
+
+
+@skipUnless(os.environ.get('REDIS_TEST_SENTINELS'), 'needs REDIS_TEST_SENTINELS, see build_scripts/redis_test_topologies.sh')
+class RedisSentinelTests(TestCase):
+    """
+    Runs against local sentinels: REDIS_TEST_SENTINELS=127.0.0.1:26379,... watching REDIS_TEST_SENTINEL_MASTER
+    """
+
+    def setUp(self):
+        master = os.environ.get('REDIS_TEST_SENTINEL_MASTER', 'mymaster')
+        overrides = override_settings(
+            REDIS_MODE='sentinel',
+            REDIS_SENTINELS=_test_nodes('REDIS_TEST_SENTINELS'),
+            REDIS_URL=f'redis://{master}',
+            CACHES={'default': {
+                'BACKEND': 'backend.cache.PrefixedRedisCache',
+                'LOCATION': f'redis://{master}/0',
+                'KEY_PREFIX': 'test_sentinel',
+                'OPTIONS': {'CLIENT_CLASS': 'backend.cache_metrics.InstrumentedClient'},
+            }},
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def test_cache_and_client_on_the_master(self):
+        caches['default'].set('key', 'value', timeout=60)
+        self.addCleanup(caches['default'].delete, 'key')
+        self.assertEqual(caches['default'].get('key'), 'value')
+
+        client = redis_connections.get_client('client')
+        self.assertIsNotNone(client.get('test_sentinel:1:key'))
+        self.assertEqual(client.info('replication')['role'], 'master')
@@ -0,0 +1,172 @@
+import logging
+import math
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from ipware import get_client_ip
+from redis.exceptions import RedisError
+from rest_framework.throttling import BaseThrottle, SimpleRateThrottle
+
+from backend.cache import redis_client, async_redis_client
+from backend.redis_connections import redis_connections
+from core.ip_allowlist import IPAllowlist
+
+logger = logging.getLogger(__name__)
+
+"""
+Sliding window rate limiting on Redis.
+
+Every limited key is a sorted set of request timestamps. A single Lua script trims the
+expired entries of all the keys of a request, checks every limit and only records the
+request when all of them pass, so a request costs one round trip and concurrent requests
+can not go over a limit. Retry-After is computed from the entry that has to expire.
+
+On Redis Cluster a script only runs on the keys of one slot. The keys are grouped by hash tag
+and checked one group per call, in the get_limits order, stopping at the first rejection: a
+request rejected by a later group is still recorded in the earlier ones.
+"""
+
+# KEYS: the limited keys, ARGV[1]: request id, then (limit, window in ms) for each key
+# Returns 0 when the request is allowed, else the milliseconds until it would be
+SLIDING_WINDOW_SCRIPT = """
+if redis.replicate_commands then redis.replicate_commands() end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local limit = tonumber(ARGV[i * 2])
+    local window = tonumber(ARGV[i * 2 + 1])
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+    local count = redis.call('ZCARD', key)
+    if count >= limit then
+        local oldest = redis.call('ZRANGE', key, count - limit, count - limit, 'WITHSCORES')
+        wait = math.max(wait, tonumber(oldest[2]) + window - now)
+    end
+end
+if wait > 0 then
+    return wait
+end
+for i, key in ipairs(KEYS) do
+    redis.call('ZADD', key, now, now .. '-' .. ARGV[1])
+    redis.call('PEXPIRE', key, tonumber(ARGV[i * 2 + 1]))
+end
+return 0
+"""
+
+throttle_exempt_allowlist = IPAllowlist('throttle_exempt', setting='THROTTLE_EXEMPT_NETWORKS')
+
+sliding_window_script = redis_client.register_script(SLIDING_WINDOW_SCRIPT)
+async_sliding_window_script = async_redis_client.register_script(SLIDING_WINDOW_SCRIPT)
+
+
+def key_hash_tag(key: str) -> str:
+    """
+    The part of the key Redis Cluster hashes: the first {tag} when it is not empty, else the whole key
+    """
+    start = key.find('{')
+    end = key.find('}', start + 1) if start != -1 else -1
+    return key[start + 1:end] if end > start + 1 else key
+
+
+def parse_rate(rate: str) -> tuple[int, int]:
+    """
+    '5/minute' -> (5, 60000), the window is in milliseconds
+    """
+    num_requests, duration = SimpleRateThrottle.parse_rate(None, rate)
+    return num_requests, duration * 1000
+
+
+class SlidingWindowThrottle(BaseThrottle):
+    """
+    Base sliding window throttle, subclasses return the keys and rates to check in get_limits
+    """
+    key_prefix = 'throttle'
+
+    def __init__(self):
+        self.wait_ms = 0
+
+    def get_limits(self, request, view) -> dict[str, str]:
+        """
+        {key: rate}, keys with the same hash tag are checked together on Redis Cluster
+        """
+        raise NotImplementedError
+
+    def is_exempt(self, request) -> bool:
+        return get_client_ip(request)[0] in throttle_exempt_allowlist
+
+    def script_args(self, limits: dict[str, str]) -> tuple[list[str], list]:
+        keys = []
+        args = [uuid.uuid4().hex]
+        for key, rate in limits.items():
+            keys.append(f'{self.key_prefix}:{key}')
+            args.extend(parse_rate(rate))
+        return keys, args
+
+    def script_calls(self, limits: dict[str, str]) -> list[tuple[list[str], list]]:
+        if redis_connections.mode() != 'cluster':
+            return [self.script_args(limits)]
+
+        groups = {}
+        for key, rate in limits.items():
+            groups.setdefault(key_hash_tag(key), {})[key] = rate
+        return [self.script_args(group) for group in groups.values()]
+
+    def allow_request(self, request, view):
+        if self.is_exempt(request):
+            return True
+        limits = self.get_limits(request, view)
+        if not limits:
+            return True
+
+        try:
+            for keys, args in self.script_calls(limits):
+                self.wait_ms = sliding_window_script(keys=keys, args=args)
+                if self.wait_ms:
+                    return False
+        except RedisError:
+            # NOTE fail open, an unavailable Redis must not lock everybody out
+            logger.exception('[Throttle] Redis error, request allowed')
+            return True
+        return True
+
+    async def aallow_request(self, request, view) -> bool:
+        if throttle_exempt_allowlist.needs_refresh():
+            await sync_to_async(throttle_exempt_allowlist.get_trie, thread_sensitive=False)()
+        if self.is_exempt(request):
+            return True
+        limits = self.get_limits(request, view)
+        if not limits:
+            return True
+
+        try:
+            for keys, args in self.script_calls(limits):
+                self.wait_ms = await async_sliding_window_script(keys=keys, args=args, client=async_redis_client.client())
+                if self.wait_ms:
+                    return False
+        except RedisError:
+            logger.exception('[Throttle] Redis error, request allowed')
+            return True
+        return True
+
+    def wait(self):
+        return math.ceil(self.wait_ms / 1000) if self.wait_ms else None
+
+
+class ScopedSlidingWindowThrottle(SlidingWindowThrottle):
+    """
+    Same rules as rest_framework ScopedRateThrottle (view.throttle_scope, REST_FRAMEWORK.DEFAULT_THROTTLE_RATES,
+    by user or by IP), on the sliding window script
+    """
+
+    def get_limits(self, request, view):
+        scope = getattr(view, 'throttle_scope', None)
+        rate = settings.REST_FRAMEWORK.get('DEFAULT_THROTTLE_RATES', {}).get(scope) if scope else None
+        if not rate:
+            return {}
+
+        if request.user and request.user.is_authenticated:
+            ident = f'user:{request.user.pk}'
+        else:
+            ident = f'ip:{get_client_ip(request)[0]}'
+        return {f'{{{scope}}}:{ident}': rate}
@@ -1,3 +1,52 @@
-from django.shortcuts import render
+import hmac
 
-# Create your views here.
+from django.conf import settings
+from django.http import HttpResponse
+from rest_framework.permissions import BasePermission, IsAdminUser
+from rest_framework.views import APIView
+
+from backend.cache_metrics import cache_metrics, prometheus_text
+from backend.near_cache import near_cache_prometheus_text, near_cache_stats
+from backend.redis_connections import pools_prometheus_text, redis_connections
+
+
+class HasMetricsToken(BasePermission):
+    """
+    `Authorization: Metrics <CACHE_METRICS_TOKEN>`, for scrapers that can not log in.
+    NOTE not Bearer, JWTAuthentication would reject it before the permissions are checked
+    """
+
+    def has_permission(self, request, view):
+        token = settings.CACHE_METRICS_TOKEN
+        header = request.headers.get('Authorization', '')
+        return bool(token) and hmac.compare_digest(header.encode(), f'Metrics {token}'.encode())
+
+
+class CacheMetricsView(APIView):
+    """
+    Per-namespace cache metrics of every process in the Prometheus text format
+    """
+    permission_classes = (HasMetricsToken | IsAdminUser,)
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(prometheus_text(cache_metrics.collect()), content_type='text/plain; version=0.0.4')
+
+
+class RedisPoolMetricsView(APIView):
+    """
+    Redis connection pools of the process serving the request in the Prometheus text format
+    """
+    permission_classes = (HasMetricsToken | IsAdminUser,)
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(pools_prometheus_text(redis_connections.stats()), content_type='text/plain; version=0.0.4')
+
+
+class NearCacheMetricsView(APIView):
+    """
+    Local and remote hits of the near caches of the process serving the request in the Prometheus text format
+    """
+    permission_classes = (HasMetricsToken | IsAdminUser,)
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(near_cache_prometheus_text(near_cache_stats()), content_type='text/plain; version=0.0.4')
@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.utils.html import format_html
 
-from .models import Profile, LoginHistory
+from .models import Profile, LoginHistory, KnownLoginIP
 
 
 @admin.register(Profile)
@@ -26,3 +26,10 @@ class LoginHistoryAdmin(admin.ModelAdmin):
     readonly_fields = ('user', 'ip', 'user_agent', 'timestamp')
     ordering = ('-timestamp',)
 
+
+@admin.register(KnownLoginIP)
+class KnownLoginIPAdmin(admin.ModelAdmin):
+    list_display = ('user', 'ip', 'created')
+    search_fields = ('user__email', 'user__username', 'ip')
+    readonly_fields = ('user', 'ip', 'created', 'updated')
+    ordering = ('-created',)
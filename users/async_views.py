@@ -0,0 +1,251 @@
+import json
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import alogin, get_user_model
+from django.core import signing
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Model
+from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.decorators import method_decorator
+from django.utils.translation import gettext_lazy as _, activate as translation_activate, get_language as translation_get_language
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.debug import sensitive_post_parameters
+from allauth.account import app_settings as allauth_account_settings
+from allauth.account.models import EmailAddress, EmailConfirmation, EmailConfirmationHMAC
+from dj_rest_auth.app_settings import api_settings as rest_auth_settings
+from dj_rest_auth.jwt_auth import set_jwt_access_cookie, set_jwt_cookies, set_jwt_refresh_cookie
+from dj_rest_auth.utils import jwt_encode
+from rest_framework import status
+from rest_framework.exceptions import APIException, AuthenticationFailed, Throttled, ValidationError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.serializers import as_serializer_error
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from users.auth.lookups import email_addresses_by_email
+from users.cache_keys import RESEND_VERIFICATION_IN_PROGRESS, RESEND_VERIFICATION_TOKEN
+from users.serializers.auth import LoginSerializer
+from users.throttling import AuthEndpointThrottle
+
+logger = logging.getLogger(__name__)
+
+User: Model = get_user_model()
+
+"""
+Async versions of the auth endpoints, enabled with settings.AUTH_ASYNC_VIEWS.
+
+DRF views are sync only, so these are plain Django views that keep the same urls, payloads,
+responses and auth throttles as the dj-rest-auth / users.views ones. Postgres and Redis are awaited with the
+async ORM and backend.cache.AsyncCache, password hashing runs on users.auth.hashing.hashing_pool
+and only allauth email confirmation/sending still runs in a thread.
+"""
+
+
+def json_response(data, status_code=status.HTTP_200_OK) -> HttpResponse:
+    return HttpResponse(JSONRenderer().render(data), status=status_code, content_type='application/json')
+
+
+class AsyncAPIView(View):
+    """
+    Parses the JSON body and turns DRF / Django validation errors into the same responses DRF returns
+    """
+    http_method_names = ['post', 'options']
+
+    @method_decorator(csrf_exempt)
+    def dispatch(self, request, *args, **kwargs):
+        return super().dispatch(request, *args, **kwargs)
+
+    async def post(self, request, *args, **kwargs):
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return json_response({'detail': _('JSON parse error.')}, status.HTTP_400_BAD_REQUEST)
+        if not isinstance(data, dict):
+            return json_response({'detail': _('Invalid data.')}, status.HTTP_400_BAD_REQUEST)
+
+        self.data = data
+        try:
+            await self.check_throttles(request)
+            return await self.handle(request, data)
+        except (ValidationError, DjangoValidationError) as exc:
+            return json_response(as_serializer_error(exc), status.HTTP_400_BAD_REQUEST)
+        except APIException as exc:
+            detail = exc.detail if isinstance(exc.detail, (list, dict)) else {'detail': exc.detail}
+            response = json_response(detail, exc.status_code)
+            if getattr(exc, 'wait', None):
+                response['Retry-After'] = str(int(exc.wait))
+            return response
+
+    async def check_throttles(self, request) -> None:
+        # NOTE same limits as the DRF views, settings.AUTH_THROTTLE_RATES by url name
+        throttle = AuthEndpointThrottle()
+        if not await throttle.aallow_request(request, self):
+            raise Throttled(throttle.wait())
+
+    async def handle(self, request, data: dict) -> HttpResponse:
+        raise NotImplementedError
+
+
+@method_decorator(sensitive_post_parameters('password'), name='dispatch')
+class AsyncLoginView(AsyncAPIView):
+    """
+    Same as dj_rest_auth LoginView with settings.REST_AUTH.LOGIN_SERIALIZER, USE_JWT and JWT_AUTH_RETURN_EXPIRATION
+    """
+
+    async def handle(self, request, data):
+        serializer = LoginSerializer(data=data, context={'request': request})
+        attrs = await serializer.avalidate(serializer.to_internal_value(data))
+        user = attrs['user']
+
+        access_token, refresh_token = jwt_encode(user)
+        if rest_auth_settings.SESSION_LOGIN:
+            await alogin(request, user)
+
+        response_data = {
+            'user': user,
+            'access': access_token,
+            'refresh': '' if rest_auth_settings.JWT_AUTH_HTTPONLY else refresh_token,
+            'access_expiration': timezone.now() + jwt_settings.ACCESS_TOKEN_LIFETIME,
+            'refresh_expiration': timezone.now() + jwt_settings.REFRESH_TOKEN_LIFETIME,
+        }
+        # NOTE the user profile was loaded with select_related, serializing does not query
+        response_serializer = rest_auth_settings.JWT_SERIALIZER_WITH_EXPIRATION(
+            instance=response_data,
+            context={'request': request},
+        )
+        response = json_response(response_serializer.data)
+        set_jwt_cookies(response, access_token, refresh_token)
+        return response
+
+
+class AsyncTokenRefreshView(AsyncAPIView):
+    """
+    Same as dj_rest_auth get_refresh_view(), the refresh token comes from the body or the refresh cookie
+    """
+
+    async def handle(self, request, data):
+        raw_token = data.get('refresh') or request.COOKIES.get(rest_auth_settings.JWT_AUTH_REFRESH_COOKIE)
+        if not raw_token:
+            raise InvalidToken(_('No valid refresh token found.'))
+
+        try:
+            refresh = RefreshToken(raw_token)
+        except TokenError as e:
+            raise InvalidToken(e.args[0])
+
+        user_id = refresh.payload.get(jwt_settings.USER_ID_CLAIM, None)
+        if user_id:
+            user = await User.objects.filter(**{jwt_settings.USER_ID_FIELD: user_id}).afirst()
+            if not user or not jwt_settings.USER_AUTHENTICATION_RULE(user):
+                raise AuthenticationFailed(_('No active account found for the given token.'), 'no_active_account')
+
+        response_data = {
+            'access': str(refresh.access_token),
+            'access_expiration': timezone.now() + jwt_settings.ACCESS_TOKEN_LIFETIME,
+        }
+        if jwt_settings.ROTATE_REFRESH_TOKENS:
+            # NOTE the blacklist app is not installed, so rotating does not touch the database
+            refresh.set_jti()
+            refresh.set_exp()
+            refresh.set_iat()
+            if not rest_auth_settings.JWT_AUTH_HTTPONLY:
+                response_data['refresh'] = str(refresh)
+                response_data['refresh_expiration'] = timezone.now() + jwt_settings.REFRESH_TOKEN_LIFETIME
+
+        response = json_response(response_data)
+        set_jwt_access_cookie(response, response_data['access'])
+        if jwt_settings.ROTATE_REFRESH_TOKENS:
+            set_jwt_refresh_cookie(response, str(refresh))
+        return response
+
+
+class AsyncVerifyEmailView(AsyncAPIView):
+    """
+    Same as users.views.CustomVerifyEmailView
+    """
+
+    @staticmethod
+    async def get_confirmation(key: str) -> EmailConfirmation | EmailConfirmationHMAC | None:
+        """
+        Same lookup as allauth get_emailconfirmation_model().from_key(key), with the async ORM
+        """
+        if allauth_account_settings.EMAIL_CONFIRMATION_HMAC:
+            try:
+                max_age = 60 * 60 * 24 * allauth_account_settings.EMAIL_CONFIRMATION_EXPIRE_DAYS
+                pk = signing.loads(key, max_age=max_age, salt=allauth_account_settings.SALT)
+            except signing.BadSignature:
+                return None
+            email_address = await EmailAddress.objects.select_related('user').filter(pk=pk, verified=False).afirst()
+            return EmailConfirmationHMAC(email_address) if email_address else None
+
+        return await EmailConfirmation.objects.all_valid().select_related('email_address__user').filter(key=key.lower()).afirst()
+
+    async def handle(self, request, data):
+        key = data.get('key')
+        if not key:
+            raise ValidationError({'key': [_('This field is required.')]})
+
+        confirmation = await self.get_confirmation(key)
+        if not confirmation:
+            return json_response({'detail': _('Invalid confirmation key.')}, status.HTTP_404_NOT_FOUND)
+
+        # NOTE allauth confirms the address and sends its signals synchronously
+        await sync_to_async(confirmation.confirm)(request)
+
+        user = confirmation.email_address.user
+        if not user.is_active:
+            return json_response({'detail': _('User account is inactive.')}, status.HTTP_400_BAD_REQUEST)
+
+        refresh = RefreshToken.for_user(user)
+        return json_response({
+            'detail': _('Email verified successfully. You are now logged in.'),
+            'access_token': str(refresh.access_token),
+            'refresh_token': str(refresh),
+        })
+
+
+class AsyncResendEmailConfirmationView(AsyncAPIView):
+    """
+    Same as users.views.ResendEmailConfirmationView
+    """
+
+    async def handle(self, request, data):
+        token = data.get('token')
+        if not token:
+            return json_response({'Status': False, 'code': 'Token not found'}, status.HTTP_400_BAD_REQUEST)
+
+        user_id = await RESEND_VERIFICATION_TOKEN.aget(token)
+        if not user_id:
+            return json_response({'Status': False, 'code': 'Token not found'}, status.HTTP_400_BAD_REQUEST)
+
+        # check if verification email in progress
+        verification_in_progress = await RESEND_VERIFICATION_IN_PROGRESS.aget(user_id)
+        if verification_in_progress:
+            return json_response({'Status': False, 'code': 'Email confirmation in progress'}, status.HTTP_400_BAD_REQUEST)
+
+        lang = data.get('lang', 'en')
+        if lang not in dict(settings.LANGUAGES):
+            return json_response({'result': f'Lang {lang} not found'}, status.HTTP_400_BAD_REQUEST)
+
+        translation_activate(lang)
+        setattr(request, 'LANGUAGE_CODE', translation_get_language())
+
+        user = await User.objects.aget(id=user_id)
+        email_address: EmailAddress = await email_addresses_by_email(
+            user.email,
+            EmailAddress.objects.filter(user=user),
+        ).aget()
+        if email_address.verified:
+            return json_response({'Status': False, 'code': 'Email already verified'}, status.HTTP_400_BAD_REQUEST)
+        logger.info(f"Sending email confirmation to {user.email}")
+        # NOTE allauth stores the confirmation with the sync ORM, the email itself is sent by a worker
+        await sync_to_async(email_address.send_confirmation)(request)
+
+        # set verification in progress by user id
+        await RESEND_VERIFICATION_IN_PROGRESS.aset(user_id, 1)
+        return json_response({'Status': True})
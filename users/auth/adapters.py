@@ -1,15 +1,31 @@
+from typing import cast
+
+from celery import Task
+from django.contrib.auth import get_user_model
+from django.contrib.sites.models import Site
+from django.contrib.sites.shortcuts import get_current_site
+from django.db import transaction
 from django.utils import translation
+from django.utils.encoding import force_str
+from allauth.account import app_settings as allauth_account_settings
 from allauth.account.adapter import DefaultAccountAdapter
-from allauth.account.models import EmailAddress
 from rest_framework.exceptions import ValidationError
 
+from users import bloom
+from users.auth.lookups import email_addresses_by_email
+from users.tasks import send_account_email
 from utils.generic_functions import get_rand_code
 
+User = get_user_model()
+
 
 class AccountAdapter(DefaultAccountAdapter):
+    # Set by send_mail_now, the worker has no request to find the site from
+    site: Site | None = None
 
     def validate_unique_email(self, email):
-        if EmailAddress.objects.filter(email=email).exists():
+        # NOTE most emails are new, the Bloom filter answers those without a query
+        if bloom.email_may_exist(email) and email_addresses_by_email(email).exists():
             raise ValidationError({
                 'type': 'wrong_data'
             })
@@ -23,8 +39,40 @@ class AccountAdapter(DefaultAccountAdapter):
         else:
             return "en"
 
+    def send_mail(self, template_prefix, email, context):
+        """
+        Queues allauth emails (confirmation, password reset) with primitive data only: the user id,
+        the site id, the language and the strings of the context (key, activate/reset URL...).
+        users.tasks.send_account_email renders and sends them in a worker, so the request does not
+        wait for SMTP and an SMTP outage does not fail it
+        """
+        user = context.get('user')
+        site = context.get('current_site') or get_current_site(self.request)
+        data = {
+            name: value for name, value in context.items()
+            if isinstance(value, (str, int, float, bool)) and name != 'email'
+        }
+        data.update(user_id=user.pk if user is not None else None, site_id=site.pk)
+        args = (template_prefix, email, data, self.__get_lang())
+        # NOTE after the commit, the worker must find the user and the confirmation key
+        transaction.on_commit(lambda: cast(Task, send_account_email).apply_async(args))
+
+    def send_mail_now(self, template_prefix: str, email: str, data: dict, lang: str) -> None:
+        data = dict(data)
+        user_id = data.pop('user_id', None)
+        self.site = Site.objects.get(pk=data.pop('site_id'))
+        context = {'email': email, 'current_site': self.site, 'lang': lang, **data}
+        if user_id is not None:
+            context['user'] = User.objects.get(pk=user_id)
+        self.render_mail(template_prefix, email, context).send()
+
+    def format_email_subject(self, subject) -> str:
+        if allauth_account_settings.EMAIL_SUBJECT_PREFIX is None and self.site is not None:
+            return f'[{self.site.name}] {force_str(subject)}'
+        return super().format_email_subject(subject)
+
     def render_mail(self, template_prefix, email, context, headers=None):
-        lang = self.__get_lang()
+        lang = context.get("lang") or self.__get_lang()
         context.update({"lang": lang})
         with translation.override(lang):
             return super().render_mail(template_prefix, email, context, headers)
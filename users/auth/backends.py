@@ -2,6 +2,9 @@ import logging
 from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import ModelBackend
 
+from users.auth.hashing import hashing_pool, check_user_password, acheck_user_password
+from users.auth.lookups import users_by_email
+
 User = get_user_model()
 logger = logging.getLogger(__name__)
 
@@ -17,19 +20,36 @@ class CaseInsensitiveModelBackend(ModelBackend):
     """
     Backend that authenticates users with case-insensitive email.
     """
-    def authenticate(self, request, email=None, password=None, **kwargs):
-        if email is None:
-            # Try to get email, or fall back to username if email isn't provided
-            email = kwargs.get(User.EMAIL_FIELD) or kwargs.get('username')
-            logger.debug(f"Attempting authentication with: {email}")
-        try:
-            user = User.objects.get(email__iexact=email)
-        except User.DoesNotExist:
-            # Hash the password even for non-existent users to prevent timing attacks
-            # that could reveal whether a email exists in the database
-            User().set_password(password)
-        else:
-            if user.check_password(password) and self.user_can_authenticate(user):
-                return user
+    def authenticate(self, request, email=None, password=None, user=None, **kwargs):
+        """
+        ``user`` can be passed by callers that already loaded the account (e.g. LoginSerializer)
+        so it is not fetched from the database again.
+        """
+        if user is None:
+            if email is None:
+                # Try to get email, or fall back to username if email isn't provided
+                email = kwargs.get(User.EMAIL_FIELD) or kwargs.get('username')
+                logger.debug(f"Attempting authentication with: {email}")
+            try:
+                user = users_by_email(email).get()
+            except User.DoesNotExist:
+                # Check the password even for non-existent users to prevent timing attacks
+                # that could reveal whether a email exists in the database
+                hashing_pool.check_dummy(password)
+                return None
+
+        if check_user_password(user, password) and self.user_can_authenticate(user):
+            return user
 
+    async def aauthenticate(self, request, email=None, password=None, user=None, **kwargs):
+        if user is None:
+            if email is None:
+                email = kwargs.get(User.EMAIL_FIELD) or kwargs.get('username')
+            try:
+                user = await users_by_email(email).aget()
+            except User.DoesNotExist:
+                await hashing_pool.acheck_dummy(password)
+                return None
 
+        if await acheck_user_password(user, password) and self.user_can_authenticate(user):
+            return user
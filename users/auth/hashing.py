@@ -0,0 +1,162 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password, verify_password
+from django.utils.crypto import get_random_string
+
+from users.exceptions import PasswordHashingBusy
+
+"""
+Password hashing runs on a bounded thread pool.
+
+Hashing is CPU bound (hashlib releases the GIL), so the pool caps how many hashes run at the
+same time. A flood of logins waits in the pool queue instead of taking every core from the
+rest of the requests, up to queue_size of them: past that PasswordHashingBusy (503) is raised
+right away, before the login would wait longer than a client does.
+"""
+
+
+class PasswordHashingPool:
+
+    def __init__(self, max_workers: int, queue_size: int):
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='password-hashing')
+        self._lock = threading.Lock()
+        self._dummy_hash = None
+        self._stats = {
+            'calls': 0,
+            'in_flight': 0,
+            'rejected': 0,
+            'hash_seconds_total': 0.0,
+            'hash_seconds_max': 0.0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0,
+        }
+
+    def _timed(self, submitted_at: float, func, *args):
+        started_at = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            finished_at = time.perf_counter()
+            self._record(started_at - submitted_at, finished_at - started_at)
+
+    def _record(self, wait: float, duration: float) -> None:
+        with self._lock:
+            stats = self._stats
+            stats['calls'] += 1
+            stats['in_flight'] -= 1
+            stats['wait_seconds_total'] += wait
+            stats['wait_seconds_max'] = max(stats['wait_seconds_max'], wait)
+            stats['hash_seconds_total'] += duration
+            stats['hash_seconds_max'] = max(stats['hash_seconds_max'], duration)
+
+    def submit(self, func, *args):
+        with self._lock:
+            if self._stats['in_flight'] >= self.max_workers + self.queue_size:
+                self._stats['rejected'] += 1
+                raise PasswordHashingBusy()
+            self._stats['in_flight'] += 1
+        return self._executor.submit(self._timed, time.perf_counter(), func, *args)
+
+    def encode(self, password: str) -> str:
+        return self.submit(make_password, password).result()
+
+    async def aencode(self, password: str) -> str:
+        return await asyncio.wrap_future(self.submit(make_password, password))
+
+    def verify(self, password: str, encoded: str) -> tuple[bool, bool]:
+        """
+        Returns (is_correct, must_update) like django.contrib.auth.hashers.verify_password
+        """
+        return self.submit(verify_password, password, encoded).result()
+
+    async def averify(self, password: str, encoded: str) -> tuple[bool, bool]:
+        return await asyncio.wrap_future(self.submit(verify_password, password, encoded))
+
+    def get_dummy_hash(self) -> str:
+        """
+        Hash of a random password, computed once per process
+        """
+        if self._dummy_hash is None:
+            with self._lock:
+                if self._dummy_hash is None:
+                    self._dummy_hash = make_password(get_random_string(32))
+        return self._dummy_hash
+
+    def check_dummy(self, password: str) -> None:
+        """
+        Takes as long as checking a real password, used when the user does not exist
+        """
+        self.verify(password, self.get_dummy_hash())
+
+    async def acheck_dummy(self, password: str) -> None:
+        await self.averify(password, self.get_dummy_hash())
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        calls = stats['calls'] or 1
+        stats['max_workers'] = self.max_workers
+        stats['queue_size'] = self.queue_size
+        stats['hash_seconds_avg'] = stats['hash_seconds_total'] / calls
+        stats['wait_seconds_avg'] = stats['wait_seconds_total'] / calls
+        return stats
+
+    def prometheus_text(self) -> str:
+        """
+        stats() in the Prometheus text format, they are per process
+        """
+        stats = self.stats()
+        return '\n'.join([
+            '# TYPE password_hashing_workers gauge',
+            f'password_hashing_workers {stats["max_workers"]}',
+            '# TYPE password_hashing_queue_size gauge',
+            f'password_hashing_queue_size {stats["queue_size"]}',
+            '# TYPE password_hashing_in_flight gauge',
+            f'password_hashing_in_flight {stats["in_flight"]}',
+            '# TYPE password_hashing_calls_total counter',
+            f'password_hashing_calls_total {stats["calls"]}',
+            '# TYPE password_hashing_rejected_total counter',
+            f'password_hashing_rejected_total {stats["rejected"]}',
+            '# TYPE password_hashing_seconds_total counter',
+            f'password_hashing_seconds_total {stats["hash_seconds_total"]}',
+            '# TYPE password_hashing_wait_seconds_total counter',
+            f'password_hashing_wait_seconds_total {stats["wait_seconds_total"]}',
+            '# TYPE password_hashing_wait_seconds_max gauge',
+            f'password_hashing_wait_seconds_max {stats["wait_seconds_max"]}',
+        ]) + '\n'
+
+
+hashing_pool = PasswordHashingPool(settings.PASSWORD_HASHING_WORKERS, settings.PASSWORD_HASHING_QUEUE_SIZE)
+
+
+def check_user_password(user, password: str) -> bool:
+    """
+    Same as user.check_password, but hashing runs on the pool, the hash upgrade too.
+    The upgrade is saved from the calling thread so it uses the request DB connection.
+    """
+    is_correct, must_update = hashing_pool.verify(password, user.password)
+    if is_correct and must_update:
+        try:
+            user.password = hashing_pool.encode(password)
+        except PasswordHashingBusy:
+            # NOTE the password was right, the upgrade waits for the next login
+            return is_correct
+        user.save(update_fields=['password'])
+    return is_correct
+
+
+async def acheck_user_password(user, password: str) -> bool:
+    is_correct, must_update = await hashing_pool.averify(password, user.password)
+    if is_correct and must_update:
+        try:
+            user.password = await hashing_pool.aencode(password)
+        except PasswordHashingBusy:
+            return is_correct
+        await user.asave(update_fields=['password'])
+    return is_correct
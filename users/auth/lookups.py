@@ -0,0 +1,46 @@
+from django.contrib.auth import get_user_model
+from django.db.models import QuerySet
+from django.db.models.functions import Lower
+from allauth.account.models import EmailAddress
+
+User = get_user_model()
+
+"""
+Case-insensitive user lookups shared by every auth path.
+
+On PostgreSQL email__iexact compiles to UPPER(email) = UPPER(%s), which no index serves.
+These helpers filter on LOWER(email) / LOWER(username), the expressions indexed by
+migration 0004_user_lower_indexes, so the lookups are index scans whatever the case.
+
+allauth stores EmailAddress.email lowercased, so it is matched exactly on the normalized email.
+"""
+
+
+def normalize_email(email: str) -> str:
+    return email.strip().lower()
+
+
+def users_by_email(email: str, queryset: QuerySet | None = None) -> QuerySet:
+    if queryset is None:
+        queryset = User.objects.all()
+    return queryset.alias(email_lower=Lower('email')).filter(email_lower=normalize_email(email))
+
+
+def users_by_username(username: str, queryset: QuerySet | None = None) -> QuerySet:
+    if queryset is None:
+        queryset = User.objects.all()
+    return queryset.alias(username_lower=Lower('username')).filter(username_lower=username.strip().lower())
+
+
+def users_by_usernames(usernames, queryset: QuerySet | None = None) -> QuerySet:
+    if queryset is None:
+        queryset = User.objects.all()
+    return queryset.alias(username_lower=Lower('username')).filter(
+        username_lower__in={username.strip().lower() for username in usernames},
+    )
+
+
+def email_addresses_by_email(email: str, queryset: QuerySet | None = None) -> QuerySet:
+    if queryset is None:
+        queryset = EmailAddress.objects.all()
+    return queryset.filter(email=normalize_email(email))
@@ -0,0 +1,105 @@
+import logging
+
+from allauth.account.models import EmailAddress
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from redis.exceptions import RedisError
+
+from backend.bloom import RedisBloomFilter
+from backend.cache import redis_client
+from users.auth.lookups import normalize_email
+from users.cache_keys import USER_BLOOM_KEY
+
+logger = logging.getLogger(__name__)
+
+User = get_user_model()
+
+"""
+Bloom filter of the existing usernames and emails (users and allauth EmailAddress rows).
+
+Registration asks it before the database: when it answers no, nobody has that username/email and
+the query is skipped, only possible positives are queried. It answers "maybe" for everything while
+it is not built, when settings.USER_BLOOM_ENABLED is off or when Redis fails.
+
+users.signals adds every new user and email address. Run the rebuild_user_bloom command once after
+deploying, after a Redis data loss and after imports that skip signals (bulk_create, raw SQL):
+a user missing from the filter would pass the duplicate checks.
+"""
+
+user_bloom = RedisBloomFilter(
+    redis_client, USER_BLOOM_KEY, settings.USER_BLOOM_CAPACITY, settings.USER_BLOOM_ERROR_RATE,
+)
+
+
+def username_item(username: str) -> str:
+    return f'u:{username.strip().lower()}'
+
+
+def email_item(email: str) -> str:
+    return f'e:{normalize_email(email)}'
+
+
+def add_user(user) -> None:
+    items = [username_item(user.username)]
+    if user.email:
+        items.append(email_item(user.email))
+    _add(items)
+
+
+def add_email(email: str) -> None:
+    _add([email_item(email)])
+
+
+def _add(items: list[str]) -> None:
+    if not settings.USER_BLOOM_ENABLED:
+        return
+    try:
+        user_bloom.add_many(items)
+    except RedisError as e:
+        logger.error(f'[User bloom] could not add {items}, run rebuild_user_bloom: {e!r}')
+
+
+def usernames_may_exist(usernames: list[str]) -> list[bool]:
+    return _may_contain([username_item(username) for username in usernames])
+
+
+def email_may_exist(email: str) -> bool:
+    return _may_contain([email_item(email)])[0]
+
+
+def _may_contain(items: list[str]) -> list[bool]:
+    if not settings.USER_BLOOM_ENABLED:
+        return [True] * len(items)
+    try:
+        return user_bloom.may_contain_many(items)
+    except RedisError as e:
+        logger.warning(f'[User bloom] check failed, using the database: {e!r}')
+        return [True] * len(items)
+
+
+def _items(last_user_pk: int, last_address_pk: int, users=None, addresses=None):
+    users = User.objects.filter(pk__lte=last_user_pk) if users is None else users
+    addresses = EmailAddress.objects.filter(pk__lte=last_address_pk) if addresses is None else addresses
+    for username, email in users.values_list('username', 'email').iterator(chunk_size=5000):
+        yield username_item(username)
+        if email:
+            yield email_item(email)
+    for email in addresses.values_list('email', flat=True).iterator(chunk_size=5000):
+        yield email_item(email)
+
+
+def rebuild_user_bloom() -> int:
+    """
+    Builds the filter from the database, returns the number of items
+    """
+    last_user_pk = User.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+    last_address_pk = EmailAddress.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+    count = user_bloom.build(_items(last_user_pk, last_address_pk))
+
+    # NOTE rows created while building went to the replaced bitmap
+    _add(list(_items(
+        last_user_pk, last_address_pk,
+        users=User.objects.filter(pk__gt=last_user_pk),
+        addresses=EmailAddress.objects.filter(pk__gt=last_address_pk),
+    )))
+    return count
@@ -1,17 +1,66 @@
 # Cache keys for accounts app
+from django.conf import settings
+
+from backend.cache import CacheKey
 
-# Used for two purposes:
-# 1. Maps verification tokens to user IDs in auth.py with 30-minute timeout (1800 seconds)
-#    Format: RESEND_VERIFICATION_TOKEN_CACHE_KEY + token = user_id
-# 2. Used as a flag in ResendEmailConfirmationView to prevent sending multiple verification emails
-#    Format: RESEND_VERIFICATION_TOKEN_CACHE_KEY + user_id = 1 (with 5-minute timeout/300 seconds)
-#    This acts as a rate limiter to prevent multiple email requests within 5 minutes
 RESEND_VERIFICATION_TOKEN_CACHE_KEY = 'resend_verification_token_'
+RESEND_VERIFICATION_TOKEN_REVERSED_CACHE_KEY = 'resend_verification_token_reversed_'
+RESEND_VERIFICATION_IN_PROGRESS_CACHE_KEY = 'resend_verification_in_progress_'
+
+# Maps verification tokens to user IDs in auth.py for 30 minutes
+# Format: RESEND_VERIFICATION_TOKEN_CACHE_KEY + token = user_id
+RESEND_VERIFICATION_TOKEN = CacheKey('resend_verification_token', RESEND_VERIFICATION_TOKEN_CACHE_KEY, timeout=30 * 60)
 
 # Maps user IDs back to their verification tokens in auth.py
 # Used when a user fails email verification to provide them with the same token
-# if they try again within 30 minutes (1800 seconds)
+# if they try again within 30 minutes, always written together with RESEND_VERIFICATION_TOKEN
 # Format: RESEND_VERIFICATION_TOKEN_REVERSED_CACHE_KEY + user_id = token
-RESEND_VERIFICATION_TOKEN_REVERSED_CACHE_KEY = 'resend_verification_token_reversed_'
+RESEND_VERIFICATION_TOKEN_REVERSED = CacheKey(
+    'resend_verification_token_reversed', RESEND_VERIFICATION_TOKEN_REVERSED_CACHE_KEY, timeout=30 * 60,
+)
+
+# Flag in ResendEmailConfirmationView to prevent sending multiple verification emails within 5 minutes
+# Format: RESEND_VERIFICATION_IN_PROGRESS_CACHE_KEY + user_id = 1
+RESEND_VERIFICATION_IN_PROGRESS = CacheKey(
+    'resend_verification_in_progress', RESEND_VERIFICATION_IN_PROGRESS_CACHE_KEY, timeout=5 * 60,
+)
+
+# Login attempts left without solving a captcha, in users/captcha.py. Stored as a raw integer so
+# Redis can DECR it. set_captcha_passed uses the family timeout, set_cache CAPTCHA_TIMEOUT
+# Format: 'passed:' + uid + ip = attempts left
+CAPTCHA_PASSED = CacheKey('captcha_passed', 'passed:', timeout=180)
+
+# Emails of the last RUC_COUNT_EMAILS registrations for users.utils.RegisterUserCheck, newest first.
+# Raw redis_client list, capped with LTRIM on every push
+RUC_EMAILS_KEY = 'ruc_emails'
+
+# Single-flight fill of RUC_EMAILS_KEY when it is missing (users.utils.recent_emails_fill), Django cache.
+# Only one process rebuilds the list from the users, the others wait for its result
+RUC_EMAILS_FILL_KEY = 'ruc_emails_fill'
+
+# Free generated usernames claimed by users.utils.generate_cool_username when every candidate is
+# taken, refilled by users.tasks.refill_username_pool. Raw redis_client set (SPOP is the atomic claim)
+USERNAME_POOL_KEY = 'username_pool'
+
+# Bloom filter of the existing usernames and emails (users/bloom.py), a hash tag so its bitmap and
+# ready marker ('{users_bloom}:bits', '{users_bloom}:ready') share a Redis Cluster slot
+USER_BLOOM_KEY = '{users_bloom}'
+
+# Parsed user agents in users/user_agent.py, only with settings.USER_AGENT_REDIS_CACHE
+# Format: USER_AGENT_CACHE_KEY + sha1(user agent) = [ua_string, device, os, browser, device_type, is_bot]
+USER_AGENT_CACHE_KEY = 'user_agent_'
+
+# Redis lists used by the LoginHistory write-behind buffer (users/login_history.py)
+# These are raw redis_client keys, they share a hash tag so the Lua script can move
+# events between them in Redis Cluster too
+LOGIN_HISTORY_BUFFER_KEY = '{login_history}:buffer'
+LOGIN_HISTORY_PROCESSING_KEY = '{login_history}:processing'
+LOGIN_HISTORY_FLUSH_LOCK_KEY = '{login_history}:flush_lock'
+# Events the database rejected (e.g. no partition for their month), kept for a manual replay
+LOGIN_HISTORY_DEAD_LETTER_KEY = '{login_history}:dead_letter'
 
-RUC_CACHE_KEY = 'ruc_emails'
+# Failed reCAPTCHA verifications in users/recaptcha.py, kept for RECAPTCHA_RESULT_CACHE_TIMEOUT.
+# Successes are not stored, a token is accepted once
+# Format: RECAPTCHA_RESULT_CACHE_KEY + sha256(token:ip) = False
+RECAPTCHA_RESULT_CACHE_KEY = 'recaptcha_result_'
+RECAPTCHA_RESULT = CacheKey('recaptcha_result', RECAPTCHA_RESULT_CACHE_KEY, timeout=settings.RECAPTCHA_RESULT_CACHE_TIMEOUT)
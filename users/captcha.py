@@ -1,15 +1,39 @@
-import re
-import requests
+import time
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.core.cache import cache
+from django_redis.cache import RedisCache
 from rest_framework.exceptions import ValidationError
 
+from backend.cache_metrics import record_call
+from core.ip_allowlist import IPAllowlist
+from users.cache_keys import CAPTCHA_PASSED
 from users.exceptions import MaxCaptchaSkipAttempts
+from users.recaptcha import recaptcha_verifier
+
+# Decrements the remaining attempts in KEYS[1], DECR keeps the TTL. The key is removed when
+# no attempts are left. Returns the remaining attempts, or nil when the key does not exist
+DECREASE_ATTEMPTS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+local remaining = redis.call('DECR', KEYS[1])
+if remaining <= 0 then
+    redis.call('DEL', KEYS[1])
+end
+return remaining
+"""
+
+captcha_allowlist = IPAllowlist('captcha_bypass', setting='CAPTCHA_ALLOWED_NETWORKS')
+
 
 class CaptchaProcessor:
+    """
+    Captcha state is one integer per (uid, ip): the login attempts left without solving a captcha.
+    Every state operation is a single atomic Redis command or script, so concurrent logins
+    can not skip the captcha more than MAX_ERROR_ATTEMPTS times.
+    """
     CAPTCHA_ENABLED = settings.CAPTCHA_ENABLED
-    PASSED_PREFIX = 'passed:'
     MAX_ERROR_ATTEMPTS = 6
     CACHE_TIMEOUT = settings.CAPTCHA_TIMEOUT
 
@@ -24,39 +48,83 @@ class CaptchaProcessor:
 
     @classmethod
     def cache_key(cls, value):
-        return f'{cls.PASSED_PREFIX}{value}'
+        return CAPTCHA_PASSED.key(value)
 
     @classmethod
     def get_cache(cls, key):
-        ckey = cls.cache_key(key)
-        data = cache.get(ckey)
-        return data
+        return CAPTCHA_PASSED.get(key)
 
     @classmethod
-    def get_cache_ttl(cls, key):
+    def decr_cache(cls, key) -> int | None:
+        """
+        Returns the attempts left after decrementing, or None if there was no captcha pass
+        """
         ckey = cls.cache_key(key)
-        return cache.ttl(ckey)
+        backend = CAPTCHA_PASSED.cache
+        if not isinstance(backend, RedisCache):
+            # NOTE other backends (e.g. locmem in tests) are not shared between processes
+            try:
+                remaining = backend.decr(ckey)
+            except ValueError:
+                return None
+            if remaining <= 0:
+                backend.delete(ckey)
+            return remaining
+
+        client = backend.client.get_client(write=True)
+        start = time.perf_counter()
+        remaining = client.eval(DECREASE_ATTEMPTS_SCRIPT, 1, backend.make_key(ckey))
+        record_call(backend, 'incr', [ckey], start, [remaining is not None])
+        return remaining
+
+    @classmethod
+    def add_cache(cls, key, timeout=None, data=None) -> bool:
+        """
+        Same as set_cache, but only if the key does not exist yet
+        """
+        if data is None:
+            data = cls.MAX_ERROR_ATTEMPTS
+        return CAPTCHA_PASSED.add(key, data, timeout or cls.CACHE_TIMEOUT)
 
     @classmethod
     def del_cache(cls, key):
-        ckey = cls.cache_key(key)
-        cache.delete(ckey)
+        CAPTCHA_PASSED.delete(key)
 
     @classmethod
     def set_cache(cls, key, timeout=None, data=None):
-        ckey = cls.cache_key(key)
         if data is None:
             data = cls.MAX_ERROR_ATTEMPTS
-        cache.set(ckey, data, timeout or cls.CACHE_TIMEOUT)
+        CAPTCHA_PASSED.set(key, data, timeout or cls.CACHE_TIMEOUT)
+
+    def is_ip_allowed(self):
+        return self.ip in captcha_allowlist
 
     def is_captcha_required(self):
-        if self.ip in ['127.0.0.1', 'localhost'] or (self.ip and re.match(settings.CAPTCHA_ALLOWED_IP_MASK, self.ip)):
+        if self.is_ip_allowed():
             return False
 
         if self.is_captcha_passed():
             return False
         return True
 
+    async def ais_captcha_required(self):
+        if captcha_allowlist.needs_refresh():
+            # NOTE compiling reads the cache and the database, not from the event loop
+            await sync_to_async(captcha_allowlist.get_trie, thread_sensitive=False)()
+        if self.is_ip_allowed():
+            return False
+
+        if await self.ais_captcha_passed():
+            return False
+        return True
+
+    def check_response_present(self):
+        if not self.captcha_response or self.captcha_response == '':
+            raise ValidationError({
+                'message': 'invalidate data',
+                'type': 'captcha_required'
+            })
+
     def check(self):
         if not self.CAPTCHA_ENABLED:
             return
@@ -65,48 +133,56 @@ class CaptchaProcessor:
             if not self.is_captcha_required():
                 return
 
-        if not self.captcha_response or self.captcha_response == '':
-            raise ValidationError({
-                'message': 'invalidate data',
-                'type': 'captcha_required'
-            })
+        self.check_response_present()
         try:
-            self._captcha_check(self.captcha_response)
+            self._captcha_check(self.captcha_response, remote_ip=self.ip)
         except Exception:
             self.del_captcha_pass()
             raise
 
+    async def acheck(self):
+        if not self.CAPTCHA_ENABLED:
+            return
+
+        if not self.skip_extra_checks:
+            if not await self.ais_captcha_required():
+                return
+
+        self.check_response_present()
+        try:
+            await recaptcha_verifier.averify(self.captcha_response, remote_ip=self.ip)
+        except Exception:
+            await self.adel_captcha_pass()
+            raise
+
 
     @classmethod
-    def _captcha_check(cls, response, secret=settings.RECAPTCHA_SECRET):
-        r = requests.post('https://www.google.com/recaptcha/api/siteverify',
-                          data={'secret': secret, 'response': response})
-        if not r.json()['success']:
-            raise ValidationError({
-                'message': 'bad captcha!',
-                'type': 'bad_captcha'
-            })
+    def _captcha_check(cls, response, secret=None, remote_ip=None):
+        recaptcha_verifier.verify(response, remote_ip=remote_ip, secret=secret)
 
     def decrease_attempts(self, custom_exception=None):
-        data = self.get_cache(self.get_ckey())
-        if data is not None:
-            ttl = self.get_cache_ttl(self.get_ckey())
-            data -= 1
-            if data <= 0:
-                self.del_captcha_pass()
-                if custom_exception:
-                    raise custom_exception()
-                raise MaxCaptchaSkipAttempts()
-            else:
-                self.set_cache(self.get_ckey(), data=data, timeout=ttl)
+        remaining = self.decr_cache(self.get_ckey())
+        if remaining is not None and remaining <= 0:
+            if custom_exception:
+                raise custom_exception()
+            raise MaxCaptchaSkipAttempts()
 
     def del_captcha_pass(self):
         self.del_cache(self.get_ckey())
 
     def set_captcha_passed(self):
-        if not self.is_captcha_passed():
-            self.set_cache(self.get_ckey(), timeout=180)
+        # NOTE add only writes the key if there is no captcha pass yet, in one round trip
+        CAPTCHA_PASSED.add(self.get_ckey(), self.MAX_ERROR_ATTEMPTS)
 
     def is_captcha_passed(self):
         return bool(self.get_cache(self.get_ckey()))
 
+    async def adel_captcha_pass(self):
+        await CAPTCHA_PASSED.adelete(self.get_ckey())
+
+    async def aset_captcha_passed(self):
+        # NOTE add only writes the key if it does not exist yet, like set_captcha_passed
+        await CAPTCHA_PASSED.aadd(self.get_ckey(), self.MAX_ERROR_ATTEMPTS)
+
+    async def ais_captcha_passed(self):
+        return bool(await CAPTCHA_PASSED.aget(self.get_ckey()))
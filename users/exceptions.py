@@ -21,4 +21,12 @@ class Wrong2FATooManyTimes(BaseError):
 class TwoFAFailed(BaseError):
     status_code = status.HTTP_403_FORBIDDEN
     default_detail = _('You do not have permission to perform this action.')
-    default_code = '2fa_failed'
\ No newline at end of file
+    default_code = '2fa_failed'
+
+
+class PasswordHashingBusy(BaseError):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = _('Too many logins in progress, please try again in a moment.')
+    default_code = 'password_hashing_busy'
+    # NOTE sent as Retry-After, in seconds
+    wait = 1
@@ -0,0 +1,164 @@
+import json
+import logging
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import DatabaseError, transaction
+from django.utils import timezone
+
+from backend.cache import redis_client, async_redis_client
+from users.models import LoginHistory
+from users.cache_keys import (
+    LOGIN_HISTORY_BUFFER_KEY,
+    LOGIN_HISTORY_PROCESSING_KEY,
+    LOGIN_HISTORY_FLUSH_LOCK_KEY,
+    LOGIN_HISTORY_DEAD_LETTER_KEY,
+)
+
+logger = logging.getLogger(__name__)
+
+User = get_user_model()
+
+"""
+Write-behind buffer for LoginHistory.
+
+With settings.LOGIN_HISTORY_BUFFERED the login request only pushes the event to a Redis list,
+and users.tasks.flush_login_history writes the events with bulk_create.
+
+Events are moved atomically from the buffer to a processing list before being written and the
+processing list is only cleared after the insert succeeds, so a worker crash never loses events.
+Events of a crashed flush are written again by the next one (at-least-once delivery).
+
+A bad event must not block the buffer: events of deleted users are dropped, and when the batch
+insert fails its events are inserted one by one and the ones the database still rejects
+(e.g. no partition for their month) are moved to the LOGIN_HISTORY_DEAD_LETTER_KEY list.
+"""
+
+# Moves up to ARGV[1] events from the buffer (KEYS[1]) to the processing list (KEYS[2])
+MOVE_BATCH_SCRIPT = redis_client.register_script("""
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items > 0 then
+    redis.call('LTRIM', KEYS[1], #items, -1)
+    redis.call('RPUSH', KEYS[2], unpack(items))
+end
+return items
+""")
+
+
+def record_login(user, ip: str | None, user_agent: str) -> None:
+    """
+    Stores a successful login, directly or through the Redis buffer
+    """
+    if not settings.LOGIN_HISTORY_BUFFERED:
+        LoginHistory(user=user, ip=ip, user_agent=user_agent).save()
+        return
+
+    redis_client.rpush(LOGIN_HISTORY_BUFFER_KEY, _login_event(user, ip, user_agent))
+
+
+async def arecord_login(user, ip: str | None, user_agent: str) -> None:
+    if not settings.LOGIN_HISTORY_BUFFERED:
+        await LoginHistory.objects.acreate(user=user, ip=ip, user_agent=user_agent)
+        return
+
+    await async_redis_client.rpush(LOGIN_HISTORY_BUFFER_KEY, _login_event(user, ip, user_agent))
+
+
+def _login_event(user, ip: str | None, user_agent: str) -> str:
+    return json.dumps({
+        'user_id': user.id,
+        'ip': ip,
+        'user_agent': user_agent,
+        'timestamp': timezone.now().isoformat(),
+    })
+
+
+def _parse_events(events: list[bytes]) -> tuple[list[tuple[bytes, LoginHistory]], list[bytes]]:
+    """
+    ([(event, row), ...], malformed events)
+    """
+    rows, malformed = [], []
+    for event in events:
+        try:
+            data = json.loads(event)
+            rows.append((event, LoginHistory(
+                user_id=data['user_id'],
+                ip=data['ip'],
+                user_agent=data['user_agent'],
+                timestamp=datetime.fromisoformat(data['timestamp']),
+            )))
+        except (ValueError, TypeError, KeyError):
+            malformed.append(event)
+    return rows, malformed
+
+
+def _insert(rows: list[tuple[bytes, LoginHistory]]) -> list[bytes]:
+    """
+    Inserts the rows, returns the events of the ones the database rejected
+    """
+    try:
+        with transaction.atomic():
+            LoginHistory.objects.bulk_create([row for _, row in rows])
+        return []
+    except DatabaseError as e:
+        logger.warning(f'[Login history] batch of {len(rows)} rejected, inserting one by one: {e!r}')
+
+    rejected = []
+    for event, row in rows:
+        try:
+            with transaction.atomic():
+                row.save(force_insert=True)
+        except DatabaseError:
+            rejected.append(event)
+    return rejected
+
+
+def _write_events(events: list[bytes]) -> int:
+    rows, dead = _parse_events(events)
+    written = 0
+    if rows:
+        user_ids = set(User.objects.filter(pk__in={row.user_id for _, row in rows}).values_list('pk', flat=True))
+        existing = [(event, row) for event, row in rows if row.user_id in user_ids]
+        if len(existing) < len(rows):
+            logger.info(f'[Login history] dropped {len(rows) - len(existing)} logins of deleted users')
+        rejected = _insert(existing) if existing else []
+        written = len(existing) - len(rejected)
+        dead += rejected
+
+    # NOTE only cleared after the insert, a crash before this line keeps the events for the next flush
+    with redis_client.pipeline() as pipe:
+        if dead:
+            logger.error(f'[Login history] {len(dead)} logins moved to {LOGIN_HISTORY_DEAD_LETTER_KEY}')
+            pipe.rpush(LOGIN_HISTORY_DEAD_LETTER_KEY, *dead)
+        pipe.delete(LOGIN_HISTORY_PROCESSING_KEY)
+        pipe.execute()
+    return written
+
+
+def flush_login_history(batch_size: int | None = None) -> int:
+    """
+    Writes the buffered logins in batches of batch_size and returns how many were written.
+    Only one flush runs at a time, concurrent calls return 0.
+    """
+    batch_size = batch_size or settings.LOGIN_HISTORY_FLUSH_SIZE
+    lock = redis_client.lock(LOGIN_HISTORY_FLUSH_LOCK_KEY, timeout=max(settings.LOGIN_HISTORY_FLUSH_INTERVAL, 1) * 10)
+    if not lock.acquire(blocking=False):
+        return 0
+
+    try:
+        # Events left behind by a flush that crashed
+        total = _write_events(redis_client.lrange(LOGIN_HISTORY_PROCESSING_KEY, 0, -1))
+
+        while True:
+            events = MOVE_BATCH_SCRIPT(keys=[LOGIN_HISTORY_BUFFER_KEY, LOGIN_HISTORY_PROCESSING_KEY], args=[batch_size])
+            total += _write_events(events)
+            if len(events) < batch_size:
+                break
+            lock.reacquire()
+    finally:
+        lock.release()
+
+    if total:
+        logger.info(f'[Login history] flushed {total} logins')
+    return total
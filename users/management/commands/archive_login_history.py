@@ -0,0 +1,38 @@
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from users import partitions
+
+
+class Command(BaseCommand):
+    help = 'Exports LoginHistory partitions older than the retention period to .csv.gz files and drops them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output_dir', type=Path)
+        parser.add_argument('--keep-months', type=int, default=settings.LOGIN_HISTORY_RETENTION_MONTHS)
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        if not partitions.is_partitioned():
+            raise CommandError('LoginHistory is not partitioned (PostgreSQL and migration 0003 are required)')
+
+        output_dir: Path = options['output_dir']
+        output_dir.mkdir(parents=True, exist_ok=True)
+        cutoff = partitions.add_months(partitions.month_start(timezone.now().date()), -options['keep_months'])
+
+        for name, month in partitions.list_partitions():
+            if month >= cutoff:
+                continue
+
+            path = output_dir / f'{name}.csv.gz'
+            if options['dry_run']:
+                self.stdout.write(f'Would archive {name} to {path}')
+                continue
+
+            # NOTE rows are exported before the partition is dropped, a failed export keeps the data
+            partitions.export_partition(name, path)
+            partitions.drop_partition(name)
+            self.stdout.write(self.style.SUCCESS(f'Archived {name} to {path}'))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from users.models import LoginHistory, KnownLoginIP
+
+
+class Command(BaseCommand):
+    help = 'Fills KnownLoginIP with every (user, ip) pair found in LoginHistory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        pairs = LoginHistory.objects.filter(
+            user__isnull=False,
+            ip__isnull=False,
+        ).values_list('user_id', 'ip').distinct().order_by()
+
+        batch = []
+        total = 0
+        for user_id, ip in pairs.iterator(chunk_size=batch_size):
+            batch.append(KnownLoginIP(user_id=user_id, ip=ip))
+            if len(batch) >= batch_size:
+                KnownLoginIP.objects.bulk_create(batch, ignore_conflicts=True)
+                total += len(batch)
+                batch = []
+
+        if batch:
+            KnownLoginIP.objects.bulk_create(batch, ignore_conflicts=True)
+            total += len(batch)
+
+        self.stdout.write(self.style.SUCCESS(f'Processed {total} known IPs'))
@@ -0,0 +1,72 @@
+import random
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from users.auth.lookups import users_by_email
+
+User = get_user_model()
+
+TABLE = 'bench_user_lookup'
+
+
+class Command(BaseCommand):
+    help = 'Compares email__iexact with the LOWER(email) index lookup on a throwaway table with millions of users (PostgreSQL)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2_000_000)
+        parser.add_argument('--lookups', type=int, default=200)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('This benchmark needs PostgreSQL')
+
+        rows = options['users']
+        lookups = options['lookups']
+
+        self.stdout.write('ORM queries:')
+        self.stdout.write(f'  iexact: {User.objects.filter(email__iexact="a@b.c").query}')
+        self.stdout.write(f'  lookup: {users_by_email("a@b.c").query}')
+
+        with connection.cursor() as cursor:
+            self.stdout.write(f'Creating {TABLE} with {rows} users...')
+            cursor.execute(f'DROP TABLE IF EXISTS {TABLE}')
+            cursor.execute(
+                f'CREATE UNLOGGED TABLE {TABLE} AS '
+                f"SELECT i AS id, 'User' || i AS username, 'User' || i || '@Example.com' AS email "
+                f'FROM generate_series(1, %s) AS i',
+                [rows],
+            )
+            # Same indexes as auth_user (unique username, plain email) plus the ones from 0004_user_lower_indexes
+            cursor.execute(f'CREATE UNIQUE INDEX {TABLE}_username ON {TABLE} (username)')
+            cursor.execute(f'CREATE INDEX {TABLE}_email ON {TABLE} (email)')
+            cursor.execute(f'CREATE INDEX {TABLE}_email_lower_idx ON {TABLE} (LOWER(email))')
+            cursor.execute(f'ANALYZE {TABLE}')
+
+            try:
+                queries = {
+                    'email__iexact (UPPER)': f'SELECT id FROM {TABLE} WHERE UPPER(email::text) = UPPER(%s)',
+                    'users_by_email (LOWER)': f'SELECT id FROM {TABLE} WHERE LOWER(email) = %s',
+                }
+                emails = [f'user{random.randint(1, rows)}@example.com' for _ in range(lookups)]
+
+                for name, sql in queries.items():
+                    cursor.execute(f'EXPLAIN {sql}', [emails[0]])
+                    plan = [row[0].strip(' ->') for row in cursor.fetchall()]
+                    seq_scan = any('Seq Scan' in line for line in plan)
+
+                    # NOTE sequential scans take seconds each on millions of rows, time fewer of them
+                    sample = emails[:5] if seq_scan else emails
+                    start = time.perf_counter()
+                    for email in sample:
+                        cursor.execute(sql, [email])
+                        cursor.fetchall()
+                    elapsed = time.perf_counter() - start
+
+                    self.stdout.write(f'{name:24} {elapsed / len(sample) * 1000:10.2f} ms/lookup')
+                    for line in plan:
+                        self.stdout.write(f'    {line}')
+            finally:
+                cursor.execute(f'DROP TABLE {TABLE}')
@@ -0,0 +1,46 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+
+from users.auth.hashing import hashing_pool
+from users.exceptions import PasswordHashingBusy
+
+
+class Command(BaseCommand):
+    help = 'Measures password checks per second through the hashing pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--logins', type=int, default=200)
+        parser.add_argument('--clients', type=int, default=32, help='Concurrent request threads')
+
+    def handle(self, *args, **options):
+        logins = options['logins']
+        encoded = make_password('benchmark-password')
+
+        def login(i):
+            # Half of the attempts are for unknown users, like credential stuffing traffic
+            try:
+                if i % 2:
+                    hashing_pool.check_dummy('benchmark-password')
+                else:
+                    hashing_pool.verify('benchmark-password', encoded)
+            except PasswordHashingBusy:
+                pass
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['clients']) as clients:
+            list(clients.map(login, range(logins)))
+        elapsed = time.perf_counter() - start
+
+        cores = min(hashing_pool.max_workers, os.cpu_count() or 1)
+        stats = hashing_pool.stats()
+        self.stdout.write(f'{logins} logins in {elapsed:.2f}s with {hashing_pool.max_workers} hashing workers')
+        self.stdout.write(f'{logins / elapsed:.1f} logins/s, {logins / elapsed / cores:.1f} logins/s per core')
+        self.stdout.write(
+            f'hash avg {stats["hash_seconds_avg"] * 1000:.1f} ms, max {stats["hash_seconds_max"] * 1000:.1f} ms, '
+            f'queue wait avg {stats["wait_seconds_avg"] * 1000:.1f} ms, max {stats["wait_seconds_max"] * 1000:.1f} ms, '
+            f'{stats["rejected"]} rejected (queue of {hashing_pool.queue_size})'
+        )
@@ -0,0 +1,87 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from users.similarity import SimilarityIndex, brute_force_max_score
+from users.utils import USERNAME_ADJECTIVES, USERNAME_NOUNS
+
+
+def random_username(rng: random.Random) -> str:
+    return f'{rng.choice(USERNAME_ADJECTIVES).capitalize()}{rng.choice(USERNAME_NOUNS).capitalize()}{rng.randint(10, 99)}'
+
+
+def random_email(rng: random.Random) -> str:
+    name = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(5, 12)))
+    return f'{name}{rng.randint(0, 999)}@{rng.choice(("gmail.com", "outlook.com", "proton.me"))}'
+
+
+def bot_variant(rng: random.Random, text: str) -> str:
+    """
+    A few character edits, like the registrations of a bot wave
+    """
+    chars = list(text)
+    for _ in range(rng.randint(1, 2)):
+        position = rng.randrange(len(chars))
+        chars[position] = rng.choice('abcdefghijklmnopqrstuvwxyz0123456789')
+    return ''.join(chars)
+
+
+def percentiles(samples: list[float]) -> str:
+    samples = sorted(samples)
+    p50 = statistics.median(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    return f'p50 {p50 * 1e3:8.3f} ms  p99 {p99 * 1e3:8.3f} ms  max {samples[-1] * 1e3:8.3f} ms'
+
+
+class Command(BaseCommand):
+    help = 'Compares RegisterUserCheck scoring through users.similarity with the loop over every recent email'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--window', type=int, default=10_000, help='recent registrations compared')
+        parser.add_argument('--queries', type=int, default=2_000)
+        parser.add_argument('--brute-force-queries', type=int, default=50, help='the loop takes seconds per query')
+        parser.add_argument('--min-score', type=int, default=85)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        min_score = options['min_score']
+        window = [random_username(rng) if rng.random() < 0.7 else random_email(rng) for _ in range(options['window'])]
+        # Half of the queries are new registrations, half are close to a recent one
+        queries = [
+            bot_variant(rng, rng.choice(window)) if i % 2 else
+            (random_username(rng) if rng.random() < 0.7 else random_email(rng))
+            for i in range(options['queries'])
+        ]
+
+        index = SimilarityIndex()
+        start = time.perf_counter()
+        index.sync(window)
+        self.stdout.write(f'index of {len(window)} built in {(time.perf_counter() - start) * 1e3:.1f} ms')
+
+        new = random_username(rng)
+        start = time.perf_counter()
+        index.sync([new] + window[:-1])
+        self.stdout.write(f'one registration synced in {(time.perf_counter() - start) * 1e3:.3f} ms')
+        index.sync(window)
+
+        timings, scores = [], []
+        for query in queries:
+            start = time.perf_counter()
+            scores.append(index.max_score(query, min_score))
+            timings.append(time.perf_counter() - start)
+        rejected = sum(score >= min_score for score in scores)
+        self.stdout.write(f'{"similarity index":18} {percentiles(timings)}  rejected {rejected}/{len(queries)}')
+
+        checked = queries[:options['brute_force_queries']]
+        timings, mismatches = [], 0
+        for query, score in zip(checked, scores):
+            start = time.perf_counter()
+            expected = brute_force_max_score(query, window)
+            timings.append(time.perf_counter() - start)
+            # Exact from min_score up, on the same side of it below
+            if (expected >= min_score or score >= min_score) and expected != score:
+                mismatches += 1
+        self.stdout.write(f'{"loop":18} {percentiles(timings)}  mismatches {mismatches}/{len(checked)}')
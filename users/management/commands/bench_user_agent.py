@@ -0,0 +1,50 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from django_user_agents.utils import get_user_agent
+from user_agents import parse
+
+from users.user_agent import get_request_user_agent
+
+SAMPLE_USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/129.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.6 Safari/605.1.15',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.6 Mobile/15E148 Safari/604.1',
+    'Mozilla/5.0 (Linux; Android 14; SM-S918B) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/129.0.0.0 Mobile Safari/537.36',
+    'Mozilla/5.0 (X11; Linux x86_64; rv:131.0) Gecko/20100101 Firefox/131.0',
+    'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
+]
+
+
+def format_user_agent(user_agent):
+    return (
+        user_agent.device.family,
+        f'({user_agent.os.family} {user_agent.os.version_string})',
+        f'({user_agent.browser.family} {user_agent.browser.version_string})',
+    )
+
+
+class Command(BaseCommand):
+    help = 'Compares the previous user agent parsing path with users.user_agent'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        factory = RequestFactory()
+        requests = [factory.get('/', HTTP_USER_AGENT=ua) for ua in SAMPLE_USER_AGENTS]
+
+        paths = {
+            'ua-parser, no cache': lambda request: format_user_agent(parse(request.META['HTTP_USER_AGENT'])),
+            'django_user_agents (cache)': lambda request: format_user_agent(get_user_agent(request)),
+            'users.user_agent (LRU)': get_request_user_agent,
+        }
+
+        for name, func in paths.items():
+            start = time.perf_counter()
+            for i in range(iterations):
+                func(requests[i % len(requests)])
+            elapsed = time.perf_counter() - start
+            self.stdout.write(f'{name:32} {elapsed / iterations * 1e6:10.1f} us/call {iterations / elapsed:12.0f} calls/s')
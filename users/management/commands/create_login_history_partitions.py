@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from users import partitions
+
+
+class Command(BaseCommand):
+    help = 'Creates the LoginHistory partitions of the current and the next months'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months-ahead', type=int, default=None)
+
+    def handle(self, *args, **options):
+        if not partitions.is_partitioned():
+            raise CommandError('LoginHistory is not partitioned (PostgreSQL and migration 0003 are required)')
+
+        created = partitions.ensure_login_history_partitions(options['months_ahead'])
+        self.stdout.write(self.style.SUCCESS(f'Created {len(created)} partitions'))
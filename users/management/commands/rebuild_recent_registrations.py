@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from users.utils import RegisterUserCheck
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the RegisterUserCheck list of recent registration emails from the users'
+
+    def handle(self, *args, **options):
+        emails = RegisterUserCheck.rebuild_last_emails()
+        self.stdout.write(self.style.SUCCESS(
+            f'Stored {len(emails)} of the last {RegisterUserCheck.COUNT_LAST_EMAILS} registrations'
+        ))
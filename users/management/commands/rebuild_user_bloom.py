@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from users.bloom import rebuild_user_bloom, user_bloom
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the Bloom filter of existing usernames and emails from the database'
+
+    def handle(self, *args, **options):
+        count = rebuild_user_bloom()
+        self.stdout.write(self.style.SUCCESS(
+            f'Stored {count} usernames and emails in {user_bloom.size // 8} bytes ({user_bloom.hashes} hashes), '
+            f'false positive rate {user_bloom.false_positive_rate(count):.4%}'
+        ))
@@ -0,0 +1,107 @@
+# Converts users_loginhistory into a table partitioned by month on "timestamp" (PostgreSQL only)
+#
+# PostgreSQL requires the partition key in the primary key, so the table gets PRIMARY KEY (id, timestamp).
+# Django keeps treating "id" as the primary key, ids still come from a single sequence.
+# Existing rows are copied into monthly partitions, this runs inside the migration transaction.
+# The reverse copies the rows back into the unpartitioned table of 0001_initial.
+
+from datetime import date
+
+from django.core.management.color import no_style
+from django.db import migrations
+from django.utils import timezone
+
+PARTITIONS_AHEAD = 3
+
+
+def add_months(value, months):
+    month = value.month - 1 + months
+    return date(value.year + month // 12, month % 12 + 1, 1)
+
+
+def partition_login_history(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+
+    LoginHistory = apps.get_model('users', 'LoginHistory')
+    User = LoginHistory._meta.get_field('user').related_model
+    table = LoginHistory._meta.db_table
+    old_table = f'{table}_unpartitioned'
+    sequence = f'{table}_partitioned_id_seq'
+    qn = connection.ops.quote_name
+
+    with connection.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE {qn(table)} RENAME TO {qn(old_table)}')
+        cursor.execute(
+            f'CREATE TABLE {qn(table)} (LIKE {qn(old_table)} INCLUDING DEFAULTS) PARTITION BY RANGE ("timestamp")'
+        )
+        cursor.execute(f'CREATE SEQUENCE {qn(sequence)}')
+        cursor.execute(f"ALTER TABLE {qn(table)} ALTER COLUMN id SET DEFAULT nextval('{sequence}')")
+        cursor.execute(f'ALTER SEQUENCE {qn(sequence)} OWNED BY {qn(table)}.id')
+        cursor.execute(f'ALTER TABLE {qn(table)} ADD PRIMARY KEY (id, "timestamp")')
+        cursor.execute(
+            f'ALTER TABLE {qn(table)} ADD CONSTRAINT {qn(table + "_user_id_fk")} '
+            f'FOREIGN KEY (user_id) REFERENCES {qn(User._meta.db_table)} (id) DEFERRABLE INITIALLY DEFERRED'
+        )
+        cursor.execute(f'CREATE INDEX {qn(table + "_user_ts_idx")} ON {qn(table)} (user_id, "timestamp" DESC)')
+        cursor.execute(f'CREATE INDEX {qn(table + "_ts_idx")} ON {qn(table)} ("timestamp")')
+        cursor.execute(f'CREATE TABLE {qn(table + "_default")} PARTITION OF {qn(table)} DEFAULT')
+
+        cursor.execute(f'SELECT min("timestamp") FROM {qn(old_table)}')
+        first = cursor.fetchone()[0] or timezone.now()
+        month = date(first.year, first.month, 1)
+        last = add_months(timezone.now().date(), PARTITIONS_AHEAD)
+        while month <= last:
+            cursor.execute(
+                f'CREATE TABLE {qn(f"{table}_p{month:%Y_%m}")} PARTITION OF {qn(table)} '
+                f"FOR VALUES FROM ('{month:%Y-%m-%d} 00:00+00') TO ('{add_months(month, 1):%Y-%m-%d} 00:00+00')"
+            )
+            month = add_months(month, 1)
+
+        cursor.execute(
+            f'INSERT INTO {qn(table)} (id, ip, user_agent, "timestamp", user_id) '
+            f'SELECT id, ip, user_agent, "timestamp", user_id FROM {qn(old_table)}'
+        )
+        cursor.execute(f"SELECT setval('{sequence}', COALESCE((SELECT max(id) FROM {qn(table)}), 0) + 1, false)")
+        cursor.execute(f'DROP TABLE {qn(old_table)}')
+
+
+def unpartition_login_history(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+
+    LoginHistory = apps.get_model('users', 'LoginHistory')
+    table = LoginHistory._meta.db_table
+    partitioned_table = f'{table}_partitioned'
+    qn = connection.ops.quote_name
+
+    with connection.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE {qn(table)} RENAME TO {qn(partitioned_table)}')
+        # NOTE frees the primary key name for the table create_model makes
+        cursor.execute(
+            "SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'p'", [partitioned_table]
+        )
+        cursor.execute(f'ALTER TABLE {qn(partitioned_table)} DROP CONSTRAINT {qn(cursor.fetchone()[0])}')
+
+        schema_editor.create_model(LoginHistory)
+        cursor.execute(
+            f'INSERT INTO {qn(table)} (id, ip, user_agent, "timestamp", user_id) '
+            f'SELECT id, ip, user_agent, "timestamp", user_id FROM {qn(partitioned_table)}'
+        )
+        for sql in connection.ops.sequence_reset_sql(no_style(), [LoginHistory]):
+            cursor.execute(sql)
+        # Drops the partitions and the id sequence too
+        cursor.execute(f'DROP TABLE {qn(partitioned_table)}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_knownloginip'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_login_history, unpartition_login_history),
+    ]
@@ -0,0 +1,54 @@
+# Functional indexes on LOWER(email) and LOWER(username) of the user table, used by users.auth.lookups
+#
+# On PostgreSQL the indexes are built CONCURRENTLY so the user table is not locked, that is why
+# this migration is not atomic. If a concurrent build fails it leaves an INVALID index, drop it and migrate again.
+
+from django.conf import settings
+from django.db import migrations
+
+INDEXES = (
+    ('email_lower_idx', 'email'),
+    ('username_lower_idx', 'username'),
+)
+
+
+def index_names(apps):
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    table = User._meta.db_table
+    return table, [(f'{table}_{suffix}', column) for suffix, column in INDEXES]
+
+
+def create_lower_indexes(apps, schema_editor):
+    connection = schema_editor.connection
+    concurrently = 'CONCURRENTLY ' if connection.vendor == 'postgresql' else ''
+    qn = connection.ops.quote_name
+    table, indexes = index_names(apps)
+
+    with connection.cursor() as cursor:
+        for name, column in indexes:
+            cursor.execute(f'CREATE INDEX {concurrently}IF NOT EXISTS {qn(name)} ON {qn(table)} (LOWER({qn(column)}))')
+
+
+def drop_lower_indexes(apps, schema_editor):
+    connection = schema_editor.connection
+    concurrently = 'CONCURRENTLY ' if connection.vendor == 'postgresql' else ''
+    qn = connection.ops.quote_name
+    _, indexes = index_names(apps)
+
+    with connection.cursor() as cursor:
+        for name, _ in indexes:
+            cursor.execute(f'DROP INDEX {concurrently}IF EXISTS {qn(name)}')
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('users', '0003_partition_loginhistory'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_lower_indexes, drop_lower_indexes),
+    ]
@@ -44,4 +44,19 @@ class LoginHistory(UserMixinModel):
         ordering = ['-timestamp']
     
     def __str__(self):
-        return f"{self.user.email} - {self.ip} - {self.timestamp}"
\ No newline at end of file
+        return f"{self.user.email} - {self.ip} - {self.timestamp}"
+
+
+class KnownLoginIP(BaseModel, UserMixinModel):
+    """IPs a user already logged in from, used to detect logins from new IPs"""
+    ip = models.GenericIPAddressField()
+
+    class Meta:
+        verbose_name = 'Known login IP'
+        verbose_name_plural = 'Known login IPs'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'ip'], name='users_knownloginip_user_ip_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.email} - {self.ip}"
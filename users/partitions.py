@@ -0,0 +1,136 @@
+import gzip
+import logging
+from datetime import date, datetime
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from users.models import LoginHistory
+
+logger = logging.getLogger(__name__)
+
+"""
+Monthly range partitions of the LoginHistory table (PostgreSQL only).
+
+The table is converted by migration 0003_partition_loginhistory. Partitions are named
+<table>_pYYYY_MM and cover [first day of the month, first day of the next month) in UTC.
+Rows outside every partition go to <table>_default, so partitions must be created ahead
+of time (see ensure_login_history_partitions and the ensure_login_history_partitions task).
+"""
+
+TABLE = LoginHistory._meta.db_table
+
+
+def month_start(value: date) -> date:
+    return date(value.year, value.month, 1)
+
+
+def add_months(value: date, months: int) -> date:
+    month = value.month - 1 + months
+    return date(value.year + month // 12, month % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f'{TABLE}_p{month:%Y_%m}'
+
+
+def partition_month(name: str) -> date | None:
+    try:
+        return datetime.strptime(name, f'{TABLE}_p%Y_%m').date()
+    except ValueError:
+        return None
+
+
+def is_partitioned() -> bool:
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass',
+            [TABLE],
+        )
+        return cursor.fetchone() is not None
+
+
+def list_partitions() -> list[tuple[str, date]]:
+    """
+    Returns the monthly partitions attached to the table, oldest first
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT child.relname FROM pg_inherits '
+            'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+            'WHERE pg_inherits.inhparent = %s::regclass',
+            [TABLE],
+        )
+        partitions = [(name, partition_month(name)) for name, in cursor.fetchall()]
+    return sorted((name, month) for name, month in partitions if month)
+
+
+def create_partition(month: date) -> str:
+    name = partition_name(month)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'CREATE TABLE IF NOT EXISTS {connection.ops.quote_name(name)} '
+            f'PARTITION OF {connection.ops.quote_name(TABLE)} '
+            f"FOR VALUES FROM ('{month:%Y-%m-%d} 00:00+00') TO ('{add_months(month, 1):%Y-%m-%d} 00:00+00')"
+        )
+    return name
+
+
+def ensure_login_history_partitions(months_ahead: int | None = None) -> list[str]:
+    """
+    Creates the partitions for the current month and the next months_ahead months
+    """
+    if not is_partitioned():
+        return []
+
+    if months_ahead is None:
+        months_ahead = settings.LOGIN_HISTORY_PARTITIONS_AHEAD
+
+    current = month_start(timezone.now().date())
+    existing = {name for name, _ in list_partitions()}
+    created = []
+    for offset in range(months_ahead + 1):
+        month = add_months(current, offset)
+        if partition_name(month) in existing:
+            continue
+        try:
+            created.append(create_partition(month))
+        except Exception:
+            # NOTE this fails if the default partition already holds rows of that month
+            logger.exception(f'[Login history] could not create partition for {month:%Y-%m}')
+
+    if created:
+        logger.info(f'[Login history] created partitions {", ".join(created)}')
+    return created
+
+
+def export_partition(name: str, path) -> None:
+    """
+    Writes the rows of a partition to a gzip compressed CSV file
+    """
+    # NOTE imported here, it needs a PostgreSQL driver and this module is loaded on every database
+    from django.db.backends.postgresql.psycopg_any import is_psycopg3
+
+    sql = f'COPY {connection.ops.quote_name(name)} TO STDOUT WITH (FORMAT csv, HEADER)'
+    with gzip.open(path, 'wb') as output, connection.cursor() as cursor:
+        if is_psycopg3:
+            # NOTE psycopg 3 has no copy_expert, the rows are streamed in chunks
+            with cursor.copy(sql) as copy:
+                for data in copy:
+                    output.write(data)
+        else:
+            cursor.copy_expert(sql, output)
+
+
+def drop_partition(name: str) -> None:
+    """
+    Detaches and drops a partition, this is O(1) regardless of how many rows it holds
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            f'ALTER TABLE {connection.ops.quote_name(TABLE)} DETACH PARTITION {connection.ops.quote_name(name)}'
+        )
+        cursor.execute(f'DROP TABLE {connection.ops.quote_name(name)}')
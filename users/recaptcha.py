@@ -0,0 +1,101 @@
+import hashlib
+import logging
+
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from rest_framework.exceptions import ValidationError
+
+from users.cache_keys import RECAPTCHA_RESULT
+
+logger = logging.getLogger(__name__)
+
+"""
+reCAPTCHA verification client.
+
+One requests.Session per process keeps the TLS connections to the verify endpoint alive,
+every call is bounded by connect/read timeouts and failed verifications are cached for a
+short time, so re-sending a bad token (e.g. a bot retrying) does not call Google again.
+
+Successes are never cached: tokens are single use and Google answers a second check of the
+same token with timeout-or-duplicate, a cached success would let it be replayed.
+"""
+
+
+class RecaptchaVerifier:
+
+    def __init__(
+        self,
+        url: str,
+        secret: str,
+        connect_timeout: float,
+        read_timeout: float,
+        pool_size: int,
+        cache_timeout: int,
+    ):
+        self.url = url
+        self.secret = secret
+        self.timeout = (connect_timeout, read_timeout)
+        self.cache_timeout = cache_timeout
+
+        self.session = requests.Session()
+        # NOTE no retries, a failed verification is answered right away instead of holding the worker
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    @staticmethod
+    def bad_captcha_error() -> ValidationError:
+        return ValidationError({
+            'message': 'bad captcha!',
+            'type': 'bad_captcha'
+        })
+
+    def token_digest(self, token: str, remote_ip: str | None) -> str:
+        return hashlib.sha256(f'{token}:{remote_ip or ""}'.encode()).hexdigest()
+
+    def request(self, token: str, remote_ip: str | None, secret: str | None = None) -> bool:
+        data = {'secret': secret or self.secret, 'response': token}
+        if remote_ip:
+            data['remoteip'] = remote_ip
+        try:
+            response = self.session.post(self.url, data=data, timeout=self.timeout)
+            response.raise_for_status()
+            return bool(response.json().get('success'))
+        except (requests.RequestException, ValueError) as e:
+            logger.warning(f'[reCAPTCHA] verification failed: {e!r}')
+            raise ValidationError({
+                'message': 'captcha verification unavailable',
+                'type': 'captcha_unavailable'
+            })
+
+    def verify(self, token: str, remote_ip: str | None = None, secret: str | None = None) -> None:
+        """
+        Raises ValidationError if the token is not valid
+        """
+        key = self.token_digest(token, remote_ip)
+        if RECAPTCHA_RESULT.get(key) is None:
+            if self.request(token, remote_ip, secret):
+                return
+            RECAPTCHA_RESULT.set(key, False, timeout=self.cache_timeout)
+        raise self.bad_captcha_error()
+
+    async def averify(self, token: str, remote_ip: str | None = None, secret: str | None = None) -> None:
+        key = self.token_digest(token, remote_ip)
+        if await RECAPTCHA_RESULT.aget(key) is None:
+            # NOTE there is no async HTTP client in the requirements, the pooled session runs in a worker thread
+            if await sync_to_async(self.request, thread_sensitive=False)(token, remote_ip, secret):
+                return
+            await RECAPTCHA_RESULT.aset(key, False, timeout=self.cache_timeout)
+        raise self.bad_captcha_error()
+
+
+recaptcha_verifier = RecaptchaVerifier(
+    url=settings.RECAPTCHA_VERIFY_URL,
+    secret=settings.RECAPTCHA_SECRET,
+    connect_timeout=settings.RECAPTCHA_CONNECT_TIMEOUT,
+    read_timeout=settings.RECAPTCHA_READ_TIMEOUT,
+    pool_size=settings.RECAPTCHA_POOL_SIZE,
+    cache_timeout=settings.RECAPTCHA_RESULT_CACHE_TIMEOUT,
+)
@@ -4,15 +4,16 @@ from ipware import get_client_ip
 from celery import Task
 
 from django.conf import settings
-from user_agents.parsers import UserAgent
-from django_user_agents.utils import get_user_agent
-from django.db.models import Model
+from django.db.models import Model, Exists, OuterRef
+from django.db.models.functions import Lower
 from django.db.transaction import atomic
-from django.core.cache import cache
-from django.contrib.auth import get_user_model
+from django.contrib.auth import get_user_model, aauthenticate
 from django.contrib.sites.models import Site
 from django.contrib.sites.shortcuts import get_current_site
+from asgiref.sync import sync_to_async
 from rest_framework import serializers
+from allauth.account import app_settings as allauth_account_settings
+from allauth.account.models import EmailAddress
 from rest_framework.exceptions import ValidationError, MethodNotAllowed
 from django.utils.translation import gettext_lazy as _
 from dj_rest_auth.registration.serializers import RegisterSerializer as BaseRegisterSerializer
@@ -22,26 +23,34 @@ from dj_rest_auth.serializers import PasswordResetConfirmSerializer as BasePassw
 from dj_rest_auth.serializers import PasswordResetSerializer as BasePasswordResetSerializer
 from dj_rest_auth.serializers import UserDetailsSerializer
 
-from users.models import Profile, LoginHistory
+from users import bloom
+from users.models import Profile, KnownLoginIP
+from users.auth.lookups import users_by_email
+from users.login_history import record_login, arecord_login
 from users.captcha import CaptchaProcessor
+from users.user_agent import ParsedUserAgent, aget_request_user_agent, get_request_user_agent, truncate_user_agent
 from users.utils import RegisterUserCheck, generate_cool_username
-from users.exceptions import AccountNotActive, TwoFAFailed, Wrong2FATooManyTimes
-from users.cache_keys import (
-    RESEND_VERIFICATION_TOKEN_CACHE_KEY,
-    RESEND_VERIFICATION_TOKEN_REVERSED_CACHE_KEY,
-)
+from users.exceptions import AccountNotActive, PasswordHashingBusy, TwoFAFailed, Wrong2FATooManyTimes
+from users.cache_keys import RESEND_VERIFICATION_TOKEN, RESEND_VERIFICATION_TOKEN_REVERSED
 from users.tasks import (
     notify_user_duplicate_registration,
     notify_user_ip_changed,
     notify_failed_login,
 )
 
+from backend.cache import aset_many, set_many
 from utils.generic_functions import generate_random_string
 
 logger = logging.getLogger(__name__)
 
 User: Model = get_user_model()
 
+
+async def apply_task_async(task, args):
+    # NOTE publishing to the broker is blocking I/O, so it runs in a worker thread
+    await sync_to_async(cast(Task, task).apply_async, thread_sensitive=False)(args)
+
+
 class UserSerializer(UserDetailsSerializer):
     """
     This is used by dj-rest-auth tp serialize the user data in the login and register response
@@ -95,62 +104,35 @@ class LoginSerializer(GCodeMixIn, BaseLoginSerializer):
         )
         captcher.check()
         
-        user_agent: UserAgent = get_user_agent(request)
-        device = user_agent.device.family
-        os = f'({user_agent.os.family} {user_agent.os.version_string})'
-        browser = f'({user_agent.browser.family} {user_agent.browser.version_string})'
-        
-        fields = {
-            'user': email,
-            'ip': ip,
-            'browser': browser,
-            'os': os,
-            'device': device,
-        }
-
-        try:
-            user_object = User.objects.filter(email=email).first()
-
-            # User not found
-            if not user_object:
-                raise ValidationError({'message': _('Unable to log in with provided credentials.'), 'type': 'wrong_data'})
+        user_agent: ParsedUserAgent = get_request_user_agent(request)
 
-            # User password was removed
-            if not user_object.password:
-                raise ValidationError({'message': _('Please reset your password'), 'type': 'reset_psw'})
+        user_object = self.get_login_user(email, ip)
 
-            if not user_object.is_active:
-                raise AccountNotActive({'message': _('User account is disabled.'), 'type': 'account_block'})
+        try:
+            self.check_login_user(user_object)
             
-            # Call the BaseLoginSerializer validate method
-            user = self._validate_email(email, password)
+            # NOTE the already loaded user is handed to the backend so it is not fetched again
+            user = self.authenticate(email=email, password=password, user=user_object)
 
             if not user:
                 raise ValidationError({'message': _('Unable to log in with provided credentials.'), 'type': 'wrong_data'})
 
             try:
-                # Call the BaseLoginSerializer validate_email_verification_status method
                 # NOTE this can be skipped if settings.EMAIL_VERIFICATION = False
                 self.validate_email_verification_status(user)
 
             except ValidationError:
-                # NOTE this token is for re-requesting a verification email
-                current_token = cache.get(f'{RESEND_VERIFICATION_TOKEN_REVERSED_CACHE_KEY}{user.id}')
-                if not current_token:
-                    current_token = generate_random_string(32)
-                    cache.set(f'{RESEND_VERIFICATION_TOKEN_REVERSED_CACHE_KEY}{user.id}', current_token, timeout=1800) # 30 minutes
-                    cache.set(f'{RESEND_VERIFICATION_TOKEN_CACHE_KEY}{current_token}', user.id, timeout=1800)
-                raise AccountNotActive({
-                    'error': 'email_not_verified',
-                    'type': 'email_not_verified',
-                    'token': current_token
-                })
+                raise self.email_not_verified_error(self.get_resend_verification_token(user.id))
 
             self.validate_kyc(user)
 
             attrs['user'] = user
             captcher.set_captcha_passed()
 
+        except PasswordHashingBusy:
+            # NOTE the password was not checked, this is not a failed login
+            raise
+
         except AccountNotActive:
             # NOTE we are not sending mail
             captcher.del_captcha_pass()
@@ -158,9 +140,9 @@ class LoginSerializer(GCodeMixIn, BaseLoginSerializer):
 
         except Exception as exc_ch:
             captcher.del_captcha_pass()
-            profile = Profile.objects.filter(user__email=email).first()
-            if profile:
-                cast(Task, notify_failed_login).apply_async((profile.user_id,))
+            # NOTE profile comes from select_related, so this does not hit the database
+            if user_object and hasattr(user_object, 'profile'):
+                cast(Task, notify_failed_login).apply_async((user_object.id,))
             raise exc_ch
 
         try:
@@ -172,20 +154,15 @@ class LoginSerializer(GCodeMixIn, BaseLoginSerializer):
         captcher.del_captcha_pass()
 
         # Send email if IP changed
-        ip_history = list(LoginHistory.objects.filter(user=user).values_list('ip', flat=True))
-        if ip_history and ip not in ip_history:
-            device_type = "Mobil" if user_agent.is_mobile else \
-                "Tableta" if user_agent.is_tablet else \
-                "PC" if user_agent.is_pc else \
-                "Bot" if user_agent.is_bot else "Desconocido"
-            
-            cast(Task, notify_user_ip_changed).apply_async((user.id, ip, device_type, os, browser))
+        if user.has_known_ips and not user.is_known_ip:
+            cast(Task, notify_user_ip_changed).apply_async(
+                (user.id, ip, user_agent.ua_string)
+            )
 
-        LoginHistory(
-            user=user,
-            ip=ip,
-            user_agent=user_agent.ua_string[:255]
-        ).save()
+        if ip and not user.is_known_ip:
+            KnownLoginIP.objects.bulk_create([KnownLoginIP(user=user, ip=ip)], ignore_conflicts=True)
+
+        record_login(user, ip, user_agent.ua_string[:255])
 
         # Update register ip if necessary
         # if not user_object.profile.register_ip:
@@ -193,9 +170,160 @@ class LoginSerializer(GCodeMixIn, BaseLoginSerializer):
         #     profile.register_ip = ip
         #     profile.save()
 
-        logger.info(f'[User auth success] user: {attrs["user"]},  ip: {ip}, browser: {fields["browser"]}, os: {fields["os"]}, device: {fields["device"]}')
+        logger.info(f'[User auth success] user: {attrs["user"]},  ip: {ip}, browser: {user_agent.browser}, os: {user_agent.os}, device: {user_agent.device}')
         return attrs
 
+    async def avalidate(self, attrs):
+        """
+        Same as validate, but using the async ORM and cache. Used by users.async_views.AsyncLoginView
+        """
+        request = self._context['request']
+        ip = get_client_ip(request)[0]
+        email = attrs.get('email').lower()
+        password = attrs.get('password')
+
+        captcher = CaptchaProcessor(
+            email,
+            ip,
+            attrs.get('captcha'),
+        )
+        await captcher.acheck()
+
+        # NOTE parsed user agents are almost always served from the in-process LRU
+        user_agent: ParsedUserAgent = await aget_request_user_agent(request)
+
+        user_object = await self.login_user_queryset(email, ip).afirst()
+
+        try:
+            self.check_login_user(user_object)
+
+            user = await aauthenticate(request, email=email, password=password, user=user_object)
+
+            if not user:
+                raise ValidationError({'message': _('Unable to log in with provided credentials.'), 'type': 'wrong_data'})
+
+            try:
+                self.validate_email_verification_status(user)
+            except ValidationError:
+                raise self.email_not_verified_error(await self.aget_resend_verification_token(user.id))
+
+            self.validate_kyc(user)
+
+            attrs['user'] = user
+            await captcher.aset_captcha_passed()
+
+        except PasswordHashingBusy:
+            raise
+
+        except AccountNotActive:
+            await captcher.adel_captcha_pass()
+            raise
+
+        except Exception as exc_ch:
+            await captcher.adel_captcha_pass()
+            if user_object and hasattr(user_object, 'profile'):
+                await apply_task_async(notify_failed_login, (user_object.id,))
+            raise exc_ch
+
+        try:
+            self.check_2fa_for_user(attrs['user'], attrs.get('googlecode', None))
+        except TwoFAFailed:
+            await sync_to_async(captcher.decrease_attempts)(Wrong2FATooManyTimes)
+            raise
+
+        await captcher.adel_captcha_pass()
+
+        if user.has_known_ips and not user.is_known_ip:
+            await apply_task_async(
+                notify_user_ip_changed,
+                (user.id, ip, user_agent.ua_string),
+            )
+
+        if ip and not user.is_known_ip:
+            await KnownLoginIP.objects.abulk_create([KnownLoginIP(user=user, ip=ip)], ignore_conflicts=True)
+
+        await arecord_login(user, ip, user_agent.ua_string[:255])
+
+        logger.info(f'[User auth success] user: {attrs["user"]},  ip: {ip}, browser: {user_agent.browser}, os: {user_agent.os}, device: {user_agent.device}')
+        return attrs
+
+    @staticmethod
+    def check_login_user(user_object: User | None) -> None:
+        # User not found
+        if not user_object:
+            raise ValidationError({'message': _('Unable to log in with provided credentials.'), 'type': 'wrong_data'})
+
+        # User password was removed
+        if not user_object.password:
+            raise ValidationError({'message': _('Please reset your password'), 'type': 'reset_psw'})
+
+        if not user_object.is_active:
+            raise AccountNotActive({'message': _('User account is disabled.'), 'type': 'account_block'})
+
+    @staticmethod
+    def email_not_verified_error(token: str) -> AccountNotActive:
+        return AccountNotActive({
+            'error': 'email_not_verified',
+            'type': 'email_not_verified',
+            'token': token
+        })
+
+    @staticmethod
+    def get_resend_verification_token(user_id: int) -> str:
+        # NOTE this token is for re-requesting a verification email
+        current_token = RESEND_VERIFICATION_TOKEN_REVERSED.get(user_id)
+        if not current_token:
+            current_token = generate_random_string(32)
+            # NOTE both directions in one round trip
+            set_many([
+                (RESEND_VERIFICATION_TOKEN_REVERSED, user_id, current_token),
+                (RESEND_VERIFICATION_TOKEN, current_token, user_id),
+            ])
+        return current_token
+
+    @staticmethod
+    async def aget_resend_verification_token(user_id: int) -> str:
+        current_token = await RESEND_VERIFICATION_TOKEN_REVERSED.aget(user_id)
+        if not current_token:
+            current_token = generate_random_string(32)
+            await aset_many([
+                (RESEND_VERIFICATION_TOKEN_REVERSED, user_id, current_token),
+                (RESEND_VERIFICATION_TOKEN, current_token, user_id),
+            ])
+        return current_token
+
+    @staticmethod
+    def login_user_queryset(email: str, ip: str | None):
+        """
+        Loads everything the login flow needs in a single query: the user, its profile,
+        whether the email is verified and whether the IP was already used to log in
+        """
+        known_ips = KnownLoginIP.objects.filter(user=OuterRef('pk'))
+        return users_by_email(email, User.objects.select_related('profile')).annotate(
+            email_verified=Exists(EmailAddress.objects.filter(
+                user=OuterRef('pk'),
+                # NOTE allauth stores the address lowercased
+                email=Lower(OuterRef('email')),
+                verified=True,
+            )),
+            has_known_ips=Exists(known_ips),
+            is_known_ip=Exists(known_ips.filter(ip=ip)),
+        )
+
+    @classmethod
+    def get_login_user(cls, email: str, ip: str | None) -> User | None:
+        return cls.login_user_queryset(email, ip).first()
+
+    @staticmethod
+    def validate_email_verification_status(user, email=None):
+        # Users loaded by login_user_queryset already know if their email is verified
+        if not hasattr(user, 'email_verified'):
+            return BaseLoginSerializer.validate_email_verification_status(user, email=email)
+
+        if allauth_account_settings.EMAIL_VERIFICATION == allauth_account_settings.EmailVerificationMethod.MANDATORY \
+                and not user.email_verified:
+            raise ValidationError(_('E-mail is not verified.'))
+
     def validate_kyc(self, user: User) -> None:
         # TODO implement
         return
@@ -218,26 +346,23 @@ class RegisterSerializer(BaseRegisterSerializer):
     first_name = serializers.CharField(required=False)
     last_name = serializers.CharField(required=False)
 
-    def validate_username(self, username):        
-        if not RegisterUserCheck.validate_score_email(username):
-            raise ValidationError({
-                'message': _('similar username was recently used'),
-                'type': 'registration_similar_username'
-            })
-        return username
-
     def validate_email(self, username):
-        user_exist = User.objects.filter(email=username).first()
+        user_exist = bloom.email_may_exist(username) and users_by_email(username).exists()
         if user_exist:
             request = self._context['request']
             ip = get_client_ip(request)[0]
-            user_agent: UserAgent = get_user_agent(request)
-            os = f'({user_agent.os.family} {user_agent.os.version_string})'
-            browser = f'({user_agent.browser.family} {user_agent.browser.version_string})'
-            
-            cast(Task, notify_user_duplicate_registration).apply_async((username, ip, browser, os))
+            # NOTE the task parses the user agent, the worker LRU serves the repeated ones
+            cast(Task, notify_user_duplicate_registration).apply_async(
+                (username, ip, truncate_user_agent(request.META.get('HTTP_USER_AGENT')))
+            )
 
             raise ValidationError({'message': _('Account creation failed. Please try again later.'), 'type': 'registration_failed'})
+
+        if not RegisterUserCheck.validate_score_email(username):
+            raise ValidationError({
+                'message': _('similar email was recently used'),
+                'type': 'registration_similar_email'
+            })
         return username
 
     def validate(self, data):
@@ -294,7 +419,7 @@ class RegisterSerializer(BaseRegisterSerializer):
             profile.save()
             logger.info(f"User created with email {user.email} and username '{user.username}'")
 
-        RegisterUserCheck.update_last_emails()
+        RegisterUserCheck.add_email(user.email)
         # Return user but no tokens will be generated for inactive users
         return user
 
@@ -1,7 +1,9 @@
+from allauth.account.models import EmailAddress
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.contrib.auth import get_user_model
 
+from users import bloom
 from users.models import Profile
 
 User = get_user_model()
@@ -18,3 +20,17 @@ def save_user_profile(sender, instance, **kwargs):
     """Save the Profile instance when User is saved."""
     if hasattr(instance, 'profile'):
         instance.profile.save()
+
+
+@receiver(post_save, sender=User)
+def add_user_to_bloom(sender, instance, created, update_fields=None, **kwargs):
+    """Add the username and email to the existence Bloom filter (users/bloom.py)."""
+    if created or update_fields is None or {'username', 'email'} & set(update_fields):
+        bloom.add_user(instance)
+
+
+@receiver(post_save, sender=EmailAddress)
+def add_email_address_to_bloom(sender, instance, created, update_fields=None, **kwargs):
+    """Add the email address to the existence Bloom filter (users/bloom.py)."""
+    if created or update_fields is None or 'email' in update_fields:
+        bloom.add_email(instance.email)
@@ -0,0 +1,225 @@
+import math
+import threading
+from collections import Counter, deque
+from itertools import repeat
+
+from fuzzywuzzy import fuzz
+
+"""
+Similarity index over the recent registrations for RegisterUserCheck.
+
+max_score(text, min_score) returns the same value as
+    max(fuzz.token_sort_ratio(text, item) for item in window)
+whenever that value is min_score or more. Below min_score it returns the best score of the
+candidates it scored (or 0), which is also below min_score: validation decides the same.
+
+Items are stored token sorted (as token_sort_ratio does) with the multiset of their bigrams.
+fuzz.ratio is 2 * matches / (len(a) + len(b)), with matches at most the longest common
+subsequence l. Each character of a out of it breaks at most 2 bigrams of a, each character of b
+out of it at most 1 more, so a and b have c >= 3 * l - len(a) - len(b) - 1 common bigrams.
+A score of min_score or more, i.e. 2 * l >= r * (len(a) + len(b)) with r = (min_score - 0.5) / 100,
+needs:
+- a length ratio of at least r (length filter),
+- that many common bigrams (count filter, counted for every item over the postings of the
+  bigrams of the query).
+The survivors are scored with fuzz.ratio by decreasing upper bound of their score (from c and
+then from the common characters), stopping when no candidate left can reach min_score or beat
+the best score.
+"""
+
+Q = 2
+
+
+def process(text: str) -> str:
+    # NOTE same processing as fuzz.token_sort_ratio
+    return fuzz._process_and_sort(text, force_ascii=True)
+
+
+def qgrams(text: str) -> frozenset:
+    """
+    Bigrams numbered by occurrence (('ab', 0), ('ab', 1)...), so set intersections count multisets
+    """
+    seen = {}
+    grams = []
+    for i in range(len(text) - Q + 1):
+        gram = text[i:i + Q]
+        n = seen.get(gram, 0)
+        seen[gram] = n + 1
+        grams.append((gram, n))
+    return frozenset(grams)
+
+
+def min_common_qgrams(length: int, other: int, ratio: float) -> int:
+    """
+    Common bigrams needed for a longest common subsequence of ratio * (length + other) / 2
+    """
+    total = length + other
+    lcs = math.ceil(ratio * total / 2 - 1e-9)
+    return (2 * Q - 1) * lcs - (Q - 1) * (total + 1)
+
+
+def score_upper_bound(length: int, other: int, common: int) -> int:
+    """
+    Upper bound of fuzz.ratio for strings of those lengths with that many common bigrams
+    """
+    total = length + other
+    if not total:
+        return 0
+    lcs = min(length, other, (common + (Q - 1) * (total + 1)) // (2 * Q - 1))
+    return round(200 * lcs / total)
+
+
+def length_range(length: int, ratio: float) -> range:
+    """
+    Lengths with 2 * min / (length + other) >= ratio, ratio > 0
+    """
+    low = length * ratio / (2 - ratio)
+    high = length * (2 - ratio) / ratio
+    return range(int(-(-low // 1)), int(high) + 1)
+
+
+def brute_force_max_score(text: str, items) -> int:
+    """
+    The previous RegisterUserCheck.get_score_email, to compare with
+    """
+    return max((fuzz.token_sort_ratio(text, item) for item in items), default=0)
+
+
+class SimilarityIndex:
+    """
+    Window of the most recent items (newest first), kept in sync with a list by sync()
+    """
+
+    def __init__(self):
+        self._items: list[str] = []
+        self._slots: deque[int] = deque()
+        self._next_slot = 0
+        self._processed: dict[int, str] = {}
+        self._grams: dict[int, frozenset] = {}
+        self._chars: dict[int, Counter] = {}
+        self._postings: dict[tuple, set[int]] = {}
+        self._by_length: dict[int, set[int]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def _add(self, item: str) -> int:
+        slot = self._next_slot
+        self._next_slot += 1
+        processed = process(item)
+        grams = qgrams(processed)
+        self._processed[slot] = processed
+        self._grams[slot] = grams
+        self._chars[slot] = Counter(processed)
+        for gram in grams:
+            self._postings.setdefault(gram, set()).add(slot)
+        self._by_length.setdefault(len(processed), set()).add(slot)
+        return slot
+
+    def _remove(self, slot: int) -> None:
+        processed = self._processed.pop(slot)
+        del self._chars[slot]
+        for gram in self._grams.pop(slot):
+            posting = self._postings[gram]
+            posting.discard(slot)
+            if not posting:
+                del self._postings[gram]
+        by_length = self._by_length[len(processed)]
+        by_length.discard(slot)
+        if not by_length:
+            del self._by_length[len(processed)]
+
+    def _rebuild(self, items: list[str]) -> None:
+        self._slots.clear()
+        self._processed.clear()
+        self._grams.clear()
+        self._chars.clear()
+        self._postings.clear()
+        self._by_length.clear()
+        for item in items:
+            self._slots.append(self._add(item))
+        self._items = list(items)
+
+    def sync(self, items: list[str]) -> 'SimilarityIndex':
+        """
+        Makes the window equal to items (newest first). When items is the window with a few new
+        items at the head and as many old ones dropped at the tail, only those are indexed/removed
+        """
+        with self._lock:
+            if items == self._items:
+                return self
+            old = self._items
+            shift = items.index(old[0]) if old and old[0] in items[:len(items) // 2 + 1] else -1
+            keep = len(items) - shift
+            if shift > 0 and keep <= len(old) and items[shift:] == old[:keep]:
+                for _ in range(len(old) - keep):
+                    self._remove(self._slots.pop())
+                for item in reversed(items[:shift]):
+                    self._slots.appendleft(self._add(item))
+                self._items = list(items)
+            else:
+                self._rebuild(items)
+        return self
+
+    def candidates(self, processed: str, grams: frozenset, ratio: float) -> list[tuple[int, int]]:
+        """
+        (score upper bound, slot) of the items that pass the length and count filters
+        """
+        length = len(processed)
+        lengths = [other for other in length_range(length, ratio) if other in self._by_length] \
+            if ratio > 0 else list(self._by_length)
+        if not lengths:
+            return []
+        thresholds = {other: min_common_qgrams(length, other, ratio) for other in lengths}
+        min_threshold = min(thresholds.values())
+
+        # NOTE counting the postings of every bigram of the query (C loop in Counter.update) is
+        # cheaper than intersecting the bigrams of each item that a prefix filter lets through
+        counts = Counter()
+        for gram in grams:
+            counts.update(self._postings.get(gram, ()))
+        if min_threshold <= 0:
+            # NOTE short strings can match without a common bigram, every item of those lengths is checked
+            slots = set().union(*(self._by_length[other] for other in lengths))
+        else:
+            slots = [slot for slot, common in counts.items() if common >= min_threshold]
+
+        result = []
+        for slot in slots:
+            other = len(self._processed[slot])
+            threshold = thresholds.get(other)
+            if threshold is None:
+                continue
+            common = counts[slot]
+            if common < threshold:
+                continue
+            result.append((score_upper_bound(length, other, common), slot))
+        return result
+
+    def max_score(self, text: str, min_score: int) -> int:
+        processed = process(text)
+        if not processed:
+            # NOTE token_sort_ratio gives 100 for two strings without tokens, 0 against any other
+            return 100 if 0 in self._by_length else 0
+        grams = qgrams(processed)
+        chars = Counter(processed)
+        char_counts = list(chars.values())
+        ratio = (min_score - 0.5) / 100
+
+        with self._lock:
+            candidates = self.candidates(processed, grams, ratio)
+            candidates.sort(reverse=True)
+            best = 0
+            for upper_bound, slot in candidates:
+                # NOTE scores below min_score only need to stay below it, they are not maximized
+                floor = max(best, min_score - 1)
+                if upper_bound <= floor:
+                    break
+                other = self._processed[slot]
+                # NOTE common characters bound the matches too, cheaper than fuzz.ratio
+                matches = sum(map(min, char_counts, map(self._chars[slot].get, chars, repeat(0))))
+                if round(200 * matches / (len(processed) + len(other))) <= floor:
+                    continue
+                best = max(best, fuzz.ratio(processed, other))
+        return best
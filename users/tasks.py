@@ -1,4 +1,7 @@
 import logging
+from smtplib import SMTPException
+
+from allauth.account.adapter import get_adapter
 from celery import shared_task
 from django.db.models import Model
 from django.conf import settings
@@ -8,21 +11,25 @@ from django.utils import timezone
 from django.utils.translation import gettext as _
 from django.contrib.auth import get_user_model
 
+from users import login_history, partitions, utils
+from users.user_agent import parse_user_agent
+
 logger = logging.getLogger(__name__)
 
 User: Model = get_user_model()
 
 @shared_task
-def notify_user_duplicate_registration(username, ip, browser, os):
+def notify_user_duplicate_registration(username, ip, ua_string):
     """
     Send email to user that there was an attempt to register an account with his email
     """
     now = timezone.now()
+    user_agent = parse_user_agent(ua_string)
     params = {
         'username': username,
         'ip_address': ip,
-        'browser': browser,
-        'os': os,
+        'browser': user_agent.browser,
+        'os': user_agent.os,
         'time': now
     }
     subject = loader.get_template(f'accounts/duplicate_account_registration.txt').render()
@@ -40,20 +47,21 @@ def notify_user_duplicate_registration(username, ip, browser, os):
 
 
 @shared_task
-def notify_user_ip_changed(user_id, ip, device, os, browser):
+def notify_user_ip_changed(user_id, ip, ua_string):
     """
     Send email to user that there was an attempt to login from a new ip address
     """
     now = timezone.now()
     user = User.objects.filter(pk=user_id).first()
     lang = user.profile.language
+    user_agent = parse_user_agent(ua_string)
 
     params = {
         'username': user.username,
         'ip_address': ip,
-        'device': device,
-        'os': os,
-        'browser': browser,
+        'device': user_agent.device_type,
+        'os': user_agent.os,
+        'browser': user_agent.browser,
         'time': now
     }
 
@@ -90,4 +98,36 @@ def notify_failed_login(user_id):
         [user.email],
         html_message=msg,
         fail_silently=False
-    )
\ No newline at end of file
+    )
+
+
+@shared_task
+def flush_login_history():
+    """
+    Write the buffered logins to LoginHistory (only used with settings.LOGIN_HISTORY_BUFFERED)
+    """
+    return login_history.flush_login_history()
+
+
+@shared_task
+def ensure_login_history_partitions():
+    """
+    Create the LoginHistory partitions of the next months before rows need them
+    """
+    return partitions.ensure_login_history_partitions()
+
+
+@shared_task
+def refill_username_pool():
+    """
+    Top up the pool of free usernames that registrations fall back to
+    """
+    return utils.refill_username_pool()
+
+
+@shared_task(autoretry_for=(SMTPException, OSError), retry_backoff=True, max_retries=5)
+def send_account_email(template_prefix, email, data, lang):
+    """
+    Render and send an allauth email queued by users.auth.adapters.AccountAdapter.send_mail
+    """
+    get_adapter().send_mail_now(template_prefix, email, data, lang)
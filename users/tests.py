@@ -1,3 +1,906 @@
-from django.test import TestCase
+import csv
+import gzip
+import json
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone as dt_timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from importlib import import_module
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from allauth.account.forms import default_token_generator
+from allauth.account.models import EmailAddress, EmailConfirmation
+from allauth.account.utils import user_pk_to_url_str
+from allauth.core.context import request_context
+from asgiref.sync import async_to_sync
+from dj_rest_auth.forms import AllAuthPasswordResetForm
+from django.conf import settings
+from django.contrib.auth import authenticate, aauthenticate, get_user_model
+from django.contrib.auth import hashers
+from django.contrib.auth.hashers import make_password
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.core.cache import caches
+from django.core import mail
+from django.db import DatabaseError, connection
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, override_settings
+from django.utils import timezone
+from redis.crc import key_slot
+from redis.exceptions import RedisError
+from rest_framework.exceptions import ValidationError
+from rest_framework.request import Request
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from backend.bloom import RedisBloomFilter
+from backend.cache import redis_client
+from users import bloom, partitions, user_agent
+from users.async_views import (
+    AsyncLoginView, AsyncResendEmailConfirmationView, AsyncTokenRefreshView, AsyncVerifyEmailView,
+)
+from users.cache_keys import RESEND_VERIFICATION_IN_PROGRESS, RESEND_VERIFICATION_TOKEN
+from users.captcha import CaptchaProcessor
+from users.auth.hashing import PasswordHashingPool, acheck_user_password, check_user_password, hashing_pool
+from users.exceptions import MaxCaptchaSkipAttempts, PasswordHashingBusy
+from users.login_history import arecord_login, flush_login_history, record_login
+from users.models import LoginHistory, KnownLoginIP
+from users.recaptcha import RecaptchaVerifier
+from users.serializers.auth import LoginSerializer
+from users.tasks import notify_user_duplicate_registration, send_account_email
+from users.throttling import AuthEndpointThrottle
+from users.similarity import SimilarityIndex, brute_force_max_score
+from users.utils import RegisterUserCheck, generate_cool_username, recent_emails_fill, refill_username_pool
+
+User = get_user_model()
+
+# Max queries a login is allowed to run, raise it only with a good reason
+LOGIN_QUERY_BUDGET = 2
+NEW_IP_LOGIN_QUERY_BUDGET = 3
+FAILED_LOGIN_QUERY_BUDGET = 1
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+)
+class LoginQueryBudgetTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='SwiftAce10', email='user@example.com', password='secret-pass')
+        EmailAddress.objects.create(user=cls.user, email=cls.user.email, verified=True, primary=True)
+        KnownLoginIP.objects.create(user=cls.user, ip='10.0.0.1')
+
+    def login(self, email, password, ip='10.0.0.1'):
+        request = RequestFactory().post('/auth/login/', REMOTE_ADDR=ip, HTTP_USER_AGENT='Mozilla/5.0')
+        serializer = LoginSerializer(data={'email': email, 'password': password}, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        return serializer.validated_data['user']
+
+    def test_login_query_budget(self):
+        with self.assertNumQueries(LOGIN_QUERY_BUDGET):
+            user = self.login('User@Example.com', 'secret-pass')
+
+        self.assertEqual(user, self.user)
+        self.assertTrue(LoginHistory.objects.filter(user=self.user, ip='10.0.0.1').exists())
+
+    @mock.patch('users.serializers.auth.notify_user_ip_changed')
+    def test_new_ip_login_query_budget(self, notify_user_ip_changed):
+        with self.assertNumQueries(NEW_IP_LOGIN_QUERY_BUDGET):
+            self.login('user@example.com', 'secret-pass', ip='10.0.0.2')
+
+        notify_user_ip_changed.apply_async.assert_called_once_with((self.user.id, '10.0.0.2', 'Mozilla/5.0'))
+        self.assertTrue(KnownLoginIP.objects.filter(user=self.user, ip='10.0.0.2').exists())
+
+        # The second login from the same IP is not reported
+        notify_user_ip_changed.reset_mock()
+        with self.assertNumQueries(LOGIN_QUERY_BUDGET):
+            self.login('user@example.com', 'secret-pass', ip='10.0.0.2')
+        notify_user_ip_changed.apply_async.assert_not_called()
+
+    @mock.patch('users.serializers.auth.notify_failed_login')
+    def test_failed_login_query_budget(self, notify_failed_login):
+        with self.assertNumQueries(FAILED_LOGIN_QUERY_BUDGET), self.assertRaises(ValidationError):
+            self.login('user@example.com', 'wrong-pass')
+
+        notify_failed_login.apply_async.assert_called_once_with((self.user.id,))
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class PasswordHashingTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='SwiftAce10', email='user@example.com')
+        # NOTE a salt too short for the hasher, a correct check saves a new hash
+        cls.user.password = make_password('secret-pass', salt='short', hasher='md5')
+        cls.user.save()
+
+    def test_check_user_password(self):
+        old_hash = self.user.password
+        self.assertFalse(check_user_password(self.user, 'wrong-pass'))
+        self.assertTrue(check_user_password(self.user, 'secret-pass'))
+        self.user.refresh_from_db()
+        self.assertNotEqual(self.user.password, old_hash)
+        self.assertTrue(check_user_password(self.user, 'secret-pass'))
+
+    async def test_acheck_user_password(self):
+        old_hash = self.user.password
+        threads = []
+
+        def make_password(password):
+            threads.append(threading.current_thread().name)
+            return hashers.make_password(password)
+
+        self.assertFalse(await acheck_user_password(self.user, 'wrong-pass'))
+        with mock.patch('users.auth.hashing.make_password', make_password):
+            self.assertTrue(await acheck_user_password(self.user, 'secret-pass'))
+        await self.user.arefresh_from_db()
+        self.assertNotEqual(self.user.password, old_hash)
+        # NOTE the upgraded hash is computed on the pool, not on the event loop
+        self.assertEqual(len(threads), 1)
+        self.assertTrue(threads[0].startswith('password-hashing'))
+
+    def test_upgrade_skipped_while_busy(self):
+        old_hash = self.user.password
+        with mock.patch.object(hashing_pool, 'encode', side_effect=PasswordHashingBusy):
+            self.assertTrue(check_user_password(self.user, 'secret-pass'))
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.password, old_hash)
+
+    def test_unknown_email_is_hashed_too(self):
+        # NOTE same work as a wrong password, the response time does not tell which emails exist
+        calls = hashing_pool.stats()['calls']
+        self.assertIsNone(authenticate(email='nobody@example.com', password='secret-pass'))
+        self.assertIsNone(async_to_sync(aauthenticate)(email='nobody@example.com', password='secret-pass'))
+        self.assertEqual(hashing_pool.stats()['calls'], calls + 2)
+        self.assertEqual(authenticate(email='User@Example.com', password='secret-pass'), self.user)
+        # The check and the upgrade of the short salt hash
+        self.assertEqual(hashing_pool.stats()['calls'], calls + 4)
+
+    def test_full_queue_fails_fast(self):
+        pool = PasswordHashingPool(max_workers=1, queue_size=1)
+        release = threading.Event()
+        running = [pool.submit(release.wait) for _ in range(2)]
+
+        with self.assertRaises(PasswordHashingBusy):
+            pool.verify('secret-pass', self.user.password)
+        release.set()
+        self.assertTrue(all(future.result() for future in running))
+        self.assertEqual((pool.stats()['rejected'], pool.stats()['in_flight']), (1, 0))
+        self.assertTrue(pool.verify('secret-pass', self.user.password)[0])
+
+    @override_settings(CACHE_METRICS_TOKEN='secret')
+    def test_metrics_view(self):
+        self.assertIn(self.client.get('/metrics/password-hashing/').status_code, (401, 403))
+        response = self.client.get('/metrics/password-hashing/', HTTP_AUTHORIZATION='Metrics secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(f'password_hashing_workers {hashing_pool.max_workers}', response.content.decode())
+
+
+class UserAgentTests(TestCase):
+    CHROME = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/129.0.0.0 Safari/537.36'
+
+    def setUp(self):
+        user_agent._parse_cached.cache_clear()
+
+    def test_parsed_once_per_process(self):
+        with mock.patch('users.user_agent.parse', wraps=user_agent.parse) as parse:
+            first = user_agent.parse_user_agent(self.CHROME)
+            self.assertEqual(user_agent.parse_user_agent(self.CHROME), first)
+        parse.assert_called_once_with(self.CHROME)
+        self.assertEqual((first.device_type, first.is_bot), ('PC', False))
+        self.assertTrue(first.browser.startswith('(Chrome 129'))
+
+    def test_memory_is_bounded(self):
+        # NOTE every request can send a new user agent, neither their number nor their length grows the cache
+        for i in range(settings.USER_AGENT_CACHE_SIZE + 10):
+            user_agent.parse_user_agent(f'{self.CHROME} {i}')
+        self.assertEqual(user_agent._parse_cached.cache_info().currsize, settings.USER_AGENT_CACHE_SIZE)
+
+        parsed = user_agent.parse_user_agent('x' * 10_000)
+        self.assertEqual(len(parsed.ua_string), user_agent.MAX_USER_AGENT_LENGTH)
+        self.assertEqual(user_agent.parse_user_agent(None).ua_string, '')
+
+    @override_settings(
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        USER_AGENT_REDIS_CACHE=True,
+    )
+    def test_shared_cache(self):
+        parsed = user_agent.parse_user_agent(self.CHROME)
+        # Another worker, its LRU is empty
+        user_agent._parse_cached.cache_clear()
+        with mock.patch('users.user_agent.parse') as parse:
+            self.assertEqual(user_agent.parse_user_agent(self.CHROME), parsed)
+        parse.assert_not_called()
+
+    @mock.patch('users.tasks.send_mail')
+    def test_notification_tasks_parse(self, send_mail):
+        notify_user_duplicate_registration('user@example.com', '10.0.0.1', self.CHROME)
+        self.assertIn('Chrome 129', send_mail.call_args.kwargs['html_message'])
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+    ALLOWED_HOSTS=['example.com'],
+)
+class AsyncAuthViewsTests(TestCase):
+    """
+    The views are called directly, users.urls only routes to them with AUTH_ASYNC_VIEWS
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='SwiftAce10', email='user@example.com', password='secret-pass')
+        EmailAddress.objects.create(user=cls.user, email=cls.user.email, verified=True, primary=True)
+        KnownLoginIP.objects.create(user=cls.user, ip='10.0.0.1')
+
+    async def post(self, view, data, cookies=None):
+        factory = AsyncRequestFactory()
+        factory.cookies.load(cookies or {})
+        request = factory.post('/', data, content_type='application/json', headers={'user-agent': 'Mozilla/5.0'})
+        request.META.update(REMOTE_ADDR='10.0.0.1', HTTP_HOST='example.com')
+        # NOTE what the session and messages middlewares would add
+        request.session = import_module(settings.SESSION_ENGINE).SessionStore()
+        request._messages = FallbackStorage(request)
+        with request_context(request):
+            response = await view.as_view()(request)
+        return response, json.loads(response.content)
+
+    @mock.patch('users.serializers.auth.notify_failed_login')
+    async def test_login(self, _):
+        response, data = await self.post(AsyncLoginView, {'email': 'User@Example.com', 'password': 'secret-pass'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['user']['email'], 'user@example.com')
+        self.assertEqual(RefreshToken(data['refresh'])['user_id'], str(self.user.pk))
+        self.assertIn('jwt_auth_token', response.cookies)
+        self.assertTrue(await LoginHistory.objects.filter(user=self.user, ip='10.0.0.1').aexists())
+
+        response, data = await self.post(AsyncLoginView, {'email': 'user@example.com', 'password': 'wrong-pass'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['type'], ['wrong_data'])
+
+    async def test_login_while_hashing_is_busy(self):
+        with mock.patch.object(hashing_pool, 'queue_size', -hashing_pool.max_workers):
+            response, data = await self.post(AsyncLoginView, {'email': 'user@example.com', 'password': 'secret-pass'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(data['type'], 'password_hashing_busy')
+
+    async def test_token_refresh(self):
+        refresh = RefreshToken.for_user(self.user)
+        response, data = await self.post(AsyncTokenRefreshView, {'refresh': str(refresh)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(RefreshToken(data['refresh'])['user_id'], str(self.user.pk))
+        self.assertNotEqual(data['refresh'], str(refresh))
+
+        # From the cookie when the body has none
+        response, data = await self.post(AsyncTokenRefreshView, {}, cookies={'jwt_refresh_token': str(refresh)})
+        self.assertEqual(response.status_code, 200)
+
+        response, data = await self.post(AsyncTokenRefreshView, {'refresh': 'invalid'})
+        self.assertEqual(response.status_code, 401)
+
+    async def test_verify_email(self):
+        user = await User.objects.acreate(username='CalmOwl11', email='new@example.com', password='x')
+        email_address = await EmailAddress.objects.acreate(user=user, email=user.email)
+        confirmation = await EmailConfirmation.objects.acreate(
+            email_address=email_address, key='confirmation-key', sent=timezone.now(),
+        )
+
+        response, data = await self.post(AsyncVerifyEmailView, {'key': 'wrong-key'})
+        self.assertEqual(response.status_code, 404)
+
+        response, data = await self.post(AsyncVerifyEmailView, {'key': confirmation.key})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(RefreshToken(data['refresh_token'])['user_id'], str(user.pk))
+        await email_address.arefresh_from_db()
+        self.assertTrue(email_address.verified)
+
+    @mock.patch('users.auth.adapters.send_account_email')
+    async def test_resend_email_confirmation(self, _):
+        user = await User.objects.acreate(username='CalmOwl11', email='New@example.com', password='x')
+        email_address = await EmailAddress.objects.acreate(user=user, email='new@example.com')
+        await RESEND_VERIFICATION_TOKEN.aset('resend-token', user.pk)
+
+        response, data = await self.post(AsyncResendEmailConfirmationView, {'token': 'unknown'})
+        self.assertEqual(data, {'Status': False, 'code': 'Token not found'})
+
+        response, data = await self.post(AsyncResendEmailConfirmationView, {'token': 'resend-token'})
+        self.assertEqual(data, {'Status': True})
+        self.assertTrue(await EmailConfirmation.objects.filter(email_address=email_address).aexists())
+        self.assertEqual(await RESEND_VERIFICATION_IN_PROGRESS.aget(user.pk), 1)
+
+        response, data = await self.post(AsyncResendEmailConfirmationView, {'token': 'resend-token'})
+        self.assertEqual(data, {'Status': False, 'code': 'Email confirmation in progress'})
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    AUTH_THROTTLE_RATES={'rest_login': {'ip': '30/minute', 'email': '2/minute', 'endpoint': '3000/minute'}},
+    THROTTLE_EXEMPT_NETWORKS=['10.0.0.0/8'],
+    IP_ALLOWLIST_RELOAD_INTERVAL=0,
+)
+class AuthEndpointThrottleTests(TestCase):
+
+    def auth_calls(self, script) -> list[dict]:
+        return [call.kwargs for call in script.call_args_list if call.kwargs['keys'][0].startswith('throttle:auth:')]
+
+    def login(self, email, ip='192.0.2.1'):
+        return self.client.post('/auth/login/', {'email': email, 'password': 'wrong-pass'}, REMOTE_ADDR=ip)
+
+    @mock.patch('users.serializers.auth.notify_failed_login')
+    def test_limits_per_endpoint_ip_and_email(self, _):
+        with mock.patch('core.throttling.sliding_window_script', return_value=0) as script:
+            self.login(' User@Example.com')
+        [call] = self.auth_calls(script)
+        self.assertEqual(call['keys'], [
+            'throttle:auth:{rest_login:ip:192.0.2.1}',
+            'throttle:auth:{rest_login:email:user@example.com}',
+            'throttle:auth:{rest_login}',
+        ])
+        self.assertEqual(call['args'][1:], [30, 60000, 2, 60000, 3000, 60000])
+
+        # Endpoints without rates are not limited
+        with mock.patch('core.throttling.sliding_window_script', return_value=0) as script:
+            self.client.post('/auth/logout/')
+        self.assertEqual(self.auth_calls(script), [])
+
+    @mock.patch('users.serializers.auth.notify_failed_login')
+    def test_cluster_spreads_the_keys(self, _):
+        # NOTE one script call per hash tag, the endpoint key is not recorded once a client key rejects
+        with mock.patch('core.throttling.redis_connections.mode', return_value='cluster'), \
+                mock.patch('core.throttling.sliding_window_script',
+                           side_effect=lambda keys, args: 1500 if ':email:' in keys[0] else 0) as script:
+            self.assertEqual(self.login('user@example.com').status_code, 429)
+        self.assertEqual([call['keys'] for call in self.auth_calls(script)], [
+            ['throttle:auth:{rest_login:ip:192.0.2.1}'],
+            ['throttle:auth:{rest_login:email:user@example.com}'],
+        ])
+        self.assertEqual(len({key_slot(call['keys'][0].encode()) for call in self.auth_calls(script)}), 2)
+
+    def test_unparsable_body(self):
+        # The body is parsed only for the endpoints with an email rate, one that does not parse has no email limit
+        with mock.patch('core.throttling.sliding_window_script', return_value=0) as script:
+            response = self.client.post('/auth/login/', '{"email', content_type='application/json', REMOTE_ADDR='192.0.2.1')
+        self.assertEqual(response.status_code, 400)
+        [call] = self.auth_calls(script)
+        self.assertEqual(call['keys'], ['throttle:auth:{rest_login:ip:192.0.2.1}', 'throttle:auth:{rest_login}'])
+
+        with override_settings(AUTH_THROTTLE_RATES={'rest_login': {'ip': '30/minute'}}), \
+                mock.patch('rest_framework.request.Request._load_data_and_files') as load_data:
+            request = Request(RequestFactory().post('/auth/login/', REMOTE_ADDR='192.0.2.1'))
+            request.resolver_match = SimpleNamespace(url_name='rest_login')
+            self.assertEqual(list(AuthEndpointThrottle().get_limits(request, None)), ['{rest_login:ip:192.0.2.1}'])
+        load_data.assert_not_called()
+
+    def test_retry_after(self):
+        with mock.patch('core.throttling.sliding_window_script', return_value=1500):
+            response = self.login('user@example.com')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '2')
+
+    @mock.patch('users.serializers.auth.notify_failed_login')
+    def test_fails_open_and_exempt(self, _):
+        with mock.patch('core.throttling.sliding_window_script', side_effect=RedisError), \
+                self.assertLogs('core.throttling', 'ERROR'):
+            self.assertEqual(self.login('user@example.com').status_code, 400)
+
+        with mock.patch('core.throttling.sliding_window_script', return_value=1500) as script:
+            self.assertEqual(self.login('user@example.com', ip='10.0.0.1').status_code, 400)
+        script.assert_not_called()
+
+    @mock.patch('users.serializers.auth.notify_failed_login')
+    def test_email_limit(self, _):
+        try:
+            redis_client.ping()
+        except Exception:
+            self.skipTest('needs a local Redis')
+        redis_client.delete('throttle:auth:{rest_login:email:user@example.com}')
+
+        # NOTE a new IP per request, only the email limit applies
+        statuses = [self.login('User@example.com', ip=f'192.0.2.{i}').status_code for i in range(3)]
+        self.assertEqual(statuses, [400, 400, 429])
+        self.assertEqual(self.login('other@example.com', ip='192.0.2.9').status_code, 400)
+
+
+@override_settings(LOGIN_HISTORY_BUFFERED=True)
+class LoginHistoryBufferTests(TestCase):
+    """
+    Runs against the local Redis from settings.REDIS, skipped when it is not reachable
+    """
+    keys = {
+        'LOGIN_HISTORY_BUFFER_KEY': '{test_login_history}:buffer',
+        'LOGIN_HISTORY_PROCESSING_KEY': '{test_login_history}:processing',
+        'LOGIN_HISTORY_FLUSH_LOCK_KEY': '{test_login_history}:flush_lock',
+        'LOGIN_HISTORY_DEAD_LETTER_KEY': '{test_login_history}:dead_letter',
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='SwiftAce10', email='user@example.com', password='x')
+
+    def setUp(self):
+        try:
+            redis_client.ping()
+        except Exception:
+            self.skipTest('needs a local Redis')
+        patcher = mock.patch.multiple('users.login_history', **self.keys)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(redis_client.delete, *self.keys.values())
+
+    def test_record_and_flush(self):
+        record_login(self.user, '10.0.0.1', 'Mozilla/5.0')
+        async_to_sync(arecord_login)(self.user, '10.0.0.2', 'Mozilla/5.0')
+        self.assertFalse(LoginHistory.objects.exists())
+
+        self.assertEqual(flush_login_history(batch_size=1), 2)
+        self.assertEqual(set(LoginHistory.objects.values_list('ip', flat=True)), {'10.0.0.1', '10.0.0.2'})
+        self.assertEqual(flush_login_history(), 0)
+
+    def test_crashed_flush_is_replayed(self):
+        record_login(self.user, '10.0.0.1', 'Mozilla/5.0')
+        with mock.patch.object(LoginHistory.objects, 'bulk_create', side_effect=RuntimeError), self.assertRaises(RuntimeError):
+            flush_login_history()
+        self.assertEqual(redis_client.llen(self.keys['LOGIN_HISTORY_PROCESSING_KEY']), 1)
+
+        self.assertEqual(flush_login_history(), 1)
+        self.assertEqual(LoginHistory.objects.count(), 1)
+        self.assertEqual(redis_client.llen(self.keys['LOGIN_HISTORY_PROCESSING_KEY']), 0)
+
+    def test_bad_events_do_not_block_the_buffer(self):
+        deleted = User.objects.create_user(username='CalmOwl11', email='gone@example.com', password='x')
+        record_login(deleted, '10.0.0.1', 'Mozilla/5.0')
+        deleted.delete()
+        record_login(self.user, '10.0.0.2', 'Mozilla/5.0')
+        record_login(self.user, '10.0.0.3', 'Mozilla/5.0')
+        redis_client.rpush(self.keys['LOGIN_HISTORY_BUFFER_KEY'], 'not json')
+
+        # A row the database rejects (e.g. no partition for its month) only fails itself
+        save = LoginHistory.save
+
+        def reject_10_0_0_3(row, *args, **kwargs):
+            if row.ip == '10.0.0.3':
+                raise DatabaseError('no partition of relation "users_loginhistory" found for row')
+            return save(row, *args, **kwargs)
+
+        with mock.patch.object(LoginHistory.objects, 'bulk_create', side_effect=DatabaseError('no partition')), \
+                mock.patch.object(LoginHistory, 'save', reject_10_0_0_3):
+            self.assertEqual(flush_login_history(), 1)
+
+        self.assertEqual(list(LoginHistory.objects.values_list('ip', flat=True)), ['10.0.0.2'])
+        dead_letter = redis_client.lrange(self.keys['LOGIN_HISTORY_DEAD_LETTER_KEY'], 0, -1)
+        self.assertEqual([json.loads(event)['ip'] if event != b'not json' else None for event in dead_letter], [None, '10.0.0.3'])
+        self.assertEqual(redis_client.llen(self.keys['LOGIN_HISTORY_BUFFER_KEY']), 0)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'needs PostgreSQL, migration 0003 partitions LoginHistory')
+class LoginHistoryPartitionsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='SwiftAce10', email='user@example.com', password='x')
+
+    def test_ensure_partitions(self):
+        self.assertTrue(partitions.is_partitioned())
+        partitions.ensure_login_history_partitions(months_ahead=1)
+        current = partitions.month_start(timezone.now().date())
+        names = {name for name, _ in partitions.list_partitions()}
+        self.assertIn(partitions.partition_name(current), names)
+        self.assertIn(partitions.partition_name(partitions.add_months(current, 1)), names)
+
+    def test_create_export_and_drop(self):
+        # NOTE far ahead, the default partition can not hold rows of that month
+        month = partitions.add_months(partitions.month_start(timezone.now().date()), 60)
+        name = partitions.create_partition(month)
+        self.assertIn((name, month), partitions.list_partitions())
+
+        timestamp = datetime(month.year, month.month, 2, tzinfo=dt_timezone.utc)
+        LoginHistory.objects.create(user=self.user, ip='10.0.0.1', user_agent='Mozilla/5.0', timestamp=timestamp)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / f'{name}.csv.gz'
+            partitions.export_partition(name, path)
+            with gzip.open(path, 'rt', newline='') as file:
+                rows = list(csv.DictReader(file))
+        self.assertEqual([(row['user_id'], row['ip']) for row in rows], [(str(self.user.pk), '10.0.0.1')])
+
+        partitions.drop_partition(name)
+        self.assertNotIn((name, month), partitions.list_partitions())
+        self.assertFalse(LoginHistory.objects.filter(timestamp=timestamp).exists())
+
+
+class RecaptchaStubHandler(BaseHTTPRequestHandler):
+    """
+    Local stand-in for the siteverify endpoint, tokens starting with 'ok' are valid and 'slow' ones hang
+    """
+    calls = 0
+
+    def do_POST(self):
+        RecaptchaStubHandler.calls += 1
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        if 'response=slow' in body:
+            time.sleep(1)
+        payload = json.dumps({'success': 'response=ok' in body}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class RecaptchaVerifierTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), RecaptchaStubHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        RecaptchaStubHandler.calls = 0
+        self.verifier = RecaptchaVerifier(
+            url=f'http://127.0.0.1:{self.server.server_port}/siteverify',
+            secret='secret',
+            connect_timeout=0.5,
+            read_timeout=0.2,
+            pool_size=2,
+            cache_timeout=60,
+        )
+
+    def test_valid_token_is_not_cached(self):
+        # NOTE a cached success could be replayed, Google is asked again (and rejects a used token)
+        self.verifier.verify('ok-token', remote_ip='1.1.1.1')
+        self.verifier.verify('ok-token', remote_ip='1.1.1.1')
+        self.assertEqual(RecaptchaStubHandler.calls, 2)
+
+    def test_invalid_token_is_cached(self):
+        for _ in range(2):
+            with self.assertRaises(ValidationError) as ctx:
+                self.verifier.verify('bad-token', remote_ip='1.1.1.1')
+            self.assertEqual(ctx.exception.detail['type'], 'bad_captcha')
+        self.assertEqual(RecaptchaStubHandler.calls, 1)
+
+        # The cached result is only for the same IP
+        with self.assertRaises(ValidationError):
+            async_to_sync(self.verifier.averify)('bad-token', remote_ip='2.2.2.2')
+        self.assertEqual(RecaptchaStubHandler.calls, 2)
+
+    def test_slow_upstream_times_out(self):
+        start = time.perf_counter()
+        with self.assertRaises(ValidationError) as ctx:
+            self.verifier.verify('slow-token')
+        self.assertEqual(ctx.exception.detail['type'], 'captcha_unavailable')
+        self.assertLess(time.perf_counter() - start, 1)
+
+
+@override_settings(CACHES={
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': f"redis://{settings.REDIS['host']}:{settings.REDIS['port']}/0",
+        'KEY_PREFIX': 'test_captcha',
+        'OPTIONS': {
+            'PASSWORD': settings.REDIS['pwd'],
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+        },
+    },
+})
+class CaptchaAttemptsTests(TestCase):
+    """
+    Runs against the local Redis from settings.REDIS, skipped when it is not reachable
+    """
+
+    def setUp(self):
+        try:
+            caches['default'].client.get_client().ping()
+        except Exception:
+            self.skipTest('needs a local Redis')
+        self.captcher = CaptchaProcessor('user@example.com', '10.0.0.1', None)
+        self.addCleanup(self.captcher.del_captcha_pass)
+
+    def test_concurrent_decrease_attempts(self):
+        self.captcher.set_captcha_passed()
+        ckey = CaptchaProcessor.cache_key(self.captcher.get_ckey())
+        threads = CaptchaProcessor.MAX_ERROR_ATTEMPTS - 1
+        barrier = threading.Barrier(threads)
+
+        def decrease(_):
+            barrier.wait()
+            CaptchaProcessor('user@example.com', '10.0.0.1', None).decrease_attempts()
+
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(decrease, range(threads)))
+
+        # No decrement was lost, only the last attempt is left
+        self.assertEqual(caches['default'].get(ckey), 1)
+        with self.assertRaises(MaxCaptchaSkipAttempts):
+            self.captcher.decrease_attempts()
+        self.assertFalse(self.captcher.is_captcha_passed())
+
+        # Without a captcha pass there is nothing to decrease
+        self.captcher.decrease_attempts()
+
+    def test_decrease_keeps_ttl(self):
+        self.captcher.set_captcha_passed()
+        # A second pass does not reset the attempts
+        self.captcher.decrease_attempts()
+        self.captcher.set_captcha_passed()
+
+        ckey = CaptchaProcessor.cache_key(self.captcher.get_ckey())
+        self.assertEqual(caches['default'].get(ckey), CaptchaProcessor.MAX_ERROR_ATTEMPTS - 1)
+        self.assertTrue(0 < caches['default'].ttl(ckey) <= 180)
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    CAPTCHA_ALLOWED_NETWORKS=['10.0.0.0/8'],
+)
+class CaptchaAllowlistTests(TestCase):
+
+    async def test_async_check_compiles_the_allowlist_in_a_thread(self):
+        self.assertFalse(await CaptchaProcessor('user@example.com', '10.0.0.1', None).ais_captcha_required())
+        self.assertTrue(await CaptchaProcessor('user@example.com', '192.168.0.1', None).ais_captcha_required())
+
+
+class SimilarityIndexTests(TestCase):
+
+    def test_same_decision_as_brute_force(self):
+        rng = random.Random(0)
+        alphabet = 'abcde 12@.'
+        window = [''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 16))) for _ in range(300)]
+        index = SimilarityIndex().sync(window)
+        for _ in range(200):
+            text = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 16)))
+            expected = brute_force_max_score(text, window)
+            for min_score in (50, 85, 100):
+                score = index.max_score(text, min_score)
+                if expected >= min_score:
+                    self.assertEqual(score, expected, (text, min_score))
+                else:
+                    self.assertLess(score, min_score, (text, min_score))
+
+    def test_sync_new_registrations(self):
+        index = SimilarityIndex().sync(['alice@example.com', 'bob@example.com', 'carol@example.com'])
+        index.sync(['dave@example.com', 'alice@example.com', 'bob@example.com'])
+
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.max_score('dave@example.com', 85), 100)
+        self.assertLess(index.max_score('carol@example.com', 85), 100)
+
+        # Not a shift of the previous window, rebuilt
+        index.sync(['erin@example.com'])
+        self.assertEqual(index.max_score('erin@example.com', 85), 100)
+        self.assertLess(index.max_score('dave@example.com', 85), 85)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class RecentRegistrationsFillTests(TestCase):
+
+    def test_one_rebuild_for_concurrent_cold_starts(self):
+        self.addCleanup(recent_emails_fill.invalidate)
+
+        def rebuild():
+            time.sleep(0.2)
+            return ['a@example.com']
+
+        with mock.patch('users.utils.redis_client') as client, \
+                mock.patch.object(RegisterUserCheck, 'rebuild_last_emails', side_effect=rebuild) as rebuild_last_emails:
+            client.lrange.return_value = []
+            with ThreadPoolExecutor(8) as executor:
+                results = list(executor.map(lambda _: RegisterUserCheck.get_last_emails(), range(8)))
+
+        rebuild_last_emails.assert_called_once_with()
+        self.assertEqual(results, [['a@example.com']] * 8)
+
+
+@mock.patch('users.utils.RUC_EMAILS_KEY', 'test_ruc_emails')
+@mock.patch.object(RegisterUserCheck, 'COUNT_LAST_EMAILS', 3)
+class RecentRegistrationsTests(TestCase):
+    """
+    Runs against the local Redis from settings.REDIS, skipped when it is not reachable
+    """
+
+    def setUp(self):
+        try:
+            redis_client.ping()
+        except Exception:
+            self.skipTest('needs a local Redis')
+        self.addCleanup(redis_client.delete, 'test_ruc_emails')
+        self.addCleanup(recent_emails_fill.invalidate)
+
+    def test_capped_list(self):
+        User.objects.create_user(username='first', email='first@example.com', password='x')
+        RegisterUserCheck.rebuild_last_emails()
+        for email in ('a@example.com', 'b@example.com', ' C@Example.com ', 'd@example.com'):
+            RegisterUserCheck.add_email(email)
+        self.assertEqual(RegisterUserCheck.get_last_emails(), ['d@example.com', 'c@example.com', 'b@example.com'])
+        self.assertEqual(RegisterUserCheck.get_score_email('C@example.com'), 100)
+
+    def test_rebuild_from_users(self):
+        RegisterUserCheck.add_email('gone@example.com')
+        for name in ('first', 'second', 'third', 'fourth'):
+            User.objects.create_user(username=name, email=f'{name.title()}@example.com', password='x')
+
+        with self.assertNumQueries(1):
+            RegisterUserCheck.rebuild_last_emails()
+        self.assertEqual(
+            RegisterUserCheck.get_last_emails(), ['fourth@example.com', 'third@example.com', 'second@example.com'],
+        )
+
+    def test_cold_start(self):
+        for name in ('first', 'second', 'third', 'fourth'):
+            User.objects.create_user(username=name, email=f'{name}@example.com', password='x')
+
+        # Not started from one registration, the whole window comes from the users
+        RegisterUserCheck.add_email('fourth@example.com')
+        self.assertEqual(redis_client.llen('test_ruc_emails'), 0)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                RegisterUserCheck.get_last_emails(), ['fourth@example.com', 'third@example.com', 'second@example.com'],
+            )
+        with self.assertNumQueries(0):
+            self.assertEqual(RegisterUserCheck.get_score_email('fourth@example.com'), 100)
+
+
+@override_settings(USER_BLOOM_ENABLED=False)
+class GenerateUsernameTests(TestCase):
+
+    def test_one_query(self):
+        with self.assertNumQueries(1):
+            username = generate_cool_username()
+        self.assertTrue(3 <= len(username) <= 20)
+
+    @mock.patch('users.utils.username_candidates', return_value=['SwiftAce10', 'BoldAce11'])
+    def test_taken_candidates_are_skipped(self, _):
+        User.objects.create_user(username='swiftace10', email='a@example.com', password='x')
+        with self.assertNumQueries(1):
+            self.assertEqual(generate_cool_username(), 'BoldAce11')
+
+
+@mock.patch('users.utils.USERNAME_POOL_KEY', 'test_username_pool')
+@override_settings(USERNAME_POOL_SIZE=20, USER_BLOOM_ENABLED=False)
+class UsernamePoolTests(TestCase):
+    """
+    Runs against the local Redis from settings.REDIS, skipped when it is not reachable
+    """
+
+    def setUp(self):
+        try:
+            redis_client.ping()
+        except Exception:
+            self.skipTest('needs a local Redis')
+        self.addCleanup(redis_client.delete, 'test_username_pool')
+
+    def test_refill_and_claim(self):
+        User.objects.create_user(username='SwiftAce10', email='a@example.com', password='x')
+        self.assertEqual(refill_username_pool(), 20)
+        self.assertEqual(refill_username_pool(), 0)
+        redis_client.sadd('test_username_pool', 'SwiftAce10')
+
+        # Every candidate is taken, the username comes from the pool
+        with mock.patch('users.utils.username_candidates', return_value=['SwiftAce10']), self.assertNumQueries(2):
+            username = generate_cool_username()
+        self.assertNotEqual(username, 'SwiftAce10')
+        self.assertFalse(redis_client.sismember('test_username_pool', username))
+
+        # Empty pool, UUID suffix
+        redis_client.delete('test_username_pool')
+        with mock.patch('users.utils.username_candidates', return_value=['SwiftAce10']), \
+                self.assertLogs('users.utils', 'WARNING'):
+            self.assertTrue(generate_cool_username().startswith('SwiftAce10'))
+
+
+class UserBloomTests(TestCase):
+    """
+    Runs against the local Redis from settings.REDIS, skipped when it is not reachable
+    """
+
+    def setUp(self):
+        try:
+            redis_client.ping()
+        except Exception:
+            self.skipTest('needs a local Redis')
+        user_bloom = RedisBloomFilter(redis_client, '{test_users_bloom}', capacity=1000, error_rate=0.001)
+        patcher = mock.patch('users.bloom.user_bloom', user_bloom)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(redis_client.delete, user_bloom.bits_key, user_bloom.ready_key)
+
+    def test_not_built_may_contain_everything(self):
+        self.assertTrue(bloom.email_may_exist('nobody@example.com'))
+
+    def test_negatives_skip_the_database(self):
+        User.objects.create_user(username='SwiftAce10', email='Old@example.com', password='x')
+        self.assertEqual(bloom.rebuild_user_bloom(), 2)
+
+        self.assertTrue(bloom.email_may_exist('old@example.com'))
+        self.assertFalse(bloom.email_may_exist('new@example.com'))
+        self.assertEqual(bloom.usernames_may_exist(['swiftace10', 'BoldAce11']), [True, False])
+
+        # post_save adds new users and email addresses
+        user = User.objects.create_user(username='BoldAce11', email='new@example.com', password='x')
+        EmailAddress.objects.create(user=user, email='second@example.com')
+        self.assertEqual(bloom.usernames_may_exist(['BoldAce11']), [True])
+        self.assertTrue(bloom.email_may_exist('Second@example.com'))
+
+        with mock.patch('users.utils.username_candidates', return_value=['BoldAce11', 'CalmAce12']), \
+                self.assertNumQueries(0):
+            self.assertEqual(generate_cool_username(), 'CalmAce12')
+
+    def test_lost_bitmap_is_not_built(self):
+        User.objects.create_user(username='SwiftAce10', email='old@example.com', password='x')
+        bloom.rebuild_user_bloom()
+        self.assertFalse(bloom.email_may_exist('new@example.com'))
+
+        # The ready marker survived the bitmap, adds do not bring back a partial one
+        redis_client.delete(bloom.user_bloom.bits_key)
+        bloom.add_email('other@example.com')
+        self.assertFalse(redis_client.exists(bloom.user_bloom.bits_key))
+        self.assertTrue(bloom.email_may_exist('new@example.com'))
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend', ALLOWED_HOSTS=['example.com'])
+class AccountEmailTests(TestCase):
+
+    @mock.patch('users.auth.adapters.send_account_email')
+    def test_confirmation_is_sent_by_a_worker(self, task):
+        user = User.objects.create_user(username='SwiftAce10', email='new@example.com', password='x')
+        email_address = EmailAddress.objects.create(user=user, email=user.email)
+        request = RequestFactory(HTTP_HOST='example.com').post('/', {'lang': 'es'})
+        request.data = {'lang': 'es'}
+
+        with request_context(request), self.captureOnCommitCallbacks(execute=True):
+            email_address.send_confirmation(request, signup=True)
+        self.assertEqual(len(mail.outbox), 0)
+
+        (args,), _ = task.apply_async.call_args
+        template_prefix, email, data, lang = args
+        self.assertEqual((template_prefix, email, lang), ('account/email/email_confirmation_signup', 'new@example.com', 'es'))
+        self.assertEqual(data['user_id'], user.pk)
+        self.assertTrue(all(isinstance(value, (str, int, float, bool)) for value in data.values()))
+
+        send_account_email(*args)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['new@example.com'])
+        self.assertIn(data['key'], mail.outbox[0].alternatives[0][0])
+
+    @mock.patch('users.auth.adapters.send_account_email')
+    def test_password_reset_is_sent_by_a_worker(self, task):
+        user = User.objects.create_user(username='SwiftAce10', email='user@example.com', password='x')
+        EmailAddress.objects.create(user=user, email=user.email, verified=True, primary=True)
+        request = RequestFactory(HTTP_HOST='example.com').post('/')
+        request.data = {}
+        form = AllAuthPasswordResetForm(data={'email': 'user@example.com'})
+        self.assertTrue(form.is_valid())
+
+        with request_context(request), self.captureOnCommitCallbacks(execute=True):
+            form.save(request)
+        self.assertEqual(len(mail.outbox), 0)
+
+        (args,), _ = task.apply_async.call_args
+        template_prefix, email, data, lang = args
+        self.assertEqual((template_prefix, email, lang), ('account/email/password_reset_key', 'user@example.com', 'en'))
+        self.assertEqual((data['user_id'], data['uid']), (user.pk, user_pk_to_url_str(user)))
+        self.assertTrue(default_token_generator.check_token(user, data['token']))
+        self.assertTrue(all(isinstance(value, (str, int, float, bool)) for value in data.values()))
+
+        send_account_email(*args)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['user@example.com'])
+        self.assertIn(data['password_reset_url'], mail.outbox[0].alternatives[0][0])
@@ -0,0 +1,56 @@
+from django.conf import settings
+from ipware import get_client_ip
+from rest_framework.exceptions import ParseError, UnsupportedMediaType
+
+from core.throttling import SlidingWindowThrottle
+from users.auth.lookups import normalize_email
+
+
+class AuthEndpointThrottle(SlidingWindowThrottle):
+    """
+    Limits the auth endpoints per IP, per email and per endpoint (all clients together).
+
+    Rates come from settings.AUTH_THROTTLE_RATES by url name, views without an entry are not limited.
+    Works for DRF views and for users.async_views (which set view.data).
+    """
+    key_prefix = 'throttle:auth'
+
+    @staticmethod
+    def get_email(request, view) -> str | None:
+        """
+        Throttles run before the view, so on a DRF view this parses the body.
+        Only called for the endpoints with an email rate. A body that does not parse has no email,
+        DRF keeps the empty data and the view fails its validation as usual
+        """
+        if hasattr(view, 'data'):
+            data = view.data
+        else:
+            try:
+                data = request.data
+            except (ParseError, UnsupportedMediaType):
+                return None
+        email = data.get('email') if hasattr(data, 'get') else None
+        return email if isinstance(email, str) and email else None
+
+    def get_limits(self, request, view):
+        endpoint = request.resolver_match.url_name if request.resolver_match else None
+        rates = settings.AUTH_THROTTLE_RATES.get(endpoint)
+        if not rates:
+            return {}
+
+        # NOTE every client key has its own hash tag, so on Redis Cluster the keys of an endpoint
+        # spread over the slots. The endpoint key is checked last: a request rejected per client
+        # does not use the budget of everybody
+        limits = {}
+        ip = get_client_ip(request)[0]
+        if rates.get('ip') and ip:
+            limits[f'{{{endpoint}:ip:{ip}}}'] = rates['ip']
+
+        email = self.get_email(request, view) if rates.get('email') else None
+        if email:
+            limits[f'{{{endpoint}:email:{normalize_email(email)}}}'] = rates['email']
+
+        if rates.get('endpoint'):
+            limits[f'{{{endpoint}}}'] = rates['endpoint']
+
+        return limits
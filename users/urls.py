@@ -1,4 +1,5 @@
-from django.urls import path, include
+from django.conf import settings
+from django.urls import path, re_path, include
 # from django.views.generic.base import View
 
 from .views import CustomVerifyEmailView, ResendEmailConfirmationView
@@ -8,7 +9,20 @@ from .views import PasswordResetConfirmView
 # class NullView(View):
 #     pass
 
-urlpatterns = [
+urlpatterns = []
+
+if settings.AUTH_ASYNC_VIEWS:
+    from .async_views import AsyncLoginView, AsyncTokenRefreshView, AsyncVerifyEmailView, AsyncResendEmailConfirmationView
+
+    # NOTE these go first so they take the dj_rest_auth urls and names
+    urlpatterns += [
+        re_path(r'^auth/login/?$', AsyncLoginView.as_view(), name='rest_login'),
+        re_path(r'^auth/token/refresh/?$', AsyncTokenRefreshView.as_view(), name='token_refresh'),
+        path('auth/registration/account-confirm-email/', AsyncVerifyEmailView.as_view(), name='account_confirm_email'),
+        path('resend-email-confirmation/', AsyncResendEmailConfirmationView.as_view(), name='resend_email_confirmation'),
+    ]
+
+urlpatterns += [
     path('auth/', include('dj_rest_auth.urls')),
     path('auth/registration/', include('dj_rest_auth.registration.urls')),
     path('auth/registration/account-confirm-email/', CustomVerifyEmailView.as_view(), name='account_confirm_email'),
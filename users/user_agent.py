@@ -0,0 +1,85 @@
+import hashlib
+from functools import lru_cache
+from typing import NamedTuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from user_agents import parse
+
+from users.cache_keys import USER_AGENT_CACHE_KEY
+
+"""
+Cached user agent parsing.
+
+ua-parser runs many regexes per user agent, but real traffic only has a small set of distinct
+user agents. Parsed results are kept in a per-process LRU of settings.USER_AGENT_CACHE_SIZE entries.
+
+With settings.USER_AGENT_REDIS_CACHE (off by default) LRU misses are looked up in the Django cache,
+keyed by a hash of the user agent, so other workers don't parse them again. Any client can send a
+new user agent per request, so those keys live only settings.USER_AGENT_CACHE_TIMEOUT seconds.
+The lookup is blocking, async code uses aget_request_user_agent.
+"""
+
+# Longer strings are truncated before parsing, this also bounds the LRU memory
+MAX_USER_AGENT_LENGTH = 512
+
+
+class ParsedUserAgent(NamedTuple):
+    ua_string: str
+    device: str
+    os: str
+    browser: str
+    device_type: str
+    is_bot: bool
+
+
+def _parse(ua_string: str) -> ParsedUserAgent:
+    user_agent = parse(ua_string)
+    device_type = "Mobil" if user_agent.is_mobile else \
+        "Tableta" if user_agent.is_tablet else \
+        "PC" if user_agent.is_pc else \
+        "Bot" if user_agent.is_bot else "Desconocido"
+
+    return ParsedUserAgent(
+        ua_string=ua_string,
+        device=user_agent.device.family,
+        os=f'({user_agent.os.family} {user_agent.os.version_string})',
+        browser=f'({user_agent.browser.family} {user_agent.browser.version_string})',
+        device_type=device_type,
+        is_bot=user_agent.is_bot,
+    )
+
+
+@lru_cache(maxsize=settings.USER_AGENT_CACHE_SIZE)
+def _parse_cached(ua_string: str) -> ParsedUserAgent:
+    if not settings.USER_AGENT_REDIS_CACHE:
+        return _parse(ua_string)
+
+    key = f'{USER_AGENT_CACHE_KEY}{hashlib.sha1(ua_string.encode()).hexdigest()}'
+    cached = cache.get(key)
+    if cached:
+        return ParsedUserAgent(*cached)
+
+    parsed = _parse(ua_string)
+    cache.set(key, list(parsed), timeout=settings.USER_AGENT_CACHE_TIMEOUT)
+    return parsed
+
+
+def truncate_user_agent(ua_string: str | None) -> str:
+    return (ua_string or '')[:MAX_USER_AGENT_LENGTH]
+
+
+def parse_user_agent(ua_string: str | None) -> ParsedUserAgent:
+    return _parse_cached(truncate_user_agent(ua_string))
+
+
+def get_request_user_agent(request) -> ParsedUserAgent:
+    return parse_user_agent(request.META.get('HTTP_USER_AGENT', ''))
+
+
+async def aget_request_user_agent(request) -> ParsedUserAgent:
+    if settings.USER_AGENT_REDIS_CACHE:
+        # NOTE a LRU miss is a blocking cache lookup, keep it off the event loop
+        return await sync_to_async(get_request_user_agent)(request)
+    return get_request_user_agent(request)
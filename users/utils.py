@@ -1,39 +1,106 @@
+import logging
 import random
-import json
 import uuid
-from fuzzywuzzy import fuzz
 from django.conf import settings
-from django.core.cache import cache
 from django.contrib.auth import get_user_model
 
-from users.cache_keys import RUC_CACHE_KEY
+from backend.cache import redis_client
+from backend.single_flight import single_flight
+from users import bloom
+from users.cache_keys import RUC_EMAILS_FILL_KEY, RUC_EMAILS_KEY, USERNAME_POOL_KEY
+from users.auth.lookups import normalize_email, users_by_usernames
+from users.similarity import SimilarityIndex
+
+logger = logging.getLogger(__name__)
 
 User = get_user_model()
 
 
+# Word lists for username generation
+USERNAME_ADJECTIVES = "swift bold brave bright calm clever cosmic crafty crisp daring deep divine eager elite epic fierce flash fleet flying ghost grand keen laser lunar major mega mighty mystic neon nimble noble prime proud quick rapid royal shadow sharp silent sleek solar solid sonic stark steel storm super titan ultra vital vivid wild wise".split()
+
+USERNAME_NOUNS = "ace agent apex arrow atlas atom blade blaze bolt byte champ comet crow cyber delta drake eagle echo edge falcon flux force frost ghost hawk hero hunter jazz knight legend lynx meteor nebula ninja nova omega orbit phoenix pilot pixel prime pulse raven rebel rex rider rover sage scout shadow shark shield spark storm summit thunder tiger titan vector viking viper vision void wave wizard wolf zenith".split()
+
+
+def username_candidates(count: int, separator: str = "", max_length: int = 20, digits: int = 2) -> list[str]:
+    """
+    Up to count distinct random usernames: an adjective, a noun and a number of that many digits
+    """
+    candidates = {}
+    for _ in range(count * 2):
+        username = random.choice(USERNAME_ADJECTIVES).capitalize() + separator + random.choice(USERNAME_NOUNS).capitalize() + str(random.randint(10**(digits-1), 10**digits - 1))
+
+        # Truncate if too long
+        candidates.setdefault(username[:max_length].lower(), username[:max_length])
+        if len(candidates) >= count:
+            break
+    return list(candidates.values())
+
+
+def free_usernames(candidates: list[str], needed: int | None = None) -> list[str]:
+    """
+    The candidates no user has (whatever the case). The ones the Bloom filter may have are checked
+    in one LOWER(username) IN (...) query, skipped when the filter alone finds `needed` free ones
+    """
+    may_exist = bloom.usernames_may_exist(candidates)
+    surely_free = [username for username, maybe in zip(candidates, may_exist) if not maybe]
+    if len(surely_free) == len(candidates) or (needed is not None and len(surely_free) >= needed):
+        return surely_free
+
+    maybe_taken = [username for username, maybe in zip(candidates, may_exist) if maybe]
+    taken = {username.lower() for username in users_by_usernames(maybe_taken).values_list('username', flat=True)}
+    return [username for username in candidates if username.lower() not in taken]
+
+
+def claim_pooled_usernames(count: int) -> list[str]:
+    # NOTE SPOP removes them, two workers never get the same username
+    return [username.decode() for username in redis_client.spop(USERNAME_POOL_KEY, count) or []]
+
+
+def refill_username_pool(max_batches: int = 50, batch_size: int = 500) -> int:
+    """
+    Adds free usernames to the pool until it has USERNAME_POOL_SIZE, returns how many were added.
+    Moves to longer numbers when most two digit ones are taken
+    """
+    missing = settings.USERNAME_POOL_SIZE - redis_client.scard(USERNAME_POOL_KEY)
+    added = 0
+    digits = 2
+    for _ in range(max_batches):
+        if added >= missing:
+            break
+        candidates = username_candidates(min(batch_size, missing - added), digits=digits)
+        free = free_usernames(candidates)
+        if free:
+            added += redis_client.sadd(USERNAME_POOL_KEY, *free)
+        if len(free) < len(candidates) / 2 and digits < 4:
+            digits += 1
+    return added
+
+
 def generate_cool_username(separator: str = "", max_length: int = 20) -> str:
     """
     Generate a unique cool username by combining adjectives and nouns.
-    Checks that username doesn't exist in database.
-    """    
-    # Word lists for username generation
-    adjectives = "swift bold brave bright calm clever cosmic crafty crisp daring deep divine eager elite epic fierce flash fleet flying ghost grand keen laser lunar major mega mighty mystic neon nimble noble prime proud quick rapid royal shadow sharp silent sleek solar solid sonic stark steel storm super titan ultra vital vivid wild wise".split()
-    
-    nouns = "ace agent apex arrow atlas atom blade blaze bolt byte champ comet crow cyber delta drake eagle echo edge falcon flux force frost ghost hawk hero hunter jazz knight legend lynx meteor nebula ninja nova omega orbit phoenix pilot pixel prime pulse raven rebel rex rider rover sage scout shadow shark shield spark storm summit thunder tiger titan vector viking viper vision void wave wizard wolf zenith".split()
-    
-    for _ in range(30):  # Reduced max attempts for efficiency
- 
-        username = random.choice(adjectives).capitalize() + separator + random.choice(nouns).capitalize() + str(random.randint(10**(2-1), 10**2 - 1))
+    Checks a batch of candidates with one query (none when the Bloom filter proves one free), when all of them are taken claims usernames from
+    the pool (refilled in the background, only for the default separator and length) and checks them
+    with a second one. At most two queries however full the namespace is.
+    """
+    candidates = username_candidates(settings.USERNAME_CANDIDATES, separator, max_length)
+    free = free_usernames(candidates, needed=1)
+    if free:
+        return free[0]
+
+    if not separator and max_length >= 20:
+        # NOTE a few, one could have been generated above since the pool was refilled
+        pooled = claim_pooled_usernames(3)
+        free = free_usernames(pooled, needed=1) if pooled else []
+        if free:
+            if len(free) > 1:
+                redis_client.sadd(USERNAME_POOL_KEY, *free[1:])
+            return free[0]
+        logger.warning('[Usernames] No free username in the pool, run users.tasks.refill_username_pool')
 
-        # Truncate if too long
-        if len(username) > max_length:
-            username = username[:max_length]
-            
-        # Return if unique
-        if not User.objects.filter(username__iexact=username).exists():
-            return username
-    
     # Fallback - add UUID suffix
+    username = candidates[-1]
     unique_suffix = f"{separator}{str(uuid.uuid4())[:8]}"
     if len(username) + len(unique_suffix) > max_length:
         username = username[:max_length - len(unique_suffix)]
@@ -44,15 +111,20 @@ def generate_cool_username(separator: str = "", max_length: int = 20) -> str:
 class RegisterUserCheck:
     """
     Check if the last emails are similar to the current email
+
+    The last COUNT_LAST_EMAILS registrations are a Redis list (newest first) that every registration
+    pushes its email to, rebuilt from the users by the rebuild_recent_registrations command or by
+    the first check that finds it missing (new or flushed Redis)
     """
     COUNT_LAST_EMAILS = getattr(settings, 'RUC_COUNT_EMAILS', 5)
     MIN_SCORE = getattr(settings, 'RUC_MIN_SCORE', 85)
 
-    cache = cache
+    # NOTE per process, updated with the new registrations when the recent emails change
+    index = SimilarityIndex()
 
     @classmethod
     def get_cache_key(cls) -> str:
-        return RUC_CACHE_KEY
+        return RUC_EMAILS_KEY
 
     @classmethod
     def validate_score_email(cls, email: str) -> bool:
@@ -60,30 +132,56 @@ class RegisterUserCheck:
 
     @classmethod
     def get_score_email(cls, email: str) -> int:
+        """
+        Highest fuzz.token_sort_ratio against the recent emails, exact from MIN_SCORE up
+        (see users/similarity.py), below it only known to be lower than MIN_SCORE
+        """
         recent_emails = cls.get_last_emails()
         if not recent_emails:
             return 0
-        
-        # Calculate similarity scores and return the maximum
-        return max(fuzz.token_sort_ratio(email, recent_email) for recent_email in recent_emails)
+        return cls.index.sync(recent_emails).max_score(normalize_email(email), cls.MIN_SCORE)
 
     @classmethod
-    def update_last_emails(cls) -> str:
-        users = User.objects.order_by('-pk')[:cls.COUNT_LAST_EMAILS]
-        username_list = list(users.values_list(
-            'username',
-            flat=True,
-        ))
-        cache_username_str = json.dumps(username_list)
-        cls.cache.set(cls.get_cache_key(), cache_username_str)
+    def add_email(cls, email: str) -> None:
+        """
+        Pushes a new registration and drops the oldest one past COUNT_LAST_EMAILS, in one round trip
+        """
+        # NOTE LPUSHX, a missing list is rebuilt from the users (this one included), not started from one email
+        with redis_client.pipeline() as pipe:
+            pipe.lpushx(RUC_EMAILS_KEY, normalize_email(email))
+            pipe.ltrim(RUC_EMAILS_KEY, 0, cls.COUNT_LAST_EMAILS - 1)
+            pipe.execute()
 
-        return cache_username_str
+    @classmethod
+    def rebuild_last_emails(cls) -> list[str]:
+        """
+        Replaces the list with the emails of the last COUNT_LAST_EMAILS users, e.g. on a new Redis
+        """
+        emails = [
+            normalize_email(email)
+            for email in User.objects.order_by('-pk').values_list('email', flat=True)[:cls.COUNT_LAST_EMAILS]
+        ]
+        # NOTE MULTI/EXEC, the check never sees the list empty or half written
+        with redis_client.pipeline() as pipe:
+            pipe.delete(RUC_EMAILS_KEY)
+            if emails:
+                pipe.rpush(RUC_EMAILS_KEY, *emails)
+            pipe.execute()
+        return emails
 
     @classmethod
     def get_last_emails(cls) -> list[str]:
-        cached_str = cache.get(cls.get_cache_key())
-        if not cached_str:
-            cached_str = cls.update_last_emails()
+        emails = redis_client.lrange(RUC_EMAILS_KEY, 0, cls.COUNT_LAST_EMAILS - 1)
+        if not emails:
+            # NOTE Redis has no empty lists, the list is missing: fall back to the users
+            return recent_emails_fill()
+        return [email.decode() for email in emails]
+
 
-        cached = json.loads(cached_str)
-        return cached
+# NOTE short, it is only read while the list is missing (no users yet or Redis just flushed)
+@single_flight(RUC_EMAILS_FILL_KEY, timeout=10)
+def recent_emails_fill() -> list[str]:
+    """
+    Rebuilds the recent registrations on a cold start, once for all the concurrent registrations
+    """
+    return RegisterUserCheck.rebuild_last_emails()
@@ -10,12 +10,16 @@ from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework.views import APIView
 from rest_framework.request import Request
 from rest_framework.permissions import AllowAny
-from django.core.cache import cache
 from allauth.account.models import EmailAddress
 from django.db.models import Model
 from django.contrib.auth import get_user_model
+from django.http import HttpResponse
+from rest_framework.permissions import IsAdminUser
 
-from users.cache_keys import RESEND_VERIFICATION_TOKEN_CACHE_KEY
+from core.views import HasMetricsToken
+from users.auth.hashing import hashing_pool
+from users.auth.lookups import email_addresses_by_email
+from users.cache_keys import RESEND_VERIFICATION_IN_PROGRESS, RESEND_VERIFICATION_TOKEN
 
 logger = logging.getLogger(__name__)
 
@@ -66,12 +70,12 @@ class ResendEmailConfirmationView(APIView):
         if not token:
             return Response({'Status': False, 'code': 'Token not found'}, status=status.HTTP_400_BAD_REQUEST)
 
-        user_id = cache.get(f'{RESEND_VERIFICATION_TOKEN_CACHE_KEY}{token}')
+        user_id = RESEND_VERIFICATION_TOKEN.get(token)
         if not user_id:
             return Response({'Status': False, 'code': 'Token not found'}, status=status.HTTP_400_BAD_REQUEST)
 
         # check if verification email in progress
-        verification_in_progress = cache.get(f'{RESEND_VERIFICATION_TOKEN_CACHE_KEY}{user_id}')
+        verification_in_progress = RESEND_VERIFICATION_IN_PROGRESS.get(user_id)
         if verification_in_progress:
             return Response({'Status': False, 'code': 'Email confirmation in progress'}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -85,17 +89,17 @@ class ResendEmailConfirmationView(APIView):
         setattr(request, 'LANGUAGE_CODE', translation_get_language())
 
         user = User.objects.get(id=user_id)
-        email_address: EmailAddress = EmailAddress.objects.get(
-            user=user,
-            email=user.email,
-        )
+        email_address: EmailAddress = email_addresses_by_email(
+            user.email,
+            EmailAddress.objects.filter(user=user),
+        ).get()
         if email_address.verified:
             return Response({'Status': False, 'code': 'Email already verified'}, status=status.HTTP_400_BAD_REQUEST)
         logger.info(f"Sending email confirmation to {user.email}")
         email_address.send_confirmation(request)
 
         # set verification in progress by user id
-        cache.set(f'{RESEND_VERIFICATION_TOKEN_CACHE_KEY}{user_id}', 1, timeout=300)  # 5 min for next attempt
+        RESEND_VERIFICATION_IN_PROGRESS.set(user_id, 1)
         return Response({'Status': True}, status=status.HTTP_200_OK)
 
 class PasswordResetConfirmView(TemplateView):
@@ -107,3 +111,13 @@ class PasswordResetConfirmView(TemplateView):
         context['token'] = kwargs.get('token')
         context['uid'] = kwargs.get('uidb64')
         return self.render_to_response(context)
+
+
+class PasswordHashingMetricsView(APIView):
+    """
+    Password hashing pool metrics in the Prometheus text format, of the process serving the request
+    """
+    permission_classes = (HasMetricsToken | IsAdminUser,)
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(hashing_pool.prometheus_text(), content_type='text/plain; version=0.0.4')